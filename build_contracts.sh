@@ -6,6 +6,11 @@ set -e
 opshin build any onchain_token_verification/contracts/authority_trust.py --force-three-params
 opshin build any onchain_token_verification/contracts/token_trust.py --force-three-params
 opshin build any onchain_token_verification/contracts/token_mistrust.py --force-three-params
+# variant of token_trust with outputs indicated in the redeemer
+opshin build any onchain_token_verification/contracts/token_trust_indexed.py --force-three-params
 
 # Build smart voucher
 opshin build mint onchain_token_verification/smart_voucher/muesliswap_pool_verifier.py $(python3 -m onchain_token_verification.contract_address token_trust)
+
+# Write the artifact manifest (policy ids and addresses by script hash) read by the querier
+python3 -m onchain_token_verification.artifacts
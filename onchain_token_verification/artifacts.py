@@ -0,0 +1,135 @@
+"""
+Manifest of the artifacts (policy id and addresses) of the compiled contracts, keyed by script hash.
+
+Generating the artifacts requires opshin and pycardano, which take long to import.
+The manifest is written at build time next to the compiled contracts and only the script hashes
+of the compiled contracts are computed when loading it. opshin is only imported for contracts
+that are missing in the manifest, e.g. because they were rebuilt since it was written.
+
+    python3 -m onchain_token_verification.artifacts
+"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple
+
+_LOGGER = logging.getLogger(__name__)
+
+# same as utils.contract_dir, which can not be imported without importing pycardano
+contract_dir = Path(__file__).parent.parent.joinpath("build")
+MANIFEST_PATH = contract_dir.joinpath("manifest.json")
+
+MANIFEST_VERSION = 1
+
+
+class ContractArtifacts(NamedTuple):
+    script_hash: str
+    policy_id: str
+    mainnet_addr: str
+    testnet_addr: str
+
+
+def script_hash(contract_name: str) -> str:
+    """
+    Hash of the compiled (Plutus V2) contract, as computed by pycardano.plutus_script_hash
+    """
+    with open(contract_dir.joinpath(contract_name).joinpath("script.cbor")) as f:
+        script = bytes.fromhex(f.read().strip())
+    return hashlib.blake2b(b"\x02" + script, digest_size=28).hexdigest()
+
+
+def load_manifest(path: Path = MANIFEST_PATH) -> Dict[str, dict]:
+    """
+    The entries of the manifest by script hash, empty if there is no (valid) manifest
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["scripts"]
+
+
+def write_manifest(scripts: Dict[str, dict], path: Path = MANIFEST_PATH):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "scripts": scripts}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def generate_entry(contract_name: str) -> dict:
+    # imported here, the opshin compiler is only needed when the manifest is stale
+    import opshin
+
+    from onchain_token_verification.utils import get_contract
+
+    artifacts = opshin.generate_artifacts(get_contract(contract_name))
+    return {
+        "policy_id": artifacts.policy_id,
+        "mainnet_addr": artifacts.mainnet_addr,
+        "testnet_addr": artifacts.testnet_addr,
+        "contracts": [contract_name],
+    }
+
+
+def contract_artifacts(
+    contract_names: Iterable[str], path: Path = MANIFEST_PATH
+) -> Dict[str, ContractArtifacts]:
+    """
+    The artifacts of the given compiled contracts by contract name.
+    Contracts missing in the manifest are added to it.
+    """
+    scripts = load_manifest(path)
+    stale = False
+    artifacts = {}
+    for contract_name in contract_names:
+        h = script_hash(contract_name)
+        entry = scripts.get(h)
+        if entry is None:
+            _LOGGER.info(f"Generating artifacts of {contract_name}")
+            entry = scripts[h] = generate_entry(contract_name)
+            stale = True
+        elif contract_name not in entry["contracts"]:
+            # e.g. a contract compiled to the same script as another one
+            entry["contracts"].append(contract_name)
+            stale = True
+        artifacts[contract_name] = ContractArtifacts(
+            h, entry["policy_id"], entry["mainnet_addr"], entry["testnet_addr"]
+        )
+    if stale:
+        try:
+            write_manifest(scripts, path)
+        except OSError as e:
+            _LOGGER.warning(f"Could not update the artifact manifest {path}: {e}")
+    return artifacts
+
+
+def compiled_contracts() -> List[str]:
+    """
+    Names of all compiled contracts in the build directory
+    """
+    return sorted(
+        p.parent.name for p in contract_dir.glob("*/script.cbor") if p.is_file()
+    )
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    # the manifest is regenerated from scratch, dropping entries of outdated builds
+    scripts: Dict[str, dict] = {}
+    for contract_name in compiled_contracts():
+        h = script_hash(contract_name)
+        if h in scripts:
+            scripts[h]["contracts"].append(contract_name)
+        else:
+            scripts[h] = generate_entry(contract_name)
+    write_manifest(scripts)
+    print(f"Wrote artifacts of {len(scripts)} scripts to {MANIFEST_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compares the conversion of CIP-68 datums to json through pycardano (CIP68Datum.from_cbor and
+cip68_to_json) against the direct conversion from cbor (cip68_cbors_to_json), for metadata maps
+of increasing size. Checks that both produce the same output.
+
+    python3 -m onchain_token_verification.benchmark.cip68_decoding --keys 10 100 1000
+"""
+import argparse
+import json
+import platform
+import random
+import time
+from pathlib import Path
+
+import cbor2
+
+from onchain_token_verification.benchmark.querier_pipeline import current_commit
+from onchain_token_verification.cip68 import cip68_cbors_to_json, cip68_to_json
+from onchain_token_verification.contracts.cip68 import CIP68Datum
+
+NOTHING = cbor2.CBORTag(127, [])
+
+
+def synthetic_datum(rng: random.Random, keys: int) -> bytes:
+    metadata = {}
+    for i in range(keys):
+        kind = rng.random()
+        if kind < 0.5:
+            value = rng.randbytes(rng.randint(10, 64))
+        elif kind < 0.7:
+            value = rng.randint(0, 2**70)
+        elif kind < 0.9:
+            value = [rng.randbytes(20) for _ in range(rng.randint(1, 5))]
+        else:
+            value = {b"k%d" % j: rng.randint(0, 100) for j in range(3)}
+        metadata[b"key%d" % i] = value
+    return cbor2.dumps(cbor2.CBORTag(121, [metadata, 1, NOTHING]))
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        "Compares the conversion of CIP-68 datums through pycardano and directly from cbor"
+    )
+    argparser.add_argument("--keys", type=int, nargs="+", default=[10, 100, 1000])
+    argparser.add_argument(
+        "--datums",
+        type=int,
+        default=1000,
+        help="Number of datums converted per metadata size",
+    )
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--output", type=Path, default=Path("cip68_decoding.json"))
+    args = argparser.parse_args()
+
+    report = {
+        "benchmark": "cip68_decoding",
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "parameters": {"datums": args.datums, "seed": args.seed},
+        "results": [],
+    }
+    rng = random.Random(args.seed)
+    for keys in args.keys:
+        datums = [synthetic_datum(rng, keys) for _ in range(args.datums)]
+
+        start = time.perf_counter()
+        expected = [cip68_to_json(CIP68Datum.from_cbor(datum)) for datum in datums]
+        pycardano_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        converted = cip68_cbors_to_json(datums)
+        direct_seconds = time.perf_counter() - start
+
+        if converted != expected:
+            raise AssertionError(f"Outputs differ for metadata with {keys} keys")
+        print(
+            f"{keys:>6} keys: pycardano {pycardano_seconds:.3f}s, direct {direct_seconds:.3f}s, "
+            f"speedup {pycardano_seconds / direct_seconds:.1f}x"
+        )
+        report["results"].append(
+            {
+                "keys": keys,
+                "pycardano_seconds": pycardano_seconds,
+                "direct_seconds": direct_seconds,
+            }
+        )
+
+    with args.output.open("w") as fp:
+        json.dump(report, fp, indent=2)
+    print(f"Wrote report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,658 @@
+"""
+Profiles the execution units (CPU steps and memory) the validators use, depending on the shape
+of the transaction.
+
+Builds synthetic script contexts with varying numbers of registrations (outputs when minting,
+inputs when withdrawing), additional outputs, wallet inputs, signatories and additional minting
+policies, evaluates the compiled scripts from build/ on them and reports the budget curves.
+The per transaction budget of the batch scenarios is compared against the protocol limits,
+yielding the maximum number of registrations per transaction.
+
+The uplc package only counts machine steps, so the budget is accounted here with the
+Plutus V2 cost model of pycardano (the CEK machine costs per step and the costing functions
+of the builtins). The numbers should match the node closely, but are no substitute for
+evaluating the final transaction.
+
+    python3 -m onchain_token_verification.benchmark.execution_units
+    python3 -m onchain_token_verification.benchmark.execution_units --contracts token_trust --registrations 1 10 50
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import platform
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from opshin.ledger.api_v2 import (
+    Address,
+    Minting,
+    NoOutputDatum,
+    NoScriptHash,
+    NoStakingCredential,
+    Nothing,
+    PubKeyCredential,
+    ScriptContext,
+    ScriptCredential,
+    SomeOutputDatum,
+    Spending,
+    TxId,
+    TxInInfo,
+    TxInfo,
+    TxOut,
+    TxOutRef,
+    POSIXTimeRange,
+    LowerBoundPOSIXTime,
+    UpperBoundPOSIXTime,
+    NegInfPOSIXTime,
+    PosInfPOSIXTime,
+    FalseData,
+)
+from pycardano import plutus_script_hash
+from pycardano.plutus import PLUTUS_V2_COST_MODEL
+from uplc import ast as uplc_ast
+from uplc.machine import Machine
+from uplc.tools import unflatten
+
+from onchain_token_verification.benchmark.querier_pipeline import current_commit
+from onchain_token_verification.contracts.cip68 import CIP68Datum
+from onchain_token_verification.scripts.batch import CONTRACTS
+from onchain_token_verification.utils import contract_dir, get_contract
+
+POOL_VERIFIER = "muesliswap_pool_verifier"
+# variants of the registry contracts that are not used by the scripts
+VARIANTS = ["token_trust_indexed"]
+
+# limits of a transaction, as of protocol version 8
+MAX_TX_EX_MEM = 14_000_000
+MAX_TX_EX_STEPS = 10_000_000_000
+
+# costing function of each builtin (named as in the cost model) by resource, where not constant:
+# the size of the arguments the cost is linear in, or a special shape
+CPU_MODELS = {
+    "addInteger": "max",
+    "subtractInteger": "max",
+    "multiplyInteger": "added",
+    "divideInteger": "above_diagonal",
+    "quotientInteger": "above_diagonal",
+    "remainderInteger": "above_diagonal",
+    "modInteger": "above_diagonal",
+    "equalsInteger": "min",
+    "lessThanInteger": "min",
+    "lessThanEqualsInteger": "min",
+    "appendByteString": "added",
+    "consByteString": "y",
+    "sliceByteString": "z",
+    "equalsByteString": "diagonal",
+    "lessThanByteString": "min",
+    "lessThanEqualsByteString": "min",
+    "sha2_256": "x",
+    "sha3_256": "x",
+    "blake2b_256": "x",
+    "verifyEd25519Signature": "y",
+    "appendString": "added",
+    "equalsString": "diagonal",
+    "encodeUtf8": "x",
+    "decodeUtf8": "x",
+    "equalsData": "min",
+    "serialiseData": "x",
+}
+MEMORY_MODELS = {
+    "addInteger": "max",
+    "subtractInteger": "max",
+    "multiplyInteger": "added",
+    "divideInteger": "subtracted",
+    "quotientInteger": "subtracted",
+    "remainderInteger": "subtracted",
+    "modInteger": "subtracted",
+    "appendByteString": "added",
+    "consByteString": "added",
+    "sliceByteString": "z",
+    "appendString": "added",
+    "encodeUtf8": "x",
+    "decodeUtf8": "x",
+    "serialiseData": "x",
+}
+
+# cost of each step of the CEK machine by the kind of term computed
+STEP_COSTS = {
+    uplc_ast.Variable: "cekVarCost",
+    uplc_ast.BoundStateLambda: "cekLamCost",
+    uplc_ast.Apply: "cekApplyCost",
+    uplc_ast.BoundStateDelay: "cekDelayCost",
+    uplc_ast.Force: "cekForceCost",
+    uplc_ast.Constant: "cekConstCost",
+    uplc_ast.ForcedBuiltIn: "cekBuiltinCost",
+}
+
+
+def memory_size(value) -> int:
+    """
+    Size of a constant in words of 8 bytes, as used by the costing functions
+    """
+    if isinstance(value, (uplc_ast.BuiltinInteger, uplc_ast.PlutusInteger)):
+        return 1 if value.value == 0 else (abs(value.value).bit_length() - 1) // 64 + 1
+    if isinstance(value, (uplc_ast.BuiltinByteString, uplc_ast.PlutusByteString)):
+        return 1 if not value.value else (len(value.value) - 1) // 8 + 1
+    if isinstance(value, uplc_ast.BuiltinString):
+        return len(value.value)
+    if isinstance(value, uplc_ast.BuiltinList):
+        return sum(memory_size(v) for v in value.values)
+    if isinstance(value, uplc_ast.BuiltinPair):
+        return 1 + memory_size(value.l_value) + memory_size(value.r_value)
+    if isinstance(value, uplc_ast.PlutusConstr):
+        return 4 + sum(memory_size(v) for v in value.fields)
+    if isinstance(value, uplc_ast.PlutusList):
+        return 4 + sum(memory_size(v) for v in value.value)
+    if isinstance(value, uplc_ast.PlutusMap):
+        return 4 + sum(memory_size(k) + memory_size(v) for k, v in value.value.items())
+    return 1
+
+
+def builtin_cost(name: str, resource: str, sizes: List[int]) -> int:
+    """
+    Cost of a builtin call in the given resource ("cpu" or "memory") for the argument sizes
+    """
+    prefix = f"{name}-{resource}-arguments"
+    model = (CPU_MODELS if resource == "cpu" else MEMORY_MODELS).get(name)
+    if model is None:
+        return PLUTUS_V2_COST_MODEL[prefix]
+    x, y, z = (sizes + [0, 0, 0])[:3]
+    if model == "diagonal":
+        if x != y:
+            return PLUTUS_V2_COST_MODEL[f"{prefix}-constant"]
+        size = x
+    elif model == "above_diagonal":
+        if x < y:
+            return PLUTUS_V2_COST_MODEL[f"{prefix}-constant"]
+        prefix, size = f"{prefix}-model-arguments", x * y
+    elif model == "subtracted":
+        return max(
+            PLUTUS_V2_COST_MODEL[f"{prefix}-minimum"],
+            PLUTUS_V2_COST_MODEL[f"{prefix}-intercept"]
+            + PLUTUS_V2_COST_MODEL[f"{prefix}-slope"] * (x - y),
+        )
+    else:
+        size = {
+            "max": max(x, y),
+            "min": min(x, y),
+            "added": x + y,
+            "x": x,
+            "y": y,
+            "z": z,
+        }[model]
+    return (
+        PLUTUS_V2_COST_MODEL[f"{prefix}-intercept"]
+        + PLUTUS_V2_COST_MODEL[f"{prefix}-slope"] * size
+    )
+
+
+class BudgetMachine(Machine):
+    """
+    CEK machine of uplc that accounts the execution budget of the evaluation
+    """
+
+    def __init__(self, program: uplc_ast.AST, max_steps=10**9):
+        super().__init__(program, max_steps)
+        self.cpu = PLUTUS_V2_COST_MODEL["cekStartupCost-exBudgetCPU"]
+        self.memory = PLUTUS_V2_COST_MODEL["cekStartupCost-exBudgetMemory"]
+        # cost of a step by the type of the computed term, resolved along the class hierarchy
+        self._step_costs: Dict[type, Tuple[int, int]] = {}
+
+    def _step_cost(self, term_type: type) -> Tuple[int, int]:
+        if term_type not in self._step_costs:
+            cost = (0, 0)
+            for cls in term_type.__mro__:
+                if cls in STEP_COSTS:
+                    cost = (
+                        PLUTUS_V2_COST_MODEL[f"{STEP_COSTS[cls]}-exBudgetCPU"],
+                        PLUTUS_V2_COST_MODEL[f"{STEP_COSTS[cls]}-exBudgetMemory"],
+                    )
+                    break
+            self._step_costs[term_type] = cost
+        return self._step_costs[term_type]
+
+    def eval(self):
+        # mirrors Machine.eval, accounting the cost of every compute step
+        stack = [
+            uplc_ast.Compute(
+                uplc_ast.NoFrame(), uplc_ast.frozendict.frozendict(), self.program
+            )
+        ]
+        while stack:
+            step = stack.pop()
+            if isinstance(step, uplc_ast.Compute):
+                cpu, memory = self._step_cost(type(step.term))
+                self.cpu += cpu
+                self.memory += memory
+                stack.append(step.term.eval(step.ctx, step.env))
+            elif isinstance(step, uplc_ast.Return):
+                stack.append(self.return_compute(step.context, step.value))
+            elif isinstance(step, uplc_ast.Done):
+                return step.term
+
+    def apply_evaluate(self, context, function, argument):
+        if isinstance(function, uplc_ast.ForcedBuiltIn):
+            eval_fun = uplc_ast.BuiltInFunEvalMap[function.builtin]
+            if (
+                function.applied_forces == uplc_ast.BuiltInFunForceMap[function.builtin]
+                and eval_fun.__code__.co_argcount == len(function.bound_arguments) + 1
+            ):
+                name = function.builtin.name[0].lower() + function.builtin.name[1:]
+                sizes = [memory_size(a) for a in function.bound_arguments + [argument]]
+                self.cpu += builtin_cost(name, "cpu", sizes)
+                self.memory += builtin_cost(name, "memory", sizes)
+        return super().apply_evaluate(context, function, argument)
+
+
+@dataclass
+class Evaluation:
+    cpu: int
+    memory: int
+    # None if the script succeeded, the error otherwise
+    error: Optional[str] = None
+
+
+def load_script(name: str) -> Optional[uplc_ast.Program]:
+    path = contract_dir.joinpath(name).joinpath("script.cbor")
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return unflatten(bytes.fromhex(f.read()))
+
+
+def evaluate(program: uplc_ast.Program, args: list) -> Evaluation:
+    """
+    Evaluates the script applied to the given arguments (pycardano PlutusData)
+    """
+    term = program.term
+    for arg in args:
+        term = uplc_ast.Apply(term, uplc_ast.data_from_cbor(arg.to_cbor()))
+    machine = BudgetMachine(uplc_ast.Program(program.version, term))
+    try:
+        machine.eval()
+    except Exception as e:
+        return Evaluation(machine.cpu, machine.memory, f"{type(e).__name__}: {e}")
+    return Evaluation(machine.cpu, machine.memory)
+
+
+def _hash(*parts, size=28) -> bytes:
+    return hashlib.blake2b(repr(parts).encode(), digest_size=size).digest()
+
+
+def _tx_ref(*parts) -> TxOutRef:
+    return TxOutRef(TxId(_hash(*parts, size=32)), 0)
+
+
+def _wallet(i: int) -> Address:
+    return Address(PubKeyCredential(_hash("wallet", i)), NoStakingCredential())
+
+
+def _script(script_hash: bytes) -> Address:
+    return Address(ScriptCredential(script_hash), NoStakingCredential())
+
+
+def _lovelace(amount: int) -> Dict[bytes, Dict[bytes, int]]:
+    return {b"": {b"": amount}}
+
+
+ALWAYS = POSIXTimeRange(
+    LowerBoundPOSIXTime(NegInfPOSIXTime(), FalseData()),
+    UpperBoundPOSIXTime(PosInfPOSIXTime(), FalseData()),
+)
+
+
+@dataclass
+class Shape:
+    """
+    Shape of a synthetic transaction
+    """
+
+    # registrations minted (outputs) or withdrawn (inputs)
+    registrations: int = 1
+    # outputs besides the registrations and the change
+    outputs: int = 0
+    # wallet inputs funding the transaction
+    inputs: int = 1
+    signatories: int = 1
+    # minting policies besides the one of the contract
+    mints: int = 0
+
+
+def _tx_info(
+    shape: Shape,
+    script_inputs: List[TxInInfo],
+    reference_inputs: List[TxInInfo],
+    outputs: List[TxOut],
+    mint: dict,
+    signer: bytes,
+    change_assets: Optional[dict] = None,
+) -> TxInfo:
+    extra_mint = {_hash("policy", i): {b"token": 1} for i in range(shape.mints)}
+    change = TxOut(
+        _wallet(0),
+        {**_lovelace(10_000_000), **extra_mint, **(change_assets or {})},
+        NoOutputDatum(),
+        NoScriptHash(),
+    )
+    return TxInfo(
+        inputs=[
+            TxInInfo(
+                _tx_ref("input", i),
+                TxOut(
+                    _wallet(i),
+                    _lovelace(1_000_000_000),
+                    NoOutputDatum(),
+                    NoScriptHash(),
+                ),
+            )
+            for i in range(shape.inputs)
+        ]
+        + script_inputs,
+        reference_inputs=reference_inputs,
+        outputs=outputs
+        + [
+            TxOut(_wallet(i + 1), _lovelace(2_000_000), NoOutputDatum(), NoScriptHash())
+            for i in range(shape.outputs)
+        ]
+        + [change],
+        fee=_lovelace(500_000),
+        mint={**_lovelace(0), **mint, **extra_mint},
+        dcert=[],
+        wdrl={},
+        valid_range=ALWAYS,
+        # the signer comes last, the worst case for the validators searching it
+        signatories=[_hash("signatory", i) for i in range(shape.signatories - 1)]
+        + [signer],
+        redeemers={},
+        data={},
+        id=TxId(_hash("tx", size=32)),
+    )
+
+
+def contract_module(contract_name: str):
+    return importlib.import_module(
+        f"onchain_token_verification.contracts.{contract_name}"
+    )
+
+
+def registration(contract_name: str, i: int, signer: bytes):
+    contract = contract_module(contract_name)
+    if contract_name.startswith("authority_trust"):
+        subject = _hash("authority", i)
+    else:
+        subject = contract.Token(_hash("policy", i), b"token%d" % i)
+    metadata = CIP68Datum({b"name": b"Registration %d" % i}, 1, Nothing())
+    return contract.Registration(subject, signer, metadata)
+
+
+def registration_scenarios(
+    contract_name: str, script_hash: bytes
+) -> Dict[str, Callable[[Shape], List[list]]]:
+    """
+    Scenarios of a registry contract, each mapping a shape to the arguments of all script
+    evaluations in the transaction. Variants with the OwnOutputs redeemer are passed the
+    indices of the outputs to the contract.
+    """
+    contract = contract_module(contract_name)
+    token_name = contract.TOKENNAME
+    address = _script(script_hash)
+    signer = _hash("signer")
+
+    def registration_output(i: int) -> TxOut:
+        return TxOut(
+            address,
+            {**_lovelace(2_000_000), script_hash: {token_name: 1}},
+            SomeOutputDatum(registration(contract_name, i, signer)),
+            NoScriptHash(),
+        )
+
+    def redeemer(own_outputs: List[int]):
+        if hasattr(contract, "OwnOutputs"):
+            return contract.OwnOutputs(own_outputs)
+        return Nothing()
+
+    def register(shape: Shape) -> List[list]:
+        tx_info = _tx_info(
+            shape,
+            [],
+            [],
+            [registration_output(i) for i in range(shape.registrations)],
+            {script_hash: {token_name: shape.registrations}},
+            signer,
+        )
+        # the registrations are the first outputs
+        own_outputs = list(range(shape.registrations))
+        return [[redeemer(own_outputs), ScriptContext(tx_info, Minting(script_hash))]]
+
+    def withdraw(shape: Shape) -> List[list]:
+        script_inputs = [
+            TxInInfo(_tx_ref("registration", i), registration_output(i))
+            for i in range(shape.registrations)
+        ]
+        tx_info = _tx_info(
+            shape,
+            script_inputs,
+            [],
+            [],
+            {script_hash: {token_name: -shape.registrations}},
+            signer,
+        )
+        return [
+            [
+                registration(contract_name, i, signer),
+                redeemer([]),
+                ScriptContext(tx_info, Spending(script_input.out_ref)),
+            ]
+            for i, script_input in enumerate(script_inputs)
+        ] + [[redeemer([]), ScriptContext(tx_info, Minting(script_hash))]]
+
+    return {"register": register, "withdraw": withdraw}
+
+
+def pool_verifier_scenarios(
+    script_hash: bytes, vouching_hash: bytes
+) -> Dict[str, Callable[[Shape], List[list]]]:
+    """
+    Scenarios of the smart voucher, which mints a voucher next to registrations at the
+    vouching address (the registrations count the outputs at the vouching address)
+    """
+    from onchain_token_verification.smart_voucher import muesliswap_pool_verifier as v
+
+    nft_name = b"pool"
+    vouching_address = _script(vouching_hash)
+    signer = _hash("signer")
+
+    def pool(lovelace: int) -> TxInInfo:
+        return TxInInfo(
+            _tx_ref("pool"),
+            TxOut(
+                _script(v.POOL_SCRIPT_HASH),
+                {**_lovelace(lovelace), v.POOL_NFT_POLICYID: {nft_name: 1}},
+                NoOutputDatum(),
+                NoScriptHash(),
+            ),
+        )
+
+    def vouching_outputs(shape: Shape) -> List[TxOut]:
+        return [
+            TxOut(
+                vouching_address,
+                _lovelace(2_000_000),
+                SomeOutputDatum(registration("token_trust", i, signer)),
+                NoScriptHash(),
+            )
+            for i in range(shape.registrations)
+        ]
+
+    def mint(shape: Shape) -> List[list]:
+        tx_info = _tx_info(
+            shape,
+            [],
+            [pool(v.THRESHOLD)],
+            vouching_outputs(shape),
+            {script_hash: {nft_name: 1}},
+            signer,
+            # the validator expects the voucher in the only output not at the vouching address
+            change_assets={script_hash: {nft_name: 1}},
+        )
+        return [[v.MintRedeemer(0), ScriptContext(tx_info, Minting(script_hash))]]
+
+    def burn(shape: Shape) -> List[list]:
+        tx_info = _tx_info(
+            shape,
+            [],
+            [pool(v.THRESHOLD - 1)],
+            vouching_outputs(shape),
+            {script_hash: {nft_name: -1}},
+            signer,
+        )
+        return [[v.BurnRedeemer(0), ScriptContext(tx_info, Minting(script_hash))]]
+
+    return {"mint": mint, "burn": burn}
+
+
+def evaluate_shape(
+    program: uplc_ast.Program, scenario: Callable[[Shape], List[list]], shape: Shape
+) -> dict:
+    evaluations = [evaluate(program, args) for args in scenario(shape)]
+    errors = [e.error for e in evaluations if e.error is not None]
+    return {
+        "evaluations": len(evaluations),
+        "cpu": sum(e.cpu for e in evaluations),
+        "memory": sum(e.memory for e in evaluations),
+        "max_cpu": max(e.cpu for e in evaluations),
+        "max_memory": max(e.memory for e in evaluations),
+        "error": errors[0] if errors else None,
+    }
+
+
+def max_registrations(
+    program: uplc_ast.Program, scenario: Callable[[Shape], List[list]], limit: int
+) -> Optional[int]:
+    """
+    Largest number of registrations (up to the limit) in a transaction of the base shape
+    whose scripts stay within the execution unit limits, found by doubling and bisecting
+    """
+
+    def fits(n: int) -> bool:
+        result = evaluate_shape(program, scenario, Shape(registrations=n))
+        return (
+            result["error"] is None
+            and result["cpu"] <= MAX_TX_EX_STEPS
+            and result["memory"] <= MAX_TX_EX_MEM
+        )
+
+    if not fits(1):
+        return None
+    best, failed = 1, None
+    while failed is None and best < limit:
+        n = min(2 * best, limit)
+        if fits(n):
+            best = n
+        else:
+            failed = n
+    while failed is not None and failed - best > 1:
+        n = (best + failed) // 2
+        if fits(n):
+            best = n
+        else:
+            failed = n
+    return best
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        "Profiles the execution units of the validators across transaction shapes"
+    )
+    argparser.add_argument(
+        "--contracts",
+        nargs="+",
+        default=[*CONTRACTS, *VARIANTS, POOL_VERIFIER],
+        help="Contracts to profile, the compiled scripts are read from build/",
+    )
+    argparser.add_argument(
+        "--registrations", type=int, nargs="+", default=[1, 2, 5, 10, 20]
+    )
+    argparser.add_argument("--outputs", type=int, nargs="+", default=[0, 5, 10, 20])
+    argparser.add_argument("--inputs", type=int, nargs="+", default=[1, 5, 10, 20])
+    argparser.add_argument("--signatories", type=int, nargs="+", default=[1, 2, 4, 8])
+    argparser.add_argument("--mints", type=int, nargs="+", default=[0, 1, 4, 8])
+    argparser.add_argument(
+        "--max-registrations",
+        type=int,
+        default=256,
+        help="Upper bound of the search for the maximum registrations per transaction, 0 to skip",
+    )
+    argparser.add_argument("--output", type=Path, default=Path("execution_units.json"))
+    args = argparser.parse_args()
+
+    report = {
+        "benchmark": "execution_units",
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "parameters": {
+            "max_tx_ex_steps": MAX_TX_EX_STEPS,
+            "max_tx_ex_mem": MAX_TX_EX_MEM,
+        },
+        "results": [],
+        "max_registrations": [],
+    }
+    axes = {
+        "registrations": args.registrations,
+        "outputs": args.outputs,
+        "inputs": args.inputs,
+        "signatories": args.signatories,
+        "mints": args.mints,
+    }
+    for contract_name in args.contracts:
+        program = load_script(contract_name)
+        if program is None:
+            print(f"{contract_name}: no compiled script in {contract_dir}, skipping")
+            continue
+        script_hash = plutus_script_hash(get_contract(contract_name)).payload
+        if contract_name == POOL_VERIFIER:
+            # the voucher is minted next to registrations at token_trust
+            scenarios = pool_verifier_scenarios(
+                script_hash, plutus_script_hash(get_contract("token_trust")).payload
+            )
+        else:
+            scenarios = registration_scenarios(contract_name, script_hash)
+        for scenario_name, scenario in scenarios.items():
+            for axis, values in axes.items():
+                for value in values:
+                    shape = Shape(**{axis: value})
+                    start = time.perf_counter()
+                    result = evaluate_shape(program, scenario, shape)
+                    result.update(
+                        contract=contract_name,
+                        scenario=scenario_name,
+                        axis=axis,
+                        value=value,
+                        seconds=time.perf_counter() - start,
+                    )
+                    report["results"].append(result)
+                    print(
+                        f"{contract_name:<26}{scenario_name:<10}{axis:<14}{value:>5}"
+                        f"{result['cpu']:>16,} steps{result['memory']:>14,} mem"
+                        + (f"  FAILED {result['error']}" if result["error"] else "")
+                    )
+            if args.max_registrations:
+                n = max_registrations(program, scenario, args.max_registrations)
+                report["max_registrations"].append(
+                    {"contract": contract_name, "scenario": scenario_name, "max": n}
+                )
+                print(
+                    f"{contract_name:<26}{scenario_name:<10}max registrations per transaction: {n}"
+                )
+
+    with args.output.open("w") as fp:
+        json.dump(report, fp, indent=2)
+    print(f"Wrote report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
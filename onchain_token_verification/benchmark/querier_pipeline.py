@@ -0,0 +1,342 @@
+"""
+Benchmarks the stages of the querier pipeline on synthetic registries.
+
+Generates registration UTxOs (in the Ogmios json format) for each contract, with CIP-68
+metadata of varying size, a share of malformed datums and a share of outputs without the
+registration token. Times every stage, optionally records the memory peak of each stage,
+and writes a json report that can be compared against the report of another commit.
+
+    python3 -m onchain_token_verification.benchmark.querier_pipeline --sizes 10000 100000
+    python3 -m onchain_token_verification.benchmark.querier_pipeline --compare old.json
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+import cbor2
+from pycardano import PlutusData
+
+from onchain_token_verification.cip68 import cip68_primitive_to_json
+from onchain_token_verification.rest.chainsync import (
+    WatchedContract,
+    registration_datum,
+)
+from onchain_token_verification.rest.querier import watched_contracts
+from onchain_token_verification.rest.registrations import (
+    decode_registration,
+    NOTHING_PRIMITIVE,
+    split_registration,
+    utxo_ref,
+)
+from onchain_token_verification.rest.snapshot import AtomicWriter, write_views
+from onchain_token_verification.rest.store import RegistrationStore
+
+# tag of constructor 0 and of Nothing (constructor 6) in the cbor encoding of plutus data
+CONSTR_0 = 121
+NOTHING = cbor2.CBORTag(127, [])
+
+METADATA_KEYS = [b"name", b"ticker", b"description", b"url", b"logo", b"decimals"]
+
+
+def random_metadata(rng: random.Random, max_keys: int) -> dict:
+    metadata = {
+        b"name": rng.randbytes(rng.randint(3, 30)),
+        b"ticker": rng.randbytes(rng.randint(2, 6)),
+    }
+    for i in range(rng.randint(0, max_keys)):
+        key = METADATA_KEYS[i] if i < len(METADATA_KEYS) else b"key%d" % i
+        kind = rng.random()
+        if kind < 0.4:
+            metadata[key] = rng.randbytes(rng.randint(10, 400))
+        elif kind < 0.6:
+            metadata[key] = rng.randint(0, 2**70)
+        elif kind < 0.8:
+            metadata[key] = [rng.randbytes(20) for _ in range(rng.randint(1, 5))]
+        else:
+            metadata[key] = {b"k%d" % j: rng.randint(0, 100) for j in range(3)}
+    return metadata
+
+
+def synthetic_utxos(
+    contract: WatchedContract,
+    size: int,
+    rng: random.Random,
+    malformed: float,
+    without_token: float,
+    max_metadata_keys: int,
+) -> List[Tuple[dict, dict]]:
+    signers = [rng.randbytes(28) for _ in range(50)]
+    policies = [rng.randbytes(28) for _ in range(max(1, size // 4))]
+    token_subjects = contract.name != "authority_trust"
+    utxos = []
+    for i in range(size):
+        if token_subjects:
+            subject = cbor2.CBORTag(
+                CONSTR_0, [rng.choice(policies), rng.randbytes(rng.randint(0, 32))]
+            )
+        else:
+            subject = rng.randbytes(28)
+        if rng.random() < 0.1:
+            metadata = NOTHING
+        else:
+            metadata = cbor2.CBORTag(
+                CONSTR_0, [random_metadata(rng, max_metadata_keys), 1, NOTHING]
+            )
+        datum = cbor2.CBORTag(CONSTR_0, [subject, rng.choice(signers), metadata])
+        if rng.random() < malformed:
+            # a registration with the fields in the wrong order
+            datum = cbor2.CBORTag(CONSTR_0, datum.value[::-1])
+        assets = {} if rng.random() < without_token else {contract.asset: 1}
+        utxos.append(
+            (
+                {"txId": rng.randbytes(32).hex(), "index": i % 4},
+                {
+                    "address": contract.address,
+                    "value": {"coins": 2_000_000, "assets": assets},
+                    "datumHash": None,
+                    "datum": cbor2.dumps(datum).hex(),
+                },
+            )
+        )
+    return utxos
+
+
+class NullWriter:
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data: bytes):
+        self.bytes_written += len(data)
+
+
+def pipeline_stages(
+    contract: WatchedContract, utxos: List[Tuple[dict, dict]], directory: Path
+) -> List[Tuple[str, Callable]]:
+    """
+    The stages of the pipeline, each consuming the result of the previous stage
+    """
+
+    def filtering(_):
+        datums = []
+        for tx_in, output in utxos:
+            ref = utxo_ref(tx_in["txId"], tx_in["index"])
+            datum = registration_datum(ref, output, contract)
+            if datum is not None:
+                datums.append((ref, datum))
+        return datums
+
+    def cbor_decode(datums):
+        decoded = []
+        for ref, datum in datums:
+            split = split_registration(datum, contract.registration_class)
+            if split is not None:
+                decoded.append((ref, split))
+                continue
+            # like the querier, decode datums of an unusual shape with pycardano
+            entry = decode_registration(ref, datum, contract.registration_class)
+            if entry is not None:
+                decoded.append((ref, entry))
+        return decoded
+
+    def cip68_conversion(decoded):
+        registrations = []
+        for ref, split in decoded:
+            if isinstance(split[0], str):
+                registrations.append(split)
+                continue
+            registration, metadata = split
+            registrations.append(
+                (
+                    PlutusData.to_json(registration.subject),
+                    {
+                        "signer": registration.signer.hex(),
+                        "utxo": ref,
+                        **(
+                            cip68_primitive_to_json(metadata)
+                            if metadata != NOTHING_PRIMITIVE
+                            else {"metadata": None}
+                        ),
+                    },
+                )
+            )
+        return registrations
+
+    def storing(registrations):
+        # a fresh store for every run, so that each run inserts all registrations
+        store = RegistrationStore(directory / f"{contract.name}-{uuid.uuid4()}.sqlite3")
+        store.replace(contract.name, registrations)
+        return store
+
+    def serialization(store):
+        write_views(store, contract.name, NullWriter(), NullWriter())
+        return store
+
+    def file_write(store):
+        with AtomicWriter(
+            directory / f"{contract.name}-subjects.json", precompress=True
+        ) as subjects_writer, AtomicWriter(
+            directory / f"{contract.name}-signers.json", precompress=True
+        ) as signers_writer:
+            write_views(store, contract.name, subjects_writer, signers_writer)
+        return subjects_writer.bytes_written + signers_writer.bytes_written
+
+    return [
+        ("filtering", filtering),
+        ("cbor_decode", cbor_decode),
+        ("cip68_conversion", cip68_conversion),
+        ("storing", storing),
+        ("serialization", serialization),
+        ("file_write", file_write),
+    ]
+
+
+def run_stages(stages, trace_memory: bool) -> List[dict]:
+    results = []
+    value = None
+    for stage, run in stages:
+        if trace_memory:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        value = run(value)
+        seconds = time.perf_counter() - start
+        result = {"stage": stage, "seconds": seconds}
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            result["peak_bytes"] = peak - before
+        results.append(result)
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict):
+    def key(r):
+        return r["contract"], r["size"], r["stage"]
+
+    old = {key(r): r for r in baseline["results"]}
+    print(
+        f"{'contract':<16}{'size':>9} {'stage':<18}{'old s':>10}{'new s':>10}{'ratio':>8}"
+    )
+    for r in report["results"]:
+        o = old.get(key(r))
+        if o is None:
+            continue
+        ratio = r["seconds"] / o["seconds"] if o["seconds"] else float("inf")
+        print(
+            f"{r['contract']:<16}{r['size']:>9} {r['stage']:<18}"
+            f"{o['seconds']:>10.3f}{r['seconds']:>10.3f}{ratio:>8.2f}"
+        )
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        "Benchmarks the stages of the querier pipeline on synthetic registries"
+    )
+    argparser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    argparser.add_argument(
+        "--contracts", nargs="+", help="Contracts to benchmark, defaults to all"
+    )
+    argparser.add_argument(
+        "--malformed", type=float, default=0.05, help="Share of malformed datums"
+    )
+    argparser.add_argument(
+        "--without-token",
+        type=float,
+        default=0.01,
+        help="Share of outputs without the registration token",
+    )
+    argparser.add_argument(
+        "--max-metadata-keys",
+        type=int,
+        default=12,
+        help="Maximum number of additional metadata entries per registration",
+    )
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Skip the second pass that records the memory peak of each stage",
+    )
+    argparser.add_argument("--output", type=Path, default=Path("querier_pipeline.json"))
+    argparser.add_argument(
+        "--compare", type=Path, help="Report of a previous run to compare against"
+    )
+    args = argparser.parse_args()
+
+    report = {
+        "benchmark": "querier_pipeline",
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "parameters": {
+            "malformed": args.malformed,
+            "without_token": args.without_token,
+            "max_metadata_keys": args.max_metadata_keys,
+            "seed": args.seed,
+        },
+        "results": [],
+    }
+    contracts = [
+        c
+        for c in watched_contracts()
+        if args.contracts is None or c.name in args.contracts
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        for contract in contracts:
+            for size in args.sizes:
+                utxos = synthetic_utxos(
+                    contract,
+                    size,
+                    random.Random(args.seed),
+                    args.malformed,
+                    args.without_token,
+                    args.max_metadata_keys,
+                )
+                stages = pipeline_stages(contract, utxos, Path(directory))
+                results = run_stages(stages, trace_memory=False)
+                if not args.no_memory:
+                    tracemalloc.start()
+                    for result, traced in zip(
+                        results, run_stages(stages, trace_memory=True)
+                    ):
+                        result["peak_bytes"] = traced["peak_bytes"]
+                    tracemalloc.stop()
+                for result in results:
+                    result.update(contract=contract.name, size=size)
+                    print(
+                        f"{contract.name:<16}{size:>9} {result['stage']:<18}"
+                        f"{result['seconds']:>10.3f}s"
+                        + (
+                            f"{result['peak_bytes'] / 2**20:>10.1f} MiB"
+                            if "peak_bytes" in result
+                            else ""
+                        )
+                    )
+                report["results"].extend(results)
+
+    with args.output.open("w") as fp:
+        json.dump(report, fp, indent=2)
+    print(f"Wrote report to {args.output}")
+    if args.compare is not None:
+        with args.compare.open() as fp:
+            compare(report, json.load(fp))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import json
+from typing import Iterable, List
 
+import cbor2
 import opshin.util
 import uplc.ast
 from pycardano import RawCBOR, Datum, PlutusData
@@ -42,3 +44,89 @@ def cip68_to_json(d: CIP68Datum) -> dict:
         "version": d.version,
         "extra": uplc.ast.data_from_cbortag(d.extra.data).to_json(),
     }
+
+
+# Direct decoding of CIP-68 datums from their cbor representation.
+# The common shape (a map with utf8 keys and values built from integers, bytes, lists and maps,
+# an integer version and Nothing as extra) is converted in a single pass over the decoded cbor.
+# Anything else is handed to the functions above, so the output is always identical to
+# cip68_to_json(CIP68Datum.from_cbor(...)), including the errors raised.
+
+# json representation of Nothing (constructor 6 without fields) as produced by uplc
+NOTHING_JSON = {"constructor": 6, "fields": []}
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _data_to_json(o):
+    # mirrors PlutusData.to_json, including the order of the keys of map entries
+    t = type(o)
+    if t is int:
+        return {"int": o}
+    if t is bytes:
+        return {"bytes": o.hex()}
+    if t is list:
+        return {"list": [_data_to_json(item) for item in o]}
+    if t is dict:
+        return {
+            "map": [
+                {"v": _data_to_json(v), "k": _data_to_json(k)} for k, v in o.items()
+            ]
+        }
+    raise _Unsupported()
+
+
+def _primitive_to_json(primitive) -> dict:
+    if (
+        type(primitive) is not cbor2.CBORTag
+        or primitive.tag != 121
+        or type(primitive.value) is not list
+        or len(primitive.value) != 3
+    ):
+        raise _Unsupported()
+    metadata, version, extra = primitive.value
+    if (
+        type(metadata) is not dict
+        or type(version) is not int
+        or type(extra) is not cbor2.CBORTag
+        or extra.tag != 127
+        or extra.value != []
+    ):
+        raise _Unsupported()
+    metadata_json = {}
+    for k, v in metadata.items():
+        if type(k) is not bytes:
+            raise _Unsupported()
+        metadata_json[k] = _data_to_json(v)
+    try:
+        metadata_json = {k.decode("utf8"): v for k, v in metadata_json.items()}
+    except UnicodeDecodeError:
+        raise _Unsupported()
+    return {"metadata": metadata_json, "version": version, "extra": NOTHING_JSON}
+
+
+def cip68_primitive_to_json(primitive: cbor2.CBORTag) -> dict:
+    """
+    Converts a CIP-68 datum given as decoded cbor (e.g. by cbor2.loads) like cip68_to_json
+    """
+    try:
+        return _primitive_to_json(primitive)
+    except _Unsupported:
+        return cip68_to_json(CIP68Datum.from_primitive(primitive))
+
+
+def cip68_cbor_to_json(datum: bytes) -> dict:
+    """
+    Converts the cbor encoding of a CIP-68 datum like cip68_to_json
+    """
+    return cip68_primitive_to_json(cbor2.loads(datum))
+
+
+def cip68_cbors_to_json(datums: Iterable[bytes]) -> List[dict]:
+    """
+    Converts the cbor encodings of many CIP-68 datums like cip68_to_json
+    """
+    loads, to_json = cbor2.loads, cip68_primitive_to_json
+    return [to_json(loads(datum)) for datum in datums]
@@ -0,0 +1,84 @@
+from onchain_token_verification.contracts.cip68 import *
+from onchain_token_verification.contracts.util import *
+
+
+@dataclass()
+class Registration(PlutusData):
+    subject: Token
+    signer: PubKeyHash
+    metadata: Union[CIP68Datum, Nothing]
+
+
+# Variant of token_trust where the redeemer indicates the outputs that go to the contract.
+# Only these outputs are checked for their datum, all other outputs only need to hold none of the tokens.
+@dataclass()
+class OwnOutputs(PlutusData):
+    # indices of the outputs to the contract in ascending order
+    CONSTR_ID = 1
+    indices: List[int]
+
+
+TOKENNAME = b"trusted"
+
+
+def own_tokens(utxo: TxOut, own_addr: Address, pid: PolicyId, tx_info: TxInfo) -> int:
+    assert utxo.address == own_addr, "Indicated output does not go to the contract"
+    tx_out_attached = utxo.datum
+    if isinstance(tx_out_attached, SomeOutputDatumHash):
+        out_datum: Registration = tx_info.data.get(
+            tx_out_attached.datum_hash, Nothing()
+        )
+    elif isinstance(tx_out_attached, SomeOutputDatum):
+        out_datum: Registration = tx_out_attached.datum
+    else:
+        assert False, "Outputs to contract address need a datum"
+    assert (out_datum.signer in tx_info.signatories) or (
+        out_datum.signer in tx_info.mint.keys()
+    ), "Designated signer is not present in signatories or minting scripts"
+    return utxo.value.get(pid, {b"": 0}).get(TOKENNAME, 0)
+
+
+def validator(datum: Registration, r: OwnOutputs, ctx: ScriptContext) -> None:
+    purpose = ctx.purpose
+    if isinstance(purpose, Minting):
+        pid = purpose.policy_id
+        minted = ctx.tx_info.mint[pid].get(TOKENNAME, 0)
+        # burned tokens are spent from the contract, which checks all outputs when spending.
+        # the ledger balances the outputs with the inputs and the minted tokens,
+        # so the indicated outputs hold all tokens iff they hold those of both
+        if minted > 0:
+            own_addr = own_address(pid)
+            assert sum(
+                [
+                    own_tokens(ctx.tx_info.outputs[i], own_addr, pid, ctx.tx_info)
+                    for i in r.indices
+                ]
+            ) == minted + sum(
+                [
+                    txi.resolved.value.get(pid, {b"": 0}).get(TOKENNAME, 0)
+                    for txi in ctx.tx_info.inputs
+                ]
+            ), "Sending tokens to wrong address"
+    elif isinstance(purpose, Spending):
+        assert (
+            datum.signer in ctx.tx_info.signatories
+        ), "Designated signer is not present in signatories"
+        own_addr = resolve_spent_utxo(ctx.tx_info.inputs, purpose).address
+        pid = policy_id_from_address(own_addr)
+        # all tokens in the outputs are in the indicated outputs
+        assert sum(
+            [
+                own_tokens(ctx.tx_info.outputs[i], own_addr, pid, ctx.tx_info)
+                for i in r.indices
+            ]
+        ) == sum(
+            [o.value.get(pid, {b"": 0}).get(TOKENNAME, 0) for o in ctx.tx_info.outputs]
+        ), "Sending tokens to wrong address"
+    else:
+        assert False, "Wrong purpose"
+    # ascending indices ensure that no output is counted twice
+    # (checked last, the loop slows down every later variable lookup)
+    previous = -1
+    for i in r.indices:
+        assert previous < i, "Indices of outputs to the contract must be ascending"
+        previous = i
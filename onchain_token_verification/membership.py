@@ -0,0 +1,109 @@
+"""
+Compact membership artifact of the subjects registered at a contract.
+
+Clients that only need to know whether a subject is registered can download this artifact
+instead of the full json list and check membership locally. Only the standard library is
+used, so this module can be copied into client code as is.
+
+Format (all integers big endian):
+
+    offset  size   content
+    0       4      magic b"OTVM"
+    4       1      format version, currently 1
+    5       1      width w of the hashes in bytes (1-32)
+    6       2      reserved, 0
+    8       8      number n of hashes
+    16      n * w  hashes of the subjects, sorted ascending, without duplicates
+
+The hash of a subject is the blake2b digest of size w of its binary representation:
+the policy id followed by the token name for tokens, the pubkeyhash for authorities.
+As hashes are truncated, membership checks have a false positive rate of about n / 2^(8w).
+"""
+import hashlib
+import mmap
+import struct
+from pathlib import Path
+from typing import BinaryIO, Iterable, Union
+
+MAGIC = b"OTVM"
+VERSION = 1
+HEADER = struct.Struct(">4sBBHQ")
+# 8 byte hashes have a false positive rate below 1e-12 for a million subjects
+DEFAULT_WIDTH = 8
+
+
+def subject_hash(subject: bytes, width: int = DEFAULT_WIDTH) -> bytes:
+    return hashlib.blake2b(subject, digest_size=width).digest()
+
+
+def token_subject(policy_id: str, token_name: str) -> bytes:
+    """
+    Binary representation of a token given by hex encoded policy id and token name
+    """
+    return bytes.fromhex(policy_id) + bytes.fromhex(token_name)
+
+
+def write_membership(
+    fp: BinaryIO, subjects: Iterable[bytes], width: int = DEFAULT_WIDTH
+) -> int:
+    """
+    Writes the membership artifact of the given subjects (binary representations)
+    to the file-like object, returns the number of hashes written
+    """
+    hashes = sorted({subject_hash(subject, width) for subject in subjects})
+    fp.write(HEADER.pack(MAGIC, VERSION, width, 0, len(hashes)))
+    fp.write(b"".join(hashes))
+    return len(hashes)
+
+
+class Membership:
+    """
+    Memory-maps a membership artifact and checks membership by binary search over the hashes
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        with open(path, "rb") as fp:
+            header = fp.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError(f"{path} is not a membership artifact, too short")
+            magic, version, width, _, count = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a membership artifact")
+            if version != VERSION:
+                raise ValueError(f"Unsupported membership artifact version {version}")
+            if fp.seek(0, 2) != HEADER.size + count * width:
+                raise ValueError(f"{path} is truncated")
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, subject: bytes) -> bool:
+        h = subject_hash(subject, self.width)
+        m, w = self._map, self.width
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = HEADER.size + mid * w
+            candidate = m[start : start + w]
+            if candidate < h:
+                lo = mid + 1
+            elif candidate > h:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def contains_token(self, policy_id: str, token_name: str) -> bool:
+        return token_subject(policy_id, token_name) in self
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,133 @@
+"""
+Binary snapshot of the registrations of a contract, for point lookups by the REST server.
+
+The snapshot is memory-mapped, so all worker processes of the server share one copy of it
+in the page cache. Records hold the json responses of the lookup endpoints, which are served
+without parsing.
+
+Format (all integers big endian):
+
+    records    per record: key length (2 bytes), key (utf8), json length (4 bytes), json
+    indexes    per index (subject key, signer, utxo ref), entries of
+               8 byte blake2b hash of the key and offset of the record (8 bytes),
+               sorted by hash
+    footer     magic b"OTVS", format version (1 byte), 3 reserved bytes,
+               then offset and number of entries (8 bytes each) of each index
+
+The footer is at the end, so the snapshot can be written in a single pass.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Optional
+
+MAGIC = b"OTVS"
+VERSION = 1
+INDEXES = ["subject", "signer", "utxo"]
+FOOTER = struct.Struct(">4sB3x" + "QQ" * len(INDEXES))
+ENTRY = struct.Struct(">8sQ")
+KEY_LENGTH = struct.Struct(">H")
+JSON_LENGTH = struct.Struct(">I")
+
+
+def key_hash(key: str) -> bytes:
+    return hashlib.blake2b(key.encode("utf8"), digest_size=8).digest()
+
+
+class _Generation:
+    """
+    One memory-mapped snapshot file
+    """
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as fp:
+            stat = os.fstat(fp.fileno())
+            self.version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < FOOTER.size:
+            raise ValueError(f"{path} is not a binary snapshot, too short")
+        magic, version, *footer = FOOTER.unpack_from(
+            self.map, len(self.map) - FOOTER.size
+        )
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a binary snapshot")
+        if version != VERSION:
+            raise ValueError(f"Unsupported binary snapshot version {version}")
+        # index name -> (offset, number of entries)
+        self.indexes = {
+            index: (footer[2 * i], footer[2 * i + 1]) for i, index in enumerate(INDEXES)
+        }
+
+    def lookup(self, index: str, key: str) -> Optional[bytes]:
+        start, count = self.indexes[index]
+        h = key_hash(key)
+        m = self.map
+        # leftmost entry with the hash, keys with colliding hashes are adjacent
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = start + mid * ENTRY.size
+            if m[entry : entry + 8] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        key_bytes = key.encode("utf8")
+        for i in range(lo, count):
+            entry_hash, offset = ENTRY.unpack_from(m, start + i * ENTRY.size)
+            if entry_hash != h:
+                break
+            (key_length,) = KEY_LENGTH.unpack_from(m, offset)
+            offset += KEY_LENGTH.size
+            if m[offset : offset + key_length] != key_bytes:
+                continue
+            offset += key_length
+            (json_length,) = JSON_LENGTH.unpack_from(m, offset)
+            offset += JSON_LENGTH.size
+            return m[offset : offset + json_length]
+        return None
+
+
+class BinarySnapshot:
+    """
+    Looks up registrations of a contract in its binary snapshot, answering with the json
+    of the response. The snapshot is re-mapped whenever the querier replaced it.
+    Mappings of replaced snapshots are released once no lookup uses them anymore.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._generation: Optional[_Generation] = None
+
+    def generation(self) -> Optional[_Generation]:
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        # the querier atomically replaces the file, so a new snapshot has a new inode
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        generation = self._generation
+        if generation is not None and generation.version == version:
+            return generation
+        with self._lock:
+            if self._generation is None or self._generation.version != version:
+                self._generation = _Generation(self._path)
+            return self._generation
+
+    def _lookup(self, index: str, key: str) -> Optional[bytes]:
+        generation = self.generation()
+        if generation is None:
+            return None
+        return generation.lookup(index, key)
+
+    def by_subject(self, key: str) -> Optional[bytes]:
+        return self._lookup("subject", key)
+
+    def by_signer(self, signer: str) -> Optional[bytes]:
+        return self._lookup("signer", signer)
+
+    def by_utxo(self, ref: str) -> Optional[bytes]:
+        return self._lookup("utxo", ref)
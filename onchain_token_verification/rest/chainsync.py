@@ -0,0 +1,410 @@
+"""
+Incremental indexing of the registration contracts through the Ogmios chain-sync protocol.
+
+Instead of re-fetching all UTxOs at the contract addresses, the indexer follows the chain
+block by block and applies the created and spent registration UTxOs to the registries.
+Changes of the most recent blocks are kept so that rollbacks can be undone.
+"""
+import json
+import logging
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+import websocket
+
+from onchain_token_verification.rest.history import RegistryHistory
+from onchain_token_verification.rest.metrics import Counter
+from onchain_token_verification.rest.registrations import (
+    decode_registration,
+    utxo_ref,
+)
+from onchain_token_verification.rest.store import ADDED, REMOVED
+
+_LOGGER = logging.getLogger(__name__)
+
+# Ogmios represents the genesis of the chain by the string "origin"
+ORIGIN = "origin"
+# number of blocks after which a block is considered immutable on cardano
+SECURITY_PARAMETER = 2160
+
+Point = Union[str, dict]
+
+
+class OgmiosChainSync:
+    """
+    Client for the chain-sync mini-protocol of Ogmios (v5, JSON-WSP)
+    """
+
+    def __init__(self, ws_url: str, record_to: Optional[Path] = None):
+        self._ws = websocket.create_connection(ws_url)
+        # optionally record all results of RequestNext so they can be replayed later
+        self._record_to = record_to
+
+    def _request(self, methodname: str, args: Optional[dict] = None) -> dict:
+        self._ws.send(
+            json.dumps(
+                {
+                    "type": "jsonwsp/request",
+                    "version": "1.0",
+                    "servicename": "ogmios",
+                    "methodname": methodname,
+                    "args": args or {},
+                },
+                separators=(",", ":"),
+            )
+        )
+        response = json.loads(self._ws.recv())
+        if "result" not in response:
+            raise ConnectionError(f"Ogmios ran into an error. Response: {response}")
+        return response["result"]
+
+    def find_intersect(self, points: List[Point]) -> dict:
+        return self._request("FindIntersect", {"points": points})
+
+    def request_next(self) -> dict:
+        result = self._request("RequestNext")
+        if self._record_to is not None:
+            with self._record_to.open("a") as fp:
+                fp.write(json.dumps(result, separators=(",", ":")) + "\n")
+        return result
+
+    def close(self):
+        self._ws.close()
+
+
+class ReplayChainSync:
+    """
+    Stand-in for OgmiosChainSync that replays recorded results of RequestNext,
+    one JSON document per line (as written by OgmiosChainSync with record_to).
+    Raises EOFError once all recorded messages are consumed.
+    """
+
+    def __init__(self, messages: Union[Path, List[dict]]):
+        if isinstance(messages, Path):
+            with messages.open() as fp:
+                messages = [json.loads(line) for line in fp if line.strip()]
+        self._messages = messages
+        self._position = 0
+
+    def find_intersect(self, points: List[Point]) -> dict:
+        for point in points:
+            if point == ORIGIN:
+                self._position = 0
+                return {"IntersectionFound": {"point": ORIGIN, "tip": ORIGIN}}
+            for i, message in enumerate(self._messages):
+                if (
+                    "RollForward" in message
+                    and block_point(message["RollForward"]["block"]) == point
+                ):
+                    self._position = i + 1
+                    return {"IntersectionFound": {"point": point, "tip": ORIGIN}}
+        return {"IntersectionNotFound": {"tip": ORIGIN}}
+
+    def request_next(self) -> dict:
+        if self._position >= len(self._messages):
+            raise EOFError("All recorded chain-sync messages were replayed")
+        message = self._messages[self._position]
+        self._position += 1
+        return message
+
+    def close(self):
+        pass
+
+
+def block_point(block: dict) -> dict:
+    # blocks are wrapped in an object keyed by their era
+    (content,) = block.values()
+    block_hash = content.get("headerHash", content.get("hash"))
+    return {"slot": content["header"]["slot"], "hash": block_hash}
+
+
+def point_slot(point: Point) -> int:
+    # the origin precedes all slots
+    return -1 if point == ORIGIN else point["slot"]
+
+
+def parse_point(point: str) -> Point:
+    """
+    The point given as <slot>.<block hash> or "origin"
+    """
+    if point == ORIGIN:
+        return ORIGIN
+    slot, block_hash = point.split(".")
+    return {"slot": int(slot), "hash": block_hash}
+
+
+def block_transactions(block: dict) -> List[dict]:
+    (content,) = block.values()
+    body = content.get("body", [])
+    # byron blocks have a different structure and can not contain registrations
+    return body if isinstance(body, list) else []
+
+
+def transaction_changes(tx: dict) -> Tuple[List[dict], List[Tuple[int, dict]]]:
+    """
+    The inputs spent and the outputs (with their index) created by the transaction
+    """
+    body = tx["body"]
+    # transactions that failed phase-2 validation only consume their collateral
+    if tx.get("inputSource", "inputs") == "inputs":
+        return body["inputs"], list(enumerate(body["outputs"]))
+    if body.get("collateralReturn") is not None:
+        return body.get("collaterals", []), [
+            (len(body["outputs"]), body["collateralReturn"])
+        ]
+    return body.get("collaterals", []), []
+
+
+class ChainIndexer:
+    """
+    Base of the indexes that follow the chain by applying roll forward and roll backward
+    messages of the chain-sync protocol. Subclasses apply the transactions of a block in
+    apply_block and return the operations that undo its changes. These are kept for the
+    most recent blocks and passed to undo in reverse order when the blocks are rolled back.
+    """
+
+    def __init__(self, max_rollback: int = SECURITY_PARAMETER):
+        self.point: Point = ORIGIN
+        # per block, the point and the operations needed to undo its changes
+        self._history = deque(maxlen=max_rollback)
+
+    def apply_block(self, point: dict, block: dict) -> list:
+        raise NotImplementedError
+
+    def undo(self, operation: tuple):
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Removes everything indexed, when rolling back to the origin
+        """
+        raise NotImplementedError
+
+    def resume(self, point: Point, restored: bool):
+        """
+        Called before following the chain from the point,
+        which is restored from a checkpoint or the start point
+        """
+
+    def intersection_points(self) -> List[Point]:
+        """
+        Points to resume from, most recent first
+        """
+        points = [block["point"] for block in reversed(self._history)]
+        points.append(self._history[0]["previous"] if self._history else self.point)
+        return points
+
+    def roll_forward(self, block: dict):
+        point = block_point(block)
+        undo = self.apply_block(point, block)
+        previous, self.point = self.point, point
+        self._history.append({"point": self.point, "previous": previous, "undo": undo})
+
+    def roll_backward(self, point: Point):
+        if point == ORIGIN:
+            self.clear()
+            self._history.clear()
+            self.point = ORIGIN
+            return
+        while self._history and self._history[-1]["point"]["slot"] > point["slot"]:
+            block = self._history.pop()
+            for operation in reversed(block["undo"]):
+                self.undo(operation)
+            self.point = block["previous"]
+        if self.point != point:
+            raise RuntimeError(
+                f"Can not roll back to {point}, the changes are not known anymore. "
+                f"Remove the checkpoint to re-index from scratch."
+            )
+
+    def checkpoint(self) -> dict:
+        return {"point": self.point, "history": list(self._history)}
+
+    def restore(self, checkpoint: dict):
+        self.point = checkpoint["point"]
+        self._history.clear()
+        self._history.extend(
+            {**block, "undo": [tuple(op) for op in block["undo"]]}
+            for block in checkpoint["history"]
+        )
+
+
+def follow(
+    chain_sync,
+    indexer: ChainIndexer,
+    checkpoint_path: Path,
+    flush: Callable[[bool], None],
+    start: Point = ORIGIN,
+    flush_every: int = 1000,
+    messages: Optional[Counter] = None,
+):
+    """
+    Applies the blocks of the chain to the indexer (or an object wrapping one with the same
+    methods), starting from the checkpoint if it exists or the given start point.
+    Calls flush, with whether the tip of the chain is reached, at the tip and regularly while
+    catching up. flush is expected to write the checkpoint, after everything else.
+    Optionally counts the applied messages by message (roll_forward, roll_backward).
+    """
+    restored = checkpoint_path.exists()
+    if restored:
+        with checkpoint_path.open() as fp:
+            indexer.restore(json.load(fp))
+        points = indexer.intersection_points()
+    else:
+        points = [start]
+    indexer.resume(indexer.point if restored else start, restored)
+    result = chain_sync.find_intersect(points)
+    if "IntersectionFound" not in result:
+        raise RuntimeError(f"Could not find an intersection with the chain: {result}")
+    _LOGGER.info(f"Following the chain from {result['IntersectionFound']['point']}")
+    unflushed = 0
+    try:
+        while True:
+            result = chain_sync.request_next()
+            if "RollForward" in result:
+                indexer.roll_forward(result["RollForward"]["block"])
+                tip = result["RollForward"]["tip"]
+                message = "roll_forward"
+            else:
+                indexer.roll_backward(result["RollBackward"]["point"])
+                tip = result["RollBackward"]["tip"]
+                message = "roll_backward"
+            if messages is not None:
+                messages.inc(message=message)
+            unflushed += 1
+            at_tip = tip == ORIGIN or point_slot(indexer.point) >= tip["slot"]
+            if at_tip or unflushed >= flush_every:
+                flush(at_tip)
+                unflushed = 0
+    except EOFError:
+        _LOGGER.info("Reached the end of the chain-sync messages")
+        if unflushed:
+            flush(False)
+    finally:
+        chain_sync.close()
+
+
+@dataclass
+class WatchedContract:
+    name: str
+    # bech32 encoded contract address
+    address: str
+    # asset id of the registration token as used by Ogmios (<policy id>.<token name hex>)
+    asset: str
+    registration_class: type
+
+
+def registration_datum(
+    ref: str, output: dict, contract: WatchedContract
+) -> Optional[bytes]:
+    """
+    Returns the datum of the output (in the Ogmios json format) if it is a validly
+    formatted registration at the contract and None otherwise
+    """
+    if output["address"] != contract.address:
+        return None
+    # validate that the output has the valid format
+    if output["value"].get("assets", {}).get(contract.asset, 0) != 1:
+        _LOGGER.debug(f"UTxO {ref} does not contain the required token")
+        return None
+    datum = output.get("datum")
+    if datum is None or datum == output.get("datumHash"):
+        _LOGGER.debug(f"UTxO {ref} does not contain the required datum")
+        return None
+    return bytes.fromhex(datum)
+
+
+class RegistryIndexer(ChainIndexer):
+    """
+    Maintains the registries (utxo ref -> registration) of a set of contracts.
+    If a registry history is given, all added and removed registrations are logged to it.
+    """
+
+    def __init__(
+        self,
+        contracts: List[WatchedContract],
+        max_rollback: int = SECURITY_PARAMETER,
+        registry_history: Optional[RegistryHistory] = None,
+    ):
+        super().__init__(max_rollback)
+        self.contracts = contracts
+        self.registry_history = registry_history
+        self.registries: Dict[str, Dict[str, list]] = {c.name: {} for c in contracts}
+        # names of the contracts whose registry changed since the last call of pop_changed
+        self._changed: Set[str] = set()
+
+    def apply_block(self, point: dict, block: dict) -> list:
+        undo = []
+        # contract name -> events of the block for the history
+        events: Dict[str, list] = {}
+        for tx in block_transactions(block):
+            spent, created = transaction_changes(tx)
+            for tx_in in spent:
+                ref = utxo_ref(tx_in["txId"], tx_in["index"])
+                for name, registry in self.registries.items():
+                    if ref in registry:
+                        entry = registry.pop(ref)
+                        undo.append((name, ref, entry))
+                        events.setdefault(name, []).append(
+                            (point["slot"], tx["id"], REMOVED, ref, *entry)
+                        )
+                        self._changed.add(name)
+            for index, output in created:
+                ref = utxo_ref(tx["id"], index)
+                for contract in self.contracts:
+                    datum = registration_datum(ref, output, contract)
+                    if datum is None:
+                        continue
+                    entry = decode_registration(ref, datum, contract.registration_class)
+                    if entry is None:
+                        continue
+                    self.registries[contract.name][ref] = list(entry)
+                    undo.append((contract.name, ref, None))
+                    events.setdefault(contract.name, []).append(
+                        (point["slot"], tx["id"], ADDED, ref, *entry)
+                    )
+                    self._changed.add(contract.name)
+        if self.registry_history is not None:
+            self.registry_history.append(point["slot"], events, self.registries)
+        return undo
+
+    def undo(self, operation: tuple):
+        name, ref, previous = operation
+        if previous is None:
+            del self.registries[name][ref]
+        else:
+            self.registries[name][ref] = previous
+        self._changed.add(name)
+
+    def clear(self):
+        for registry in self.registries.values():
+            registry.clear()
+        self._changed.update(self.registries)
+
+    def resume(self, point: Point, restored: bool):
+        if self.registry_history is None:
+            return
+        if not restored:
+            # indexing from scratch, the history starts over as well
+            self.registry_history.roll_back(-1)
+        self.registry_history.resume(point_slot(point), self.registries)
+
+    def roll_backward(self, point: Point):
+        if self.registry_history is not None:
+            self.registry_history.roll_back(point_slot(point))
+        super().roll_backward(point)
+
+    def pop_changed(self) -> Set[str]:
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def checkpoint(self) -> dict:
+        return {**super().checkpoint(), "registries": self.registries}
+
+    def restore(self, checkpoint: dict):
+        super().restore(checkpoint)
+        for name in self.registries:
+            self.registries[name] = checkpoint["registries"].get(name, {})
+        self._changed.update(self.registries)
@@ -0,0 +1,236 @@
+"""
+History of the registries: an append-only log of all added and removed registrations
+per contract, with periodic full snapshots, to answer which registrations existed at a given slot.
+
+The log of each contract is a file with one json array per event,
+[slot, transaction id, change, utxo ref, subject, signature], where the transaction id is
+the one creating the UTxO for added and the one spending it for removed registrations.
+Every snapshot_every events, the full registry is written to a snapshot named after the slot
+of the last applied block and the length of the log at that point.
+The state at a slot is restored from the latest snapshot at or before the slot by replaying
+only the events logged after it, so the cost does not grow with the length of the history.
+Events of rolled back blocks are cut off the end of the log.
+If the history is started on a registry that is already populated, it begins with a snapshot
+of the registry at log offset 0 and states before its slot are not known.
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from onchain_token_verification.rest.registrations import RegistrationEntry
+from onchain_token_verification.rest.snapshot import atomic_dump, encode_json
+from onchain_token_verification.rest.store import ADDED
+
+_LOGGER = logging.getLogger(__name__)
+
+# number of events after which a new snapshot is written
+SNAPSHOT_EVERY = 10_000
+
+# slot, transaction id, change, utxo ref, subject, signature
+Event = Tuple[int, str, str, str, str, dict]
+
+
+class EventLog:
+    """
+    Event log and snapshots of the registry of a single contract, stored in their own directory.
+    Only one process may write to the log, any number of processes may read it.
+    """
+
+    def __init__(self, directory: Path, snapshot_every: int = SNAPSHOT_EVERY):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.log_path = directory / "events.log"
+        # number of events appended since the latest snapshot,
+        # only known to the writer (see resume)
+        self._unsnapshotted = 0
+
+    def snapshots(self) -> List[Tuple[int, int]]:
+        """
+        Slot and log offset of all snapshots, ordered by slot
+        """
+        snapshots = []
+        for p in self.directory.glob("snapshot-*-*.json"):
+            _, slot, offset = p.stem.split("-")
+            snapshots.append((int(slot), int(offset)))
+        return sorted(snapshots)
+
+    def _snapshot_path(self, slot: int, offset: int) -> Path:
+        return self.directory / f"snapshot-{slot}-{offset}.json"
+
+    def _latest_snapshot(self, slot: Optional[int]) -> Tuple[int, int]:
+        """
+        Slot and offset of the latest snapshot at or before the slot (any slot if None),
+        (-1, 0) if there is none, i.e. the state before the first event
+        """
+        latest = (-1, 0)
+        for snapshot in self.snapshots():
+            if slot is not None and snapshot[0] > slot:
+                break
+            latest = snapshot
+        return latest
+
+    def _events(self, offset: int) -> Iterator[Tuple[int, Event]]:
+        """
+        The events after the given offset, each with the offset at which it ends,
+        skipping an incomplete last line (which is being written)
+        """
+        try:
+            f = self.log_path.open("rb")
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                yield offset, tuple(json.loads(line))
+
+    def recorded(self) -> bool:
+        """
+        Whether the history is recorded, which the querier only does when following the chain
+        """
+        return self.directory.is_dir()
+
+    def first_slot(self) -> int:
+        """
+        The first slot whose state is known, -1 if the history starts at the origin
+        """
+        snapshots = self.snapshots()
+        if snapshots and snapshots[0][1] == 0:
+            return snapshots[0][0]
+        return -1
+
+    def state_at(self, slot: int) -> Optional[Dict[str, RegistrationEntry]]:
+        """
+        The registrations (utxo ref -> (subject, signature)) at the end of the given slot,
+        None if the history starts after the slot
+        """
+        if slot < self.first_slot():
+            return None
+        # the snapshot may be removed by a rollback while reading it, in which case
+        # the events after it are gone as well and an earlier snapshot is used
+        for _ in range(3):
+            snapshot_slot, offset = self._latest_snapshot(slot)
+            if snapshot_slot < 0:
+                registrations = {}
+                break
+            try:
+                with self._snapshot_path(snapshot_slot, offset).open("rb") as f:
+                    registrations = {
+                        ref: tuple(entry) for ref, entry in json.load(f).items()
+                    }
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            raise RuntimeError("The history changed repeatedly while reading it")
+        for _, (event_slot, _, change, ref, subject, signature) in self._events(offset):
+            if event_slot > slot:
+                break
+            if change == ADDED:
+                registrations[ref] = (subject, signature)
+            else:
+                registrations.pop(ref, None)
+        return registrations
+
+    def resume(self, slot: int, registrations: Dict[str, list]):
+        """
+        Prepares appending the events after the given slot (-1 for the origin),
+        given the registrations at that slot
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # events after the slot are applied again
+        self.roll_back(slot)
+        empty = not self.log_path.exists() or self.log_path.stat().st_size == 0
+        if slot >= 0 and empty and not self.snapshots():
+            _LOGGER.info(f"Starting the history of {self.directory} at slot {slot}")
+            atomic_dump(encode_json(registrations), self._snapshot_path(slot, 0))
+        self._count_unsnapshotted()
+
+    def _count_unsnapshotted(self):
+        _, offset = self._latest_snapshot(None)
+        self._unsnapshotted = sum(1 for _ in self._events(offset))
+
+    def append(
+        self,
+        slot: int,
+        events: Iterable[Event],
+        registrations: Dict[str, list],
+    ):
+        """
+        Appends the events of a block and writes a snapshot of the registrations
+        (the state after the block) if due
+        """
+        events = list(events)
+        if not events:
+            return
+        with self.log_path.open("ab") as f:
+            f.write(b"".join(encode_json(event) + b"\n" for event in events))
+            f.flush()
+            os.fsync(f.fileno())
+            offset = f.tell()
+        self._unsnapshotted += len(events)
+        if self._unsnapshotted >= self.snapshot_every:
+            atomic_dump(encode_json(registrations), self._snapshot_path(slot, offset))
+            self._unsnapshotted = 0
+
+    def roll_back(self, slot: int):
+        """
+        Removes all events and snapshots after the given slot, -1 removes everything
+        """
+        for snapshot_slot, offset in self.snapshots():
+            if snapshot_slot > slot:
+                self._snapshot_path(snapshot_slot, offset).unlink()
+        _, end = self._latest_snapshot(slot)
+        for offset, event in self._events(end):
+            if event[0] > slot:
+                break
+            end = offset
+        if self.log_path.exists():
+            # also cuts off an incomplete last line
+            os.truncate(self.log_path, end)
+        self._count_unsnapshotted()
+
+
+class RegistryHistory:
+    """
+    Event logs of a set of contracts, in one subdirectory per contract
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        contract_names: Iterable[str],
+        snapshot_every: int = SNAPSHOT_EVERY,
+    ):
+        self.logs = {
+            name: EventLog(directory / name, snapshot_every) for name in contract_names
+        }
+
+    def resume(self, slot: int, registries: Dict[str, Dict[str, list]]):
+        for name, log in self.logs.items():
+            log.resume(slot, registries[name])
+
+    def append(
+        self,
+        slot: int,
+        events: Dict[str, List[Event]],
+        registries: Dict[str, Dict[str, list]],
+    ):
+        for name, contract_events in events.items():
+            self.logs[name].append(slot, contract_events, registries[name])
+
+    def roll_back(self, slot: int):
+        for log in self.logs.values():
+            log.roll_back(slot)
+
+    def recorded(self, contract_name: str) -> bool:
+        return self.logs[contract_name].recorded()
+
+    def state_at(
+        self, contract_name: str, slot: int
+    ) -> Optional[Dict[str, RegistrationEntry]]:
+        return self.logs[contract_name].state_at(slot)
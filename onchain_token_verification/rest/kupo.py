@@ -0,0 +1,127 @@
+"""
+Fetch backend that reads the registration UTxOs from the index of Kupo
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+from onchain_token_verification.rest.registrations import utxo_ref
+
+_LOGGER = logging.getLogger(__name__)
+
+# Kupo reports the slot up to which it indexed the chain in this header
+CHECKPOINT_HEADER = "X-Most-Recent-Checkpoint"
+
+
+class KupoBackend:
+    """
+    Matches the contract address, filtered server-side by the policy id and asset name of
+    the registration token, so only outputs holding it are returned (Kupo needs to index the
+    contract address, e.g. with --match <address>). After the first cycle, only matches created or
+    spent after the last seen checkpoint are requested. Every resync_every cycles, all unspent
+    matches are fetched again to drop matches that vanished through rollbacks.
+    UTxOs are returned in the json format of Ogmios.
+    """
+
+    def __init__(self, kupo_url: str, resync_every: int = 100):
+        self._url = kupo_url.rstrip("/")
+        self._resync_every = resync_every
+        # contract name -> utxo ref -> (transaction input, output)
+        self._utxos: Dict[str, Dict[str, Tuple[dict, dict]]] = {}
+        # contract name -> slot of the last seen checkpoint
+        self._slots: Dict[str, Optional[int]] = {}
+        self._cycles: Dict[str, int] = {}
+        # the worker of a timed out cycle keeps running until its request fails,
+        # only the worker of the latest cycle of a contract may update the state
+        self._lock = threading.Lock()
+        self._generations: Dict[str, int] = {}
+
+    async def utxos(self, contract, timeout: float) -> List[Tuple[dict, dict]]:
+        with self._lock:
+            generation = self._generations.get(contract.name, 0) + 1
+            self._generations[contract.name] = generation
+        deadline = time.monotonic() + timeout
+        return await asyncio.wait_for(
+            asyncio.to_thread(self._fetch, contract, generation, deadline), timeout
+        )
+
+    def close(self):
+        pass
+
+    def _get(self, path: str, params: List[str], deadline: float):
+        url = f"{self._url}{path}"
+        if params:
+            url += "?" + "&".join(params)
+        # bounds the whole cycle, not only each read of the socket
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            raise TimeoutError(f"Deadline of the request to {url} passed")
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            checkpoint = response.headers.get(CHECKPOINT_HEADER)
+            return json.load(response), (
+                int(checkpoint) if checkpoint is not None else None
+            )
+
+    def _fetch(
+        self, contract, generation: int, deadline: float
+    ) -> List[Tuple[dict, dict]]:
+        policy_id, asset_name = contract.asset.split(".")
+        pattern = f"/matches/{contract.address}"
+        token = [f"policy_id={policy_id}", f"asset_name={asset_name}"]
+        with self._lock:
+            utxos = dict(self._utxos.get(contract.name, {}))
+            slot = self._slots.get(contract.name)
+            cycle = self._cycles.get(contract.name, 0)
+        if slot is None or cycle % self._resync_every == 0:
+            matches, checkpoint = self._get(pattern, ["unspent", *token], deadline)
+            known = {}
+            for match in matches:
+                ref = utxo_ref(match["transaction_id"], match["output_index"])
+                known[ref] = utxos.get(ref) or self._to_ogmios(match, deadline)
+            utxos = known
+        else:
+            created, checkpoint = self._get(
+                pattern, ["unspent", *token, f"created_after={slot}"], deadline
+            )
+            spent, _ = self._get(
+                pattern, ["spent", *token, f"spent_after={slot}"], deadline
+            )
+            for match in created:
+                ref = utxo_ref(match["transaction_id"], match["output_index"])
+                if ref not in utxos:
+                    utxos[ref] = self._to_ogmios(match, deadline)
+            for match in spent:
+                utxos.pop(
+                    utxo_ref(match["transaction_id"], match["output_index"]), None
+                )
+            _LOGGER.debug(
+                f"{contract.name}: {len(created)} created and {len(spent)} spent matches after slot {slot}"
+            )
+        with self._lock:
+            if self._generations[contract.name] != generation:
+                raise TimeoutError(
+                    f"Fetching {contract.name} finished after a later cycle started"
+                )
+            self._utxos[contract.name] = utxos
+            # matches after the checkpoint of the first request are requested again in the next cycle
+            self._slots[contract.name] = checkpoint
+            self._cycles[contract.name] = cycle + 1
+        return list(utxos.values())
+
+    def _to_ogmios(self, match: dict, deadline: float) -> Tuple[dict, dict]:
+        datum = None
+        if match.get("datum_type") == "inline":
+            datum, _ = self._get(f"/datums/{match['datum_hash']}", [], deadline)
+        return (
+            {"txId": match["transaction_id"], "index": match["output_index"]},
+            {
+                "address": match["address"],
+                "value": match["value"],
+                "datumHash": match.get("datum_hash"),
+                "datum": datum["datum"] if datum is not None else None,
+            },
+        )
@@ -0,0 +1,146 @@
+"""
+asyncio client for the state queries of Ogmios (v5, JSON-WSP)
+"""
+import asyncio
+import json
+import logging
+import threading
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import websocket
+
+_LOGGER = logging.getLogger(__name__)
+
+# default time in seconds after which a request is abandoned
+DEFAULT_TIMEOUT = 60
+
+
+class AsyncOgmiosClient:
+    """
+    Multiplexes the requests of many asyncio tasks over one long-lived websocket.
+    Requests are pipelined, responses are matched to their requests through the mirror field.
+    A dedicated thread receives the responses, so the event loop never blocks on the socket.
+    The connection is re-established on the next request after it failed or a request timed out.
+    """
+
+    def __init__(self, ws_url: str):
+        self._ws_url = ws_url
+        self._ws: Optional[websocket.WebSocket] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connect_lock = asyncio.Lock()
+        self._send_lock = threading.Lock()
+        # request id -> (websocket the request was sent on, future for the response)
+        self._pending: Dict[str, Tuple[websocket.WebSocket, asyncio.Future]] = {}
+
+    async def _connection(self) -> websocket.WebSocket:
+        async with self._connect_lock:
+            if self._ws is None:
+                self._loop = asyncio.get_running_loop()
+                ws = await self._loop.run_in_executor(
+                    None, websocket.create_connection, self._ws_url
+                )
+                threading.Thread(target=self._receive, args=(ws,), daemon=True).start()
+                self._ws = ws
+            return self._ws
+
+    def _receive(self, ws: websocket.WebSocket):
+        try:
+            while True:
+                response = json.loads(ws.recv())
+                self._loop.call_soon_threadsafe(self._resolve, response)
+        except Exception as e:
+            self._loop.call_soon_threadsafe(self._disconnected, ws, e)
+
+    def _resolve(self, response: dict):
+        request_id = (response.get("reflection") or {}).get("id")
+        _, future = self._pending.pop(request_id, (None, None))
+        # the request may have timed out or been cancelled in the meantime
+        if future is None or future.done():
+            return
+        if "result" in response:
+            future.set_result(response["result"])
+        else:
+            future.set_exception(
+                ConnectionError(f"Ogmios ran into an error. Response: {response}")
+            )
+
+    def _disconnected(self, ws: websocket.WebSocket, e: Exception):
+        if self._ws is ws:
+            self._ws = None
+        for request_id, (request_ws, future) in list(self._pending.items()):
+            if request_ws is ws:
+                del self._pending[request_id]
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError(f"Connection to Ogmios was lost: {e}")
+                    )
+
+    def _drop(self, ws: websocket.WebSocket):
+        # closing makes the receiving thread fail all requests pending on this connection
+        if self._ws is ws:
+            self._ws = None
+        ws.close()
+
+    async def request(
+        self, methodname: str, args: dict, timeout: float = DEFAULT_TIMEOUT
+    ):
+        ws = await self._connection()
+        request_id = uuid.uuid4().hex
+        future = self._loop.create_future()
+        self._pending[request_id] = (ws, future)
+        payload = json.dumps(
+            {
+                "type": "jsonwsp/request",
+                "version": "1.0",
+                "servicename": "ogmios",
+                "methodname": methodname,
+                "args": args,
+                "mirror": {"id": request_id},
+            },
+            separators=(",", ":"),
+        )
+        try:
+            with self._send_lock:
+                ws.send(payload)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # do not let a hung connection stall subsequent requests
+            _LOGGER.warning(f"{methodname} request to Ogmios timed out, reconnecting")
+            self._drop(ws)
+            raise
+        except websocket.WebSocketException:
+            self._drop(ws)
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def query(self, query, timeout: float = DEFAULT_TIMEOUT):
+        return await self.request("Query", {"query": query}, timeout)
+
+    async def utxos(
+        self, address: str, timeout: float = DEFAULT_TIMEOUT
+    ) -> List[Tuple[dict, dict]]:
+        """
+        UTxOs at the address as pairs of transaction input and output in the Ogmios json format
+        """
+        return await self.query({"utxo": [address]}, timeout)
+
+    def close(self):
+        if self._ws is not None:
+            self._drop(self._ws)
+
+
+class OgmiosBackend:
+    """
+    Fetch backend that queries all UTxOs at the contract address from Ogmios
+    """
+
+    def __init__(self, client: AsyncOgmiosClient):
+        self.client = client
+
+    async def utxos(self, contract, timeout: float) -> List[Tuple[dict, dict]]:
+        return await self.client.utxos(contract.address, timeout)
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,171 @@
+"""
+Push of registry changes to clients as server-sent events.
+
+A single producer thread per server process follows the change feed of the store and
+serializes every change once into an event. The events are kept in a shared buffer
+from which all subscribers read, so the cost per subscriber is only writing the events
+of the contracts it follows.
+
+Each event has the cursor of the change feed as id, so clients reconnecting with the
+Last-Event-ID header continue where they left off. If the events after that id are not
+buffered anymore, the client receives a resync event and has to re-download the lists.
+"""
+import bisect
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Collection, Iterator, List, Optional
+
+from onchain_token_verification.rest.store import RegistrationStore
+
+_LOGGER = logging.getLogger(__name__)
+
+# number of events kept for subscribers that fall behind or reconnect
+BUFFER_SIZE = 10_000
+# interval in seconds in which the change feed is checked for new changes
+POLL_INTERVAL = 1.0
+# interval in seconds after which an idle subscription receives a comment,
+# so that proxies do not close the connection
+KEEPALIVE_INTERVAL = 15.0
+# maximum number of changes read from the store at once
+READ_LIMIT = 10_000
+
+
+def format_event(
+    cursor: int, contract: str, change: str, subject: str, signature: str
+) -> bytes:
+    # subject and signature are stored as compact json, so they are embedded without parsing
+    data = (
+        f'{{"contract":"{contract}","cursor":{cursor},"change":"{change}",'
+        f'"subject":{subject},"signature":{signature}}}'
+    )
+    return f"id: {cursor}\nevent: {change}\ndata: {data}\n\n".encode("utf8")
+
+
+def format_resync(cursor: int) -> bytes:
+    return f'id: {cursor}\nevent: resync\ndata: {{"cursor":{cursor}}}\n\n'.encode(
+        "utf8"
+    )
+
+
+class ChangeBroadcaster:
+    """
+    Follows the change feed of the store in a background thread (started on the first
+    subscription) and fans the changes out to any number of subscribers
+    """
+
+    def __init__(
+        self,
+        store_path: Path,
+        buffer_size: int = BUFFER_SIZE,
+        poll_interval: float = POLL_INTERVAL,
+        keepalive_interval: float = KEEPALIVE_INTERVAL,
+    ):
+        self.store_path = store_path
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self.keepalive_interval = keepalive_interval
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        # buffered events, ordered by cursor
+        self._cursors: List[int] = []
+        self._contracts: List[str] = []
+        self._events: List[bytes] = []
+        # the events after this cursor are all buffered
+        self._complete_since: Optional[int] = None
+        self._latest = 0
+        self.subscribers = 0
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="change-broadcaster", daemon=True
+                )
+                self._thread.start()
+            # subscribers need to know from where on the events are complete
+            while self._complete_since is None:
+                self._condition.wait()
+
+    def _run(self):
+        store = None
+        while True:
+            try:
+                if store is None:
+                    if not self.store_path.exists():
+                        # nothing recorded yet, all changes will be buffered
+                        self._publish([], since=0)
+                        time.sleep(self.poll_interval)
+                        continue
+                    store = RegistrationStore(self.store_path, readonly=True)
+                if self._complete_since is None:
+                    self._publish([], since=store.latest_cursor())
+                changes = store.feed(self._latest, READ_LIMIT)
+                self._publish(changes)
+                if len(changes) == READ_LIMIT:
+                    continue
+            except Exception as e:
+                _LOGGER.error("Could not read the change feed", exc_info=e)
+                store = None
+            time.sleep(self.poll_interval)
+
+    def _publish(self, changes: list, since: Optional[int] = None):
+        events = [format_event(*change) for change in changes]
+        with self._condition:
+            if since is not None and self._complete_since is None:
+                self._complete_since = self._latest = since
+            if events:
+                self._cursors += [change[0] for change in changes]
+                self._contracts += [change[1] for change in changes]
+                self._events += events
+                self._latest = changes[-1][0]
+                if len(self._events) > 2 * self.buffer_size:
+                    # drop the oldest events in bulk, not on every publish
+                    drop = len(self._events) - self.buffer_size
+                    self._complete_since = self._cursors[drop - 1]
+                    del self._cursors[:drop]
+                    del self._contracts[:drop]
+                    del self._events[:drop]
+            self._condition.notify_all()
+
+    def subscribe(
+        self, contracts: Collection[str], last_id: Optional[int] = None
+    ) -> Iterator[bytes]:
+        """
+        The events of the given contracts after the given cursor (the latest one if None),
+        as chunks of the event stream. Runs indefinitely.
+        """
+        self.start()
+        with self._condition:
+            position = self._latest if last_id is None else last_id
+            self.subscribers += 1
+        try:
+            yield from self._stream(contracts, position)
+        finally:
+            with self._condition:
+                self.subscribers -= 1
+
+    def _stream(self, contracts: Collection[str], position: int) -> Iterator[bytes]:
+        while True:
+            deadline = time.monotonic() + self.keepalive_interval
+            chunk = b""
+            with self._condition:
+                while not chunk:
+                    if position < self._complete_since:
+                        position = self._latest
+                        chunk = format_resync(position)
+                        break
+                    start = bisect.bisect_right(self._cursors, position)
+                    # indexes instead of slices, the log is not copied per subscriber
+                    chunk = b"".join(
+                        self._events[i]
+                        for i in range(start, len(self._events))
+                        if self._contracts[i] in contracts
+                    )
+                    position = max(position, self._latest)
+                    remaining = deadline - time.monotonic()
+                    if chunk or remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            yield chunk or b": keepalive\n\n"
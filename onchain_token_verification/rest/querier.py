@@ -1,134 +1,264 @@
 import argparse
+import asyncio
 import logging
 import time
-from collections import defaultdict
 from pathlib import Path
-import uuid
 import json
-import concurrent.futures
+from typing import Collection, List
 
-import pycardano
-from opshin.ledger.api_v2 import Nothing
-from pycardano import OgmiosChainContext, Network, AssetName, ScriptHash, PlutusData
+from pycardano import Network
 
 from gelidum import freeze
 
 logging.basicConfig(level=logging.INFO)
 
-from onchain_token_verification.cip68 import cip68_to_json
+from onchain_token_verification.rest.chainsync import (
+    ORIGIN,
+    OgmiosChainSync,
+    Point,
+    RegistryIndexer,
+    ReplayChainSync,
+    WatchedContract,
+    follow,
+    parse_point,
+    registration_datum,
+)
+from onchain_token_verification.rest.history import RegistryHistory, SNAPSHOT_EVERY
+from onchain_token_verification.rest.kupo import KupoBackend
+from onchain_token_verification.rest.metrics import Registry
+from onchain_token_verification.rest.ogmios import (
+    AsyncOgmiosClient,
+    DEFAULT_TIMEOUT,
+    OgmiosBackend,
+)
+from onchain_token_verification.rest.registrations import (
+    DecodeCache,
+    RegistrationEntry,
+    utxo_ref,
+)
+from onchain_token_verification.rest.snapshot import (
+    atomic_dump,
+    dump_registrations,
+    encode_json,
+    snapshots_exist,
+)
+from onchain_token_verification.rest.store import RegistrationStore
 from onchain_token_verification.rest.util import (
-    CONTRACTS,
-    CONTRACT_ARTIFACTS,
-    contract_data_path,
-    FULL_LIST,
-    SIGNERS,
+    CHAINSYNC_CHECKPOINT,
+    CONTRACT_NAMES,
+    HISTORY_DIR,
+    contract_module,
+    load_contract_artifacts,
+    QUERIER_METRICS,
+    STORE_PATH,
 )
 
 _LOGGER = logging.getLogger(__name__)
 
-from ..utils import network, ogmios_url
+from ..utils import network, ogmios_url, kupo_host, kupo_url
+
+METRICS = Registry()
+CYCLE_SECONDS = METRICS.histogram(
+    "querier_cycle_seconds",
+    "Duration of successful fetching cycles",
+    ["contract"],
+)
+STAGE_SECONDS = METRICS.histogram(
+    "querier_stage_seconds",
+    "Duration of the stages of fetching cycles (fetch, decode, write)",
+    ["contract", "stage"],
+)
+CYCLE_ERRORS = METRICS.counter(
+    "querier_cycle_errors_total",
+    "Fetching cycles that failed, by error (timeout, unexpected)",
+    ["contract", "error"],
+)
+UTXOS = METRICS.counter(
+    "querier_utxos_total",
+    "UTxOs processed, by outcome (accepted, invalid_output for a missing token or datum, malformed datum)",
+    ["contract", "outcome"],
+)
+REGISTRATIONS = METRICS.gauge(
+    "querier_registrations",
+    "Number of registrations in the last written snapshot",
+    ["contract"],
+)
+BYTES_WRITTEN = METRICS.counter(
+    "querier_snapshot_bytes_written_total",
+    "Bytes of snapshots written (uncompressed)",
+    ["contract"],
+)
+LAST_SUCCESS = METRICS.gauge(
+    "querier_last_success_timestamp_seconds",
+    "Unix time of the last successful refresh of the snapshots",
+    ["contract"],
+)
+CHAINSYNC_MESSAGES = METRICS.counter(
+    "querier_chainsync_messages_total",
+    "Chain-sync messages applied, by message (roll_forward, roll_backward)",
+    ["message"],
+)
+
 
-# initialize an Ogmios Chain context
-context = OgmiosChainContext(f"{ogmios_url}", network=network)
+def write_metrics():
+    atomic_dump(METRICS.render(), QUERIER_METRICS)
 
 
-def atomic_dump(content: str, p: Path, mode="w"):
-    # This sounds more drastic than it is
-    new_path = Path(str(p) + ".new" + str(uuid.uuid4()))
-    with new_path.open(mode) as fp:
-        fp.write(content)
-    new_path.replace(p)
+def write_registrations(
+    store: RegistrationStore,
+    contract_name: str,
+    registrations: Collection[RegistrationEntry],
+):
+    added, removed = store.replace(contract_name, registrations)
+    # the binary snapshot and the membership file are replaced whenever they are written,
+    # which makes every server map them again
+    if added or removed or not snapshots_exist(contract_name):
+        bytes_written = dump_registrations(contract_name, store)
+        BYTES_WRITTEN.inc(bytes_written, contract=contract_name)
+    REGISTRATIONS.set(len(registrations), contract=contract_name)
+    LAST_SUCCESS.set(time.time(), contract=contract_name)
 
 
-def fetch_entities(interval, contract, artifacts):
-    contract_name = Path(contract.__file__).stem
+async def fetch_entities(
+    backend,
+    contract: WatchedContract,
+    interval: float,
+    timeout: float = DEFAULT_TIMEOUT,
+):
+    contract_name = contract.name
     _LOGGER.info(f"Starting Fetching UTxOs for {contract_name}")
+    # accessed from one worker thread at a time only
+    store = RegistrationStore(STORE_PATH)
+    # decoded registrations of the UTxOs seen in previous cycles
+    decode_cache = DecodeCache()
     while True:
         try:
-            # keep a list for all registered subjects and who signed them
-            registered_subjects = defaultdict(list)
-
             _LOGGER.debug(f"Fetching UTxOs for {contract_name}")
-            registration_class = contract.Registration
-            tokenname = AssetName(contract.TOKENNAME)
-            policy_id = ScriptHash(bytes.fromhex(artifacts.policy_id))
-            address = (
-                artifacts.mainnet_addr
-                if network == Network.MAINNET
-                else artifacts.testnet_addr
-            )
-            for utxo in context.utxos(address):
-                # validate that the output has the valid format
-                if (
-                    utxo.output.amount.multi_asset.get(policy_id, {}).get(tokenname, 0)
-                    != 1
-                ):
-                    _LOGGER.debug(
-                        f"UTxO {utxo.input.transaction_id}#{utxo.input.index} does not contain the required token"
-                    )
-                    continue
-                if utxo.output.datum is None:
-                    _LOGGER.debug(
-                        f"UTxO {utxo.input.transaction_id}#{utxo.input.index} does not contain the required datum"
-                    )
-                    continue
-                try:
-                    trust_datum = registration_class.from_cbor(utxo.output.datum.cbor)
-                except pycardano.DeserializeException as e:
-                    _LOGGER.debug(
-                        f"UTxO {utxo.input.transaction_id}#{utxo.input.index} contains malformed datum"
+            cycle_start = time.perf_counter()
+            with STAGE_SECONDS.time(contract=contract_name, stage="fetch"):
+                utxos = await backend.utxos(contract, timeout)
+            with STAGE_SECONDS.time(contract=contract_name, stage="decode"):
+                registrations = []
+                invalid_outputs, malformed = 0, 0
+                for tx_in, output in utxos:
+                    ref = utxo_ref(tx_in["txId"], tx_in["index"])
+                    datum = registration_datum(ref, output, contract)
+                    if datum is None:
+                        invalid_outputs += 1
+                        continue
+                    registration = decode_cache.decode(
+                        ref, datum, contract.registration_class
                     )
-                    continue
-
-                # generate a frozen version of the trust datum json representation
-                subject = PlutusData.to_json(trust_datum.subject)
-                # attach all the metadata and the original signer
-                registered_subjects[subject].append(
-                    {
-                        "signer": trust_datum.signer.hex(),
-                        "utxo": f"{utxo.input.transaction_id}#{utxo.input.index}",
-                        **(
-                            cip68_to_json(trust_datum.metadata)
-                            if trust_datum.metadata != Nothing()
-                            else {"metadata": None}
-                        ),
-                    }
-                )
-
-            registered_subjects_list = [
-                {"subject": json.loads(s), "verifiers": d}
-                for s, d in registered_subjects.items()
-            ]
-
-            atomic_dump(
-                json.dumps(registered_subjects_list, separators=(",", ":")),
-                contract_data_path(contract_name, FULL_LIST),
+                    if registration is None:
+                        malformed += 1
+                        continue
+                    registrations.append(registration)
+            UTXOS.inc(len(registrations), contract=contract_name, outcome="accepted")
+            UTXOS.inc(invalid_outputs, contract=contract_name, outcome="invalid_output")
+            UTXOS.inc(malformed, contract=contract_name, outcome="malformed")
+            hits, misses = decode_cache.hits, decode_cache.misses
+            evicted = decode_cache.evict_unseen()
+            _LOGGER.debug(
+                f"Decode cache of {contract_name}: {hits} hits, {misses} misses in total, "
+                f"evicted {evicted} spent UTxOs, {len(decode_cache)} cached"
             )
 
-            # restructure to store signed_by variation
-
-            signed_by = defaultdict(list)
-            for subject, trustees in registered_subjects.items():
-                for trustee in trustees:
-                    signed_by[trustee["signer"]].append(
-                        {"subject": json.loads(subject), "signature": trustee}
-                    )
-            signed_by_list = [
-                {"signer": signer, "subjects": subjects}
-                for signer, subjects in signed_by.items()
-            ]
-
-            atomic_dump(
-                json.dumps(signed_by_list, separators=(",", ":")),
-                contract_data_path(contract_name, SIGNERS),
+            # keep the event loop responsive while writing to disk
+            with STAGE_SECONDS.time(contract=contract_name, stage="write"):
+                await asyncio.to_thread(
+                    write_registrations, store, contract_name, registrations
+                )
+            CYCLE_SECONDS.observe(
+                time.perf_counter() - cycle_start, contract=contract_name
+            )
+        except asyncio.TimeoutError:
+            CYCLE_ERRORS.inc(contract=contract_name, error="timeout")
+            _LOGGER.warning(
+                f"Fetching entities of {contract_name} timed out after {timeout}s"
             )
         except Exception as e:
+            CYCLE_ERRORS.inc(contract=contract_name, error="unexpected")
             _LOGGER.error(
                 f"While fetching entities of {contract_name}, encountered unexpected issue",
                 exc_info=e,
             )
+        try:
+            await asyncio.to_thread(write_metrics)
+        except OSError as e:
+            _LOGGER.warning(f"Could not write metrics: {e}")
         # re-fetch every 20 seconds
-        time.sleep(interval)
+        await asyncio.sleep(interval)
+
+
+async def fetch_all(interval: float, timeout: float, backends: list):
+    """
+    Fetches the entities of all contracts concurrently,
+    sharing a small pool of backends (e.g. connections to Ogmios)
+    """
+    try:
+        await asyncio.gather(
+            *(
+                fetch_entities(backends[i % len(backends)], contract, interval, timeout)
+                for i, contract in enumerate(watched_contracts())
+            )
+        )
+    finally:
+        for backend in backends:
+            backend.close()
+
+
+def watched_contracts() -> List[WatchedContract]:
+    watched = []
+    for name, artifacts in load_contract_artifacts().items():
+        contract = contract_module(name)
+        watched.append(
+            WatchedContract(
+                name=name,
+                address=(
+                    artifacts.mainnet_addr
+                    if network == Network.MAINNET
+                    else artifacts.testnet_addr
+                ),
+                asset=f"{artifacts.policy_id}.{contract.TOKENNAME.hex()}",
+                registration_class=contract.Registration,
+            )
+        )
+    return watched
+
+
+def flush_registries(
+    indexer: RegistryIndexer, store: RegistrationStore, checkpoint_path: Path
+):
+    for name in indexer.pop_changed():
+        with STAGE_SECONDS.time(contract=name, stage="write"):
+            write_registrations(store, name, indexer.registries[name].values())
+    # the checkpoint is written last so that a crash leads to re-applying blocks
+    atomic_dump(encode_json(indexer.checkpoint()), checkpoint_path)
+    write_metrics()
+
+
+def follow_chain(
+    chain_sync,
+    indexer: RegistryIndexer,
+    store: RegistrationStore,
+    checkpoint_path: Path,
+    start: Point = ORIGIN,
+    flush_every: int = 1000,
+):
+    """
+    Applies the blocks of the chain to the registries, starting from the last checkpoint
+    or the given start point. Writes the registries once the tip of the chain is reached
+    and regularly while catching up.
+    """
+    follow(
+        chain_sync,
+        indexer,
+        checkpoint_path,
+        lambda at_tip: flush_registries(indexer, store, checkpoint_path),
+        start=start,
+        flush_every=flush_every,
+        messages=CHAINSYNC_MESSAGES,
+    )
 
 
 def main():
@@ -139,18 +269,98 @@ def main():
         "--interval",
         "-i",
         default=20,
+        type=float,
         help="Period of re-fetching in seconds, defaults to 20s",
     )
+    argparser.add_argument(
+        "--timeout",
+        default=DEFAULT_TIMEOUT,
+        type=float,
+        help=f"Time in seconds after which a request to Ogmios is abandoned, defaults to {DEFAULT_TIMEOUT}s",
+    )
+    argparser.add_argument(
+        "--connections",
+        default=1,
+        type=int,
+        help="Number of connections to Ogmios shared by the fetching jobs, defaults to 1",
+    )
+    argparser.add_argument(
+        "--backend",
+        choices=["ogmios", "kupo"],
+        default="ogmios",
+        help="Where to fetch the UTxOs from in poll mode, defaults to ogmios",
+    )
+    argparser.add_argument(
+        "--mode",
+        choices=["poll", "chainsync"],
+        default="poll",
+        help="Either periodically re-fetch all UTxOs or follow the chain incrementally, defaults to poll",
+    )
+    argparser.add_argument(
+        "--start",
+        default=ORIGIN,
+        help="Point (<slot>.<block hash>) to start following the chain from if there is no checkpoint, defaults to origin",
+    )
+    argparser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="Do not log the added and removed registrations for point-in-time queries (chainsync mode)",
+    )
+    argparser.add_argument(
+        "--history-snapshot-every",
+        default=SNAPSHOT_EVERY,
+        type=int,
+        help=f"Number of logged registration events after which a snapshot of the registry is written, defaults to {SNAPSHOT_EVERY}",
+    )
+    argparser.add_argument(
+        "--replay",
+        type=Path,
+        help="Replay recorded chain-sync messages from this file instead of connecting to Ogmios",
+    )
+    argparser.add_argument(
+        "--record",
+        type=Path,
+        help="Record all chain-sync messages received from Ogmios to this file",
+    )
     args = argparser.parse_args()
-    interval = args.interval
-    workers = len(CONTRACTS)
+    if args.mode == "chainsync":
+        chain_sync = (
+            ReplayChainSync(args.replay)
+            if args.replay is not None
+            else OgmiosChainSync(ogmios_url, record_to=args.record)
+        )
+        contracts = watched_contracts()
+        registry_history = (
+            RegistryHistory(
+                HISTORY_DIR,
+                [contract.name for contract in contracts],
+                args.history_snapshot_every,
+            )
+            if not args.no_history
+            else None
+        )
+        follow_chain(
+            chain_sync,
+            RegistryIndexer(contracts, registry_history=registry_history),
+            RegistrationStore(STORE_PATH),
+            CHAINSYNC_CHECKPOINT,
+            start=parse_point(args.start),
+        )
+        return
     _LOGGER.info(
-        f"Starting fetching of contract UTxOs, running {workers} jobs concurrently."
+        f"Starting fetching of contract UTxOs, running {len(CONTRACT_NAMES)} jobs concurrently."
     )
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as tpe:
-        for contract, artifacts in zip(CONTRACTS, CONTRACT_ARTIFACTS):
-            tpe.submit(fetch_entities, interval, contract, artifacts)
-        # will await completion of jobs here, indefinitely
+    if args.backend == "kupo":
+        if kupo_host is None:
+            argparser.error("KUPO_API_HOST needs to be set to fetch from Kupo")
+        backends = [KupoBackend(kupo_url)]
+    else:
+        backends = [
+            OgmiosBackend(AsyncOgmiosClient(ogmios_url))
+            for _ in range(args.connections)
+        ]
+    # runs indefinitely, interrupting cancels all fetching jobs
+    asyncio.run(fetch_all(args.interval, args.timeout, backends))
 
 
 if __name__ == "__main__":
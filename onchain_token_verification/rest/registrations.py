@@ -0,0 +1,165 @@
+import logging
+from collections import defaultdict
+from typing import Optional, Tuple, Iterable, Dict, List
+
+import cbor2
+from cbor2 import CBORTag
+
+_LOGGER = logging.getLogger(__name__)
+
+# a registration as served by the endpoints:
+# the json representation of the subject and the signature (signer, utxo and metadata)
+RegistrationEntry = Tuple[str, dict]
+
+
+def utxo_ref(transaction_id, index) -> str:
+    return f"{transaction_id}#{index}"
+
+
+# decoded cbor of Nothing, the metadata of registrations without metadata
+NOTHING_PRIMITIVE = CBORTag(127, [])
+
+
+def split_registration(datum_cbor: bytes, registration_class):
+    """
+    Decodes subject and signer of a registration datum, leaving the metadata as decoded cbor
+    for cip68_primitive_to_json. Returns None if the datum does not have the common shape
+    and needs to be decoded by the registration class.
+    """
+    try:
+        primitive = cbor2.loads(datum_cbor)
+    except Exception:
+        return None
+    if (
+        type(primitive) is not CBORTag
+        or primitive.tag != 121
+        or type(primitive.value) is not list
+        or len(primitive.value) != 3
+    ):
+        return None
+    subject, signer, metadata = primitive.value
+    if type(metadata) is not CBORTag or not (
+        metadata.tag == 121 or metadata == NOTHING_PRIMITIVE
+    ):
+        return None
+    try:
+        # the metadata is decoded separately, in one pass
+        registration = registration_class.from_primitive(
+            CBORTag(121, [subject, signer, NOTHING_PRIMITIVE])
+        )
+    except Exception:
+        return None
+    return registration, metadata
+
+
+def decode_registration(
+    ref: str, datum_cbor: bytes, registration_class
+) -> Optional[RegistrationEntry]:
+    """
+    Decodes the datum of a registration UTxO, returns None if the datum is malformed
+    """
+    # anyone can create registrations, so no datum may stop the indexing,
+    # e.g. metadata keys that are not valid utf8
+    try:
+        return _decode_registration(ref, datum_cbor, registration_class)
+    except Exception as e:
+        _LOGGER.debug(f"UTxO {ref} contains malformed datum: {e!r}")
+        return None
+
+
+def _decode_registration(
+    ref: str, datum_cbor: bytes, registration_class
+) -> Optional[RegistrationEntry]:
+    # imported here, the server uses this module without decoding datums
+    from opshin.ledger.api_v2 import Nothing
+    from pycardano import PlutusData
+
+    from onchain_token_verification.cip68 import cip68_primitive_to_json, cip68_to_json
+
+    split = split_registration(datum_cbor, registration_class)
+    if split is not None:
+        registration, metadata = split
+        metadata_json = (
+            cip68_primitive_to_json(metadata)
+            if metadata != NOTHING_PRIMITIVE
+            else {"metadata": None}
+        )
+        return PlutusData.to_json(registration.subject), {
+            "signer": registration.signer.hex(),
+            "utxo": ref,
+            **metadata_json,
+        }
+
+    trust_datum = registration_class.from_cbor(datum_cbor)
+    # generate a frozen version of the trust datum json representation
+    subject = PlutusData.to_json(trust_datum.subject)
+    # attach all the metadata and the original signer
+    return subject, {
+        "signer": trust_datum.signer.hex(),
+        "utxo": ref,
+        **(
+            cip68_to_json(trust_datum.metadata)
+            if trust_datum.metadata != Nothing()
+            else {"metadata": None}
+        ),
+    }
+
+
+def group_by_subject(
+    registrations: Iterable[RegistrationEntry],
+) -> Dict[str, List[dict]]:
+    registered_subjects = defaultdict(list)
+    for subject, signature in registrations:
+        registered_subjects[subject].append(signature)
+    return registered_subjects
+
+
+def subject_key(subject: dict) -> str:
+    """
+    Compact key of a subject given in its json representation:
+    <policy id>.<token name> (hex encoded) for tokens, the hex encoded pubkeyhash for authorities
+    """
+    if "bytes" in subject:
+        return subject["bytes"]
+    policy_id, token_name = subject["fields"]
+    return f"{policy_id['bytes']}.{token_name['bytes']}"
+
+
+class DecodeCache:
+    """
+    Caches decoded registrations by utxo ref across polling cycles.
+    UTxOs are immutable, so an entry stays valid until the UTxO is spent.
+    """
+
+    def __init__(self):
+        # malformed datums are cached as well (as None)
+        self._entries: Dict[str, Optional[RegistrationEntry]] = {}
+        self._seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def decode(
+        self, ref: str, datum_cbor: bytes, registration_class
+    ) -> Optional[RegistrationEntry]:
+        self._seen.add(ref)
+        if ref in self._entries:
+            self.hits += 1
+            return self._entries[ref]
+        self.misses += 1
+        registration = decode_registration(ref, datum_cbor, registration_class)
+        self._entries[ref] = registration
+        return registration
+
+    def evict_unseen(self) -> int:
+        """
+        Drops all entries that were not requested since the last eviction,
+        i.e. of UTxOs that were spent. Returns the number of evicted entries.
+        """
+        unseen = self._entries.keys() - self._seen
+        for ref in unseen:
+            del self._entries[ref]
+        self._seen = set()
+        return len(unseen)
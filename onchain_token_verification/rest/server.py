@@ -1,10 +1,37 @@
+import json
 import logging
+import os
+import threading
+import time
 
-from flask import Flask, request, abort, send_from_directory, send_file, jsonify, Response  # type: ignore
+from flask import Flask, request, abort, send_from_directory, send_file, jsonify, Response, g  # type: ignore
 from flask_cors import CORS  # type: ignore
 from flask_caching import Cache  # type: ignore
 
-from .util import CONTRACTS, DATA_DIR, contract_data_path, contract_name, PURPOSES
+from .binary_snapshot import BinarySnapshot
+from .history import RegistryHistory
+from .metrics import Registry
+from .push import ChangeBroadcaster
+from .registrations import group_by_subject
+from .snapshot import encode_json
+from .store import RegistrationStore
+from .trust import TrustGraph
+from .util import (
+    CONTRACT_NAMES,
+    DATA_DIR,
+    contract_binary_snapshot_path,
+    contract_data_path,
+    contract_membership_path,
+    encoded_path,
+    ENCODINGS,
+    etag_path,
+    FULL_LIST,
+    HISTORY_DIR,
+    PURPOSES,
+    QUERIER_METRICS,
+    STORE_PATH,
+    TRUSTED_ROOTS,
+)
 
 # logger setup
 _LOGGER = logging.getLogger(__name__)
@@ -17,20 +44,345 @@ app.config.from_mapping({"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 2
 cache = Cache(app)
 CORS(app)
 
-CONTRACT_NAMES = {contract_name(contract) for contract in CONTRACTS}
+# memory-mapped, so that all worker processes share the pages of the snapshots
+SNAPSHOTS = {
+    name: BinarySnapshot(contract_binary_snapshot_path(name)) for name in CONTRACT_NAMES
+}
+
+# event logs of the querier (chainsync mode) for point-in-time queries
+HISTORY = RegistryHistory(HISTORY_DIR, CONTRACT_NAMES)
+
+# pushes the changes recorded by the querier to subscribers of /events
+BROADCASTER = ChangeBroadcaster(STORE_PATH)
+
+# sqlite connections can not be shared across threads
+_local = threading.local()
+
+# maximum number of changes returned per request
+MAX_CHANGES = 10_000
+
+# follows the change feed of the store
+TRUST_GRAPH = TrustGraph(TRUSTED_ROOTS)
+
+# maximum number of tokens verified per request
+MAX_VERIFY_TOKENS = 50_000
+
+# number of items per page of the lists, by default and at most
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1_000
+# query parameters that request a page of a list instead of the full list
+PAGE_PARAMETERS = {"limit", "after", "signer", "policy_id", "metadata_key", "fields"}
+
+
+METRICS = Registry()
+REQUEST_SECONDS = METRICS.histogram(
+    "server_request_seconds",
+    "Duration of requests by route, method and status",
+    ["route", "method", "status"],
+)
+SNAPSHOT_AGE = METRICS.gauge(
+    "server_snapshot_age_seconds",
+    "Time since the querier last wrote the served snapshot",
+    ["contract"],
+)
+EVENT_SUBSCRIBERS = METRICS.gauge(
+    "server_event_subscribers", "Open subscriptions to /events"
+)
+
+
+def get_store() -> RegistrationStore:
+    # a connection keeps reading a deleted store, so it is opened again for a new file
+    inode = STORE_PATH.stat().st_ino
+    if getattr(_local, "store_inode", None) != inode:
+        if hasattr(_local, "store"):
+            _local.store.close()
+        _local.store = RegistrationStore(STORE_PATH, readonly=True)
+        _local.store_inode = inode
+    return _local.store
+
 
 #################################################################################################
 #                                            Endpoints                                          #
 #################################################################################################
 
 
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_latency(response):
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - g.request_start,
+        route=request.url_rule.rule if request.url_rule is not None else "unmatched",
+        method=request.method,
+        status=response.status_code,
+    )
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    """
+    Metrics of this server process and of the querier in the Prometheus text format
+    """
+    now = time.time()
+    for name in CONTRACT_NAMES:
+        try:
+            mtime = os.stat(contract_binary_snapshot_path(name)).st_mtime
+        except FileNotFoundError:
+            continue
+        SNAPSHOT_AGE.set(now - mtime, contract=name)
+    EVENT_SUBSCRIBERS.set(BROADCASTER.subscribers)
+    text = METRICS.render()
+    try:
+        text += QUERIER_METRICS.read_text()
+    except FileNotFoundError:
+        pass
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
+def unknown_contract(contract_name):
+    return (
+        f"Unknown contract name {repr(contract_name)}, choose one of {CONTRACT_NAMES}",
+        404,
+    )
+
+
+def lookup_response(entry: bytes, description: str):
+    if entry is None:
+        return f"No registration found for {description}", 404
+    return Response(entry, mimetype="application/json")
+
+
 @app.route("/<contract_name>/<purpose>")
 def entity_list(contract_name, purpose):
     if contract_name not in CONTRACT_NAMES:
+        return unknown_contract(contract_name)
+    if purpose not in PURPOSES:
+        return f"Unknown request format {repr(purpose)}, choose one of {PURPOSES}", 404
+    if not PAGE_PARAMETERS.isdisjoint(request.args):
+        return entity_page(contract_name, purpose)
+    path = contract_data_path(contract_name, purpose)
+    try:
+        etag = etag_path(path).read_text()
+    except FileNotFoundError:
+        # fall back to the etag derived from the file metadata
+        return send_file(path)
+    # serve a precompressed variant if the client accepts it, the querier only writes
+    # the variants of the compression modules installed in its environment
+    offered = [e for e in ENCODINGS if encoded_path(path, e).exists()]
+    encoding = request.accept_encodings.best_match(
+        [*offered, "identity"], default="identity"
+    )
+    if encoding != "identity":
+        path = encoded_path(path, encoding)
+        etag = f"{etag}-{encoding}"
+    # answers conditional requests with 304 Not Modified
+    response = send_file(path, mimetype="application/json", etag=etag)
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def project(signature: dict, fields) -> dict:
+    if fields is None:
+        return signature
+    return {k: v for k, v in signature.items() if k in fields}
+
+
+def entity_page(contract_name, purpose):
+    """
+    A page of the list, sorted by subject key or signer, starting after the key given as after.
+    Optionally only contains the registrations by the given signer, of tokens of the given
+    policy id or with the given key in their metadata, and only the comma separated fields
+    of each signature (e.g. signer,utxo).
+    """
+    limit = request.args.get("limit", default=DEFAULT_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    signer, policy_id = request.args.get("signer"), request.args.get("policy_id")
+    fields = request.args.get("fields")
+    fields = set(fields.split(",")) if fields is not None else None
+    if not STORE_PATH.exists():
+        return "No registrations recorded yet", 503
+    items, next_key = get_store().page(
+        contract_name,
+        purpose,
+        after=request.args.get("after", ""),
+        limit=limit,
+        signer=signer.lower() if signer is not None else None,
+        policy_id=policy_id.lower() if policy_id is not None else None,
+        metadata_key=request.args.get("metadata_key"),
+    )
+    for item in items:
+        if purpose == FULL_LIST:
+            item["verifiers"] = [project(v, fields) for v in item["verifiers"]]
+        else:
+            for signed in item["subjects"]:
+                signed["signature"] = project(signed["signature"], fields)
+    return Response(
+        encode_json({"items": items, "next": next_key}), mimetype="application/json"
+    )
+
+
+@app.route("/<contract_name>/members")
+def membership(contract_name):
+    """
+    Compact membership artifact of the registered subjects,
+    see onchain_token_verification.membership for the format
+    """
+    if contract_name not in CONTRACT_NAMES:
+        return unknown_contract(contract_name)
+    return send_file(
+        contract_membership_path(contract_name), mimetype="application/octet-stream"
+    )
+
+
+@app.route("/<contract_name>/changes")
+def change_feed(contract_name):
+    """
+    Registrations added and removed after the cursor given as since.
+    Clients should store the returned cursor and pass it as since in the next request.
+    If the changes after the given cursor are not known anymore, answers with 410
+    and the client needs to re-download the full list.
+    """
+    if contract_name not in CONTRACT_NAMES:
+        return unknown_contract(contract_name)
+    since = request.args.get("since", default=0, type=int)
+    limit = min(request.args.get("limit", default=MAX_CHANGES, type=int), MAX_CHANGES)
+    if not STORE_PATH.exists():
+        return "No changes recorded yet", 503
+    cursor, changes = get_store().changes(contract_name, since, max(limit, 1))
+    if changes is None:
+        return jsonify({"resync": True, "cursor": cursor}), 410
+    return jsonify({"resync": False, "cursor": cursor, "changes": changes})
+
+
+@app.route("/events")
+def events():
+    """
+    Stream of the added and removed registrations of the comma separated contracts
+    (all by default) as server-sent events, with the cursor of the change feed as id
+    """
+    contracts = request.args.get("contracts")
+    contracts = set(contracts.split(",")) if contracts else set(CONTRACT_NAMES)
+    unknown = contracts.difference(CONTRACT_NAMES)
+    if unknown:
+        return unknown_contract(", ".join(sorted(unknown)))
+    last_id = request.headers.get("Last-Event-ID", type=int)
+    if last_id is None:
+        last_id = request.args.get("since", type=int)
+    response = Response(
+        BROADCASTER.subscribe(contracts, last_id), mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    # disables buffering by nginx
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/<contract_name>/history/<int:slot>")
+def registrations_at(contract_name, slot):
+    """
+    The registrations of the contract at the end of the given slot,
+    in the same format as the subjects list
+    """
+    if contract_name not in CONTRACT_NAMES:
+        return unknown_contract(contract_name)
+    if not HISTORY.recorded(contract_name):
+        return "No history recorded, the querier only records it in chainsync mode", 503
+    registrations = HISTORY.state_at(contract_name, slot)
+    if registrations is None:
         return (
-            f"Unknown contract name {repr(contract_name)}, choose one of {CONTRACT_NAMES}",
+            f"The history of {contract_name} starts after slot {slot}, "
+            f"at slot {HISTORY.logs[contract_name].first_slot()}",
             404,
         )
-    if purpose not in PURPOSES:
-        return f"Unknown request format {repr(purpose)}, choose one of {PURPOSES}", 404
-    return send_file(contract_data_path(contract_name, purpose))
+    return Response(
+        encode_json(
+            [
+                {"subject": json.loads(subject), "verifiers": verifiers}
+                for subject, verifiers in group_by_subject(
+                    registrations.values()
+                ).items()
+            ]
+        ),
+        mimetype="application/json",
+    )
+
+
+@app.route("/<contract_name>/subject/<subject>")
+@app.route("/<contract_name>/subject/<policy_id>/<token_name>")
+def subject_lookup(contract_name, subject=None, policy_id=None, token_name=None):
+    """
+    Registrations of a single subject, given as pubkeyhash (authority_trust)
+    or policy id and token name (token_trust/token_mistrust), all hex encoded
+    """
+    if contract_name not in CONTRACT_NAMES:
+        return unknown_contract(contract_name)
+    key = subject if subject is not None else f"{policy_id}.{token_name}"
+    return lookup_response(SNAPSHOTS[contract_name].by_subject(key.lower()), key)
+
+
+@app.route("/<contract_name>/signer/<signer>")
+def signer_lookup(contract_name, signer):
+    if contract_name not in CONTRACT_NAMES:
+        return unknown_contract(contract_name)
+    return lookup_response(SNAPSHOTS[contract_name].by_signer(signer.lower()), signer)
+
+
+@app.route("/<contract_name>/utxo/<ref>")
+@app.route("/<contract_name>/utxo/<tx_id>/<int:index>")
+def utxo_lookup(contract_name, ref=None, tx_id=None, index=None):
+    """
+    The registration at a utxo, given as <tx id>#<index> (url encoded) or <tx id>/<index>
+    """
+    if contract_name not in CONTRACT_NAMES:
+        return unknown_contract(contract_name)
+    ref = ref if ref is not None else f"{tx_id}#{index}"
+    return lookup_response(SNAPSHOTS[contract_name].by_utxo(ref.lower()), ref)
+
+
+@app.route("/verify/<policy_id>/<token_name>")
+def verify_token(policy_id, token_name):
+    """
+    Whether a token is verified, i.e. registered in token_trust by an authority trusted
+    through authority_trust (starting at the configured roots) and not registered in token_mistrust
+    by any trusted authority. Lists the trusted signers with the chain of authorities
+    through which they are trusted.
+    """
+    if not STORE_PATH.exists():
+        return "No registrations recorded yet", 503
+    TRUST_GRAPH.sync(get_store())
+    return jsonify(TRUST_GRAPH.verify(policy_id.lower(), token_name.lower()))
+
+
+@app.route("/verify", methods=["POST"])
+def verify_tokens():
+    """
+    Verdicts about many tokens at once, posted as json {"tokens": [[<policy_id>, <token_name>], ...]}
+    (hex encoded). Answers with the verdicts in the same order, as for single tokens.
+    """
+    body = request.get_json(silent=True)
+    tokens = body.get("tokens") if isinstance(body, dict) else None
+    if not isinstance(tokens, list) or not all(
+        isinstance(token, list)
+        and len(token) == 2
+        and all(isinstance(part, str) for part in token)
+        for token in tokens
+    ):
+        return (
+            "Expected json of the form {'tokens': [[<policy_id>, <token_name>], ...]}",
+            400,
+        )
+    if len(tokens) > MAX_VERIFY_TOKENS:
+        return f"At most {MAX_VERIFY_TOKENS} tokens can be verified per request", 413
+    if not STORE_PATH.exists():
+        return "No registrations recorded yet", 503
+    TRUST_GRAPH.sync(get_store())
+    verdicts = TRUST_GRAPH.verify_many(
+        (policy_id.lower(), token_name.lower()) for policy_id, token_name in tokens
+    )
+    return Response(encode_json({"verdicts": verdicts}), mimetype="application/json")
@@ -0,0 +1,231 @@
+"""
+Serialization of the registrations into the json snapshots served by the REST server.
+
+Snapshots are streamed to temporary files and atomically moved into place,
+so that readers always see a complete snapshot.
+"""
+import hashlib
+import json
+import uuid
+from pathlib import Path
+from typing import Iterable, Union
+
+from onchain_token_verification.membership import write_membership
+from onchain_token_verification.rest.binary_snapshot import (
+    ENTRY,
+    FOOTER,
+    INDEXES,
+    JSON_LENGTH,
+    KEY_LENGTH,
+    key_hash,
+    MAGIC,
+    VERSION,
+)
+from onchain_token_verification.rest.store import RegistrationStore
+from onchain_token_verification.rest.util import (
+    contract_binary_snapshot_path,
+    contract_data_path,
+    contract_membership_path,
+    encoded_path,
+    ENCODINGS,
+    etag_path,
+    FULL_LIST,
+    SIGNERS,
+)
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+
+try:
+    import orjson
+
+    def encode_json(o) -> bytes:
+        try:
+            return orjson.dumps(o)
+        except orjson.JSONEncodeError:
+            # orjson only supports 64 bit integers, metadata may contain larger ones
+            return _encoder.encode(o).encode("utf8")
+
+except ImportError:
+
+    def encode_json(o) -> bytes:
+        return _encoder.encode(o).encode("utf8")
+
+
+# size of the chunks in which snapshots are written
+CHUNK_SIZE = 1 << 16
+
+
+class AtomicWriter:
+    """
+    Incrementally writes a file to a temporary location and moves it into place once complete.
+    With precompress, the file is accompanied by compressed variants and its content hash
+    (the etag), and the existing files are left untouched if the content did not change.
+    """
+
+    def __init__(self, p: Path, precompress=False):
+        self.path = p
+        self.bytes_written = 0
+        self._precompress = precompress
+        self._hash = hashlib.sha256()
+        # target path -> (temporary path, file, compressor)
+        self._files = {}
+
+    def __enter__(self):
+        self._open(self.path, None)
+        if self._precompress:
+            for encoding, (_, compressor) in ENCODINGS.items():
+                self._open(encoded_path(self.path, encoding), compressor())
+        return self
+
+    def _open(self, p: Path, compressor):
+        # This sounds more drastic than it is
+        new_path = Path(str(p) + ".new" + str(uuid.uuid4()))
+        self._files[p] = (new_path, new_path.open("wb"), compressor)
+
+    def write(self, data: bytes):
+        self._hash.update(data)
+        self.bytes_written += len(data)
+        for _, fp, compressor in self._files.values():
+            fp.write(data if compressor is None else compressor.compress(data))
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for _, fp, compressor in self._files.values():
+            if compressor is not None and exc_type is None:
+                fp.write(compressor.flush())
+            fp.close()
+        etag = self._hash.hexdigest()
+        etag_file = etag_path(self.path)
+        # a missing compressed variant is written again even if the content did not change
+        unchanged = (
+            self._precompress
+            and all(p.exists() for p in self._files)
+            and etag_file.exists()
+            and etag_file.read_text() == etag
+        )
+        if exc_type is not None or unchanged:
+            for new_path, _, _ in self._files.values():
+                new_path.unlink()
+            return False
+        # the plain file is replaced last and the etag after it,
+        # so the etag never belongs to content that is not yet in place
+        for p, (new_path, _, _) in reversed(self._files.items()):
+            new_path.replace(p)
+        if self._precompress:
+            atomic_dump(etag, etag_file)
+        return False
+
+
+def atomic_dump(content: Union[str, bytes], p: Path, precompress=False):
+    with AtomicWriter(p, precompress=precompress) as writer:
+        writer.write(content.encode("utf8") if isinstance(content, str) else content)
+
+
+def write_json_array(writer, items: Iterable):
+    chunk = bytearray(b"[")
+    for i, item in enumerate(items):
+        if i:
+            chunk += b","
+        chunk += encode_json(item)
+        if len(chunk) >= CHUNK_SIZE:
+            writer.write(bytes(chunk))
+            chunk.clear()
+    chunk += b"]"
+    writer.write(bytes(chunk))
+
+
+def write_views(
+    store: RegistrationStore, contract_name: str, subjects_writer, signers_writer
+):
+    """
+    Writes the subjects and the signers view of the registrations of the contract in the store
+    to the given writers (objects with write(bytes)), streaming them from the store ordered by
+    subject and by signer
+    """
+    write_json_array(
+        subjects_writer, (item for _, item in store.items(contract_name, "subjects"))
+    )
+    write_json_array(
+        signers_writer, (item for _, item in store.items(contract_name, "signers"))
+    )
+
+
+def write_binary_snapshot(store: RegistrationStore, contract_name: str, writer):
+    """
+    Writes the binary snapshot of the registrations of the contract in the store
+    to the writer (object with write(bytes)), only the index entries are kept in memory
+    """
+    offset = 0
+    entries = {index: [] for index in INDEXES}
+
+    def write_record(index: str, key: str, record: dict):
+        nonlocal offset
+        key_bytes, json_bytes = key.encode("utf8"), encode_json(record)
+        writer.write(
+            KEY_LENGTH.pack(len(key_bytes))
+            + key_bytes
+            + JSON_LENGTH.pack(len(json_bytes))
+            + json_bytes
+        )
+        entries[index].append((key_hash(key), offset))
+        offset += KEY_LENGTH.size + len(key_bytes) + JSON_LENGTH.size + len(json_bytes)
+
+    for key, item in store.items(contract_name, "subjects"):
+        write_record("subject", key, item)
+        for trustee in item["verifiers"]:
+            write_record(
+                "utxo",
+                trustee["utxo"],
+                {"subject": item["subject"], "signature": trustee},
+            )
+    for signer, item in store.items(contract_name, "signers"):
+        write_record("signer", signer, item)
+
+    footer = []
+    for index in INDEXES:
+        index_entries = sorted(entries[index])
+        writer.write(b"".join(ENTRY.pack(h, o) for h, o in index_entries))
+        footer += [offset, len(index_entries)]
+        offset += ENTRY.size * len(index_entries)
+    writer.write(FOOTER.pack(MAGIC, VERSION, *footer))
+
+
+def snapshots_exist(contract_name: str) -> bool:
+    """
+    Whether all snapshots of the contract written by dump_registrations exist
+    """
+    paths = [
+        contract_binary_snapshot_path(contract_name),
+        contract_membership_path(contract_name),
+    ]
+    for purpose in (FULL_LIST, SIGNERS):
+        path = contract_data_path(contract_name, purpose)
+        paths += [path, etag_path(path)]
+        paths += [encoded_path(path, encoding) for encoding in ENCODINGS]
+    return all(p.exists() for p in paths)
+
+
+def dump_registrations(contract_name: str, store: RegistrationStore) -> int:
+    """
+    Writes all snapshots of the registrations of the contract in the store,
+    returns the number of bytes written
+    """
+    with AtomicWriter(
+        contract_data_path(contract_name, FULL_LIST), precompress=True
+    ) as subjects_writer, AtomicWriter(
+        contract_data_path(contract_name, SIGNERS), precompress=True
+    ) as signers_writer:
+        write_views(store, contract_name, subjects_writer, signers_writer)
+    with AtomicWriter(contract_binary_snapshot_path(contract_name)) as binary_writer:
+        write_binary_snapshot(store, contract_name, binary_writer)
+    with AtomicWriter(contract_membership_path(contract_name)) as members_writer:
+        write_membership(
+            members_writer,
+            (
+                bytes.fromhex(key.replace(".", ""))
+                for key in store.subject_keys(contract_name)
+            ),
+        )
+    return sum(
+        writer.bytes_written
+        for writer in (subjects_writer, signers_writer, binary_writer, members_writer)
+    )
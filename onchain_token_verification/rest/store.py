@@ -0,0 +1,366 @@
+"""
+Persistent, indexed store of all registration UTxOs, kept next to the json snapshots.
+
+The store is an SQLite database in WAL mode, so readers (e.g. the REST server) never
+block the querier writing to it.
+"""
+import json
+import sqlite3
+import uuid
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from onchain_token_verification.rest.registrations import (
+    RegistrationEntry,
+    subject_key,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registrations (
+    contract TEXT NOT NULL,
+    utxo TEXT NOT NULL,
+    -- json representation of the subject and its compact key (see subject_key)
+    subject TEXT NOT NULL,
+    subject_key TEXT NOT NULL,
+    signer TEXT NOT NULL,
+    -- only set for registrations about tokens
+    policy_id TEXT,
+    signature TEXT NOT NULL,
+    PRIMARY KEY (contract, utxo)
+);
+CREATE INDEX IF NOT EXISTS registrations_subject ON registrations (contract, subject_key);
+-- also orders the registrations of a signer by subject, for pagination
+CREATE INDEX IF NOT EXISTS registrations_signer_subject ON registrations (contract, signer, subject_key);
+CREATE INDEX IF NOT EXISTS registrations_policy ON registrations (contract, policy_id);
+CREATE INDEX IF NOT EXISTS registrations_utxo ON registrations (utxo);
+-- feed of added and removed registrations, the cursor increases monotonically
+CREATE TABLE IF NOT EXISTS changes (
+    cursor INTEGER PRIMARY KEY AUTOINCREMENT,
+    contract TEXT NOT NULL,
+    change TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    signature TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_contract ON changes (contract, cursor);
+-- highest cursor per contract whose changes were pruned from the feed
+CREATE TABLE IF NOT EXISTS changes_pruned (
+    contract TEXT PRIMARY KEY,
+    cursor INTEGER NOT NULL
+);
+-- random id of the store, the cursors of a recreated store start over
+CREATE TABLE IF NOT EXISTS store_id (id TEXT NOT NULL);
+"""
+
+# views of the registrations by the column they are grouped by, as in the json lists
+VIEWS = {"subjects": "subject_key", "signers": "signer"}
+
+ADDED = "added"
+REMOVED = "removed"
+# number of changes kept per contract in the change feed
+CHANGE_RETENTION = 100_000
+
+
+class RegistrationStore:
+    """
+    One row per registration UTxO, with indexes on subject, signer, token policy id and utxo ref.
+    Every instance holds its own connection, which must not be used by several threads at once.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        readonly: bool = False,
+        change_retention: int = CHANGE_RETENTION,
+    ):
+        self.change_retention = change_retention
+        if readonly:
+            self._db = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, timeout=30, check_same_thread=False
+            )
+        else:
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+            with self._db:
+                if self.store_id() is None:
+                    self._db.execute(
+                        "INSERT INTO store_id VALUES (?)", (uuid.uuid4().hex,)
+                    )
+
+    def store_id(self) -> Optional[str]:
+        """
+        The id of the store, which changes when the store is deleted and created again
+        """
+        row = self._db.execute("SELECT id FROM store_id").fetchone()
+        return None if row is None else row[0]
+
+    def close(self):
+        self._db.close()
+
+    def replace(
+        self, contract: str, registrations: Iterable[RegistrationEntry]
+    ) -> Tuple[Set[str], Set[str]]:
+        """
+        Replaces the registrations of the contract in a single transaction,
+        only touching rows that changed, and records the changes in the change feed.
+        Returns the added and removed utxo refs.
+        """
+        registrations = {
+            signature["utxo"]: (s, signature) for s, signature in registrations
+        }
+        with self._db:
+            existing = {
+                row[0]
+                for row in self._db.execute(
+                    "SELECT utxo FROM registrations WHERE contract = ?", (contract,)
+                )
+            }
+            removed = existing - registrations.keys()
+            added = registrations.keys() - existing
+            self._db.executemany(
+                "INSERT INTO changes (contract, change, subject, signature) "
+                "SELECT contract, ?, subject, signature FROM registrations "
+                "WHERE contract = ? AND utxo = ?",
+                ((REMOVED, contract, ref) for ref in removed),
+            )
+            self._db.executemany(
+                "DELETE FROM registrations WHERE contract = ? AND utxo = ?",
+                ((contract, ref) for ref in removed),
+            )
+            self._db.executemany(
+                "INSERT INTO registrations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (_row(contract, *registrations[ref]) for ref in added),
+            )
+            self._db.executemany(
+                "INSERT INTO changes (contract, change, subject, signature) "
+                "SELECT contract, ?, subject, signature FROM registrations "
+                "WHERE contract = ? AND utxo = ?",
+                ((ADDED, contract, ref) for ref in added),
+            )
+            if added or removed:
+                self._prune_changes(contract)
+        return added, removed
+
+    def _prune_changes(self, contract: str):
+        row = self._db.execute(
+            "SELECT cursor FROM changes WHERE contract = ? "
+            "ORDER BY cursor DESC LIMIT 1 OFFSET ?",
+            (contract, self.change_retention),
+        ).fetchone()
+        if row is None:
+            return
+        self._db.execute(
+            "DELETE FROM changes WHERE contract = ? AND cursor <= ?",
+            (contract, row[0]),
+        )
+        self._db.execute(
+            "INSERT OR REPLACE INTO changes_pruned VALUES (?, ?)", (contract, row[0])
+        )
+
+    def changes(
+        self, contract: str, since: int, limit: int
+    ) -> Tuple[int, Optional[List[dict]]]:
+        """
+        Changes of the contract after the given cursor, at most limit many.
+        Returns the cursor to continue from and the changes, which are None if changes
+        after the given cursor were already pruned or the cursor is from a recreated store.
+        """
+        # read everything from the same snapshot of the database
+        self._db.execute("BEGIN")
+        try:
+            (latest,) = self._db.execute(
+                "SELECT COALESCE(MAX(cursor), 0) FROM changes"
+            ).fetchone()
+            if since > latest:
+                # handed out by a previous store, whose cursors went further
+                return latest, None
+            pruned = self._db.execute(
+                "SELECT cursor FROM changes_pruned WHERE contract = ?", (contract,)
+            ).fetchone()
+            if pruned is not None and since < pruned[0]:
+                return latest, None
+            changes = [
+                {
+                    "cursor": cursor,
+                    "change": change,
+                    "subject": json.loads(subject),
+                    "signature": json.loads(signature),
+                }
+                for cursor, change, subject, signature in self._db.execute(
+                    "SELECT cursor, change, subject, signature FROM changes "
+                    "WHERE contract = ? AND cursor > ? ORDER BY cursor LIMIT ?",
+                    (contract, since, limit),
+                )
+            ]
+        finally:
+            self._db.execute("COMMIT")
+        if len(changes) == limit:
+            return changes[-1]["cursor"], changes
+        return max(latest, since), changes
+
+    def feed(self, since: int, limit: int) -> List[Tuple[int, str, str, str, str]]:
+        """
+        Changes of all contracts after the given cursor, at most limit many, ordered by cursor,
+        as tuples (cursor, contract, change, subject json, signature json)
+        """
+        return self._db.execute(
+            "SELECT cursor, contract, change, subject, signature FROM changes "
+            "WHERE cursor > ? ORDER BY cursor LIMIT ?",
+            (since, limit),
+        ).fetchall()
+
+    def latest_cursor(self) -> int:
+        (latest,) = self._db.execute(
+            "SELECT COALESCE(MAX(cursor), 0) FROM changes"
+        ).fetchone()
+        return latest
+
+    def registrations(self, contract: str) -> Tuple[int, List[dict]]:
+        """
+        All registrations of the contract and the cursor of the change feed they reflect,
+        i.e. applying the changes after the cursor brings them up to date
+        """
+        self._db.execute("BEGIN")
+        try:
+            (latest,) = self._db.execute(
+                "SELECT COALESCE(MAX(cursor), 0) FROM changes"
+            ).fetchone()
+            registrations = self._query("contract = ?", (contract,))
+        finally:
+            self._db.execute("COMMIT")
+        return latest, registrations
+
+    def by_subject(self, contract: str, key: str) -> List[dict]:
+        return self._query("contract = ? AND subject_key = ?", (contract, key))
+
+    def by_signer(self, contract: str, signer: str) -> List[dict]:
+        return self._query("contract = ? AND signer = ?", (contract, signer))
+
+    def by_policy(self, contract: str, policy_id: str) -> List[dict]:
+        return self._query("contract = ? AND policy_id = ?", (contract, policy_id))
+
+    def by_utxo(self, ref: str, contract: Optional[str] = None) -> List[dict]:
+        if contract is None:
+            return self._query("utxo = ?", (ref,))
+        return self._query("contract = ? AND utxo = ?", (contract, ref))
+
+    def page(
+        self,
+        contract: str,
+        view: str,
+        after: str = "",
+        limit: int = 100,
+        signer: Optional[str] = None,
+        policy_id: Optional[str] = None,
+        metadata_key: Optional[str] = None,
+    ) -> Tuple[List[dict], Optional[str]]:
+        """
+        Up to limit items of the subjects or signers view (see VIEWS) after the given subject key
+        or signer, in the format of the json lists, restricted to the registrations matching
+        all given filters. Returns the items and the key to pass as after for the next page,
+        None if this is the last page.
+        """
+        items, last_key = [], None
+        for key, item in self.items(
+            contract, view, after, signer, policy_id, metadata_key
+        ):
+            if len(items) == limit:
+                return items, last_key
+            items.append(item)
+            last_key = key
+        return items, None
+
+    def items(
+        self,
+        contract: str,
+        view: str,
+        after: str = "",
+        signer: Optional[str] = None,
+        policy_id: Optional[str] = None,
+        metadata_key: Optional[str] = None,
+    ) -> Iterator[Tuple[str, dict]]:
+        """
+        The items of the subjects or signers view (see VIEWS) after the given subject key
+        or signer, each with its key, in the format of the json lists and ordered by key.
+        Only one item is held in memory at a time.
+        """
+        group_column = VIEWS[view]
+        conditions, args = ["contract = ?", f"{group_column} > ?"], [contract, after]
+        if signer is not None:
+            conditions.append("signer = ?")
+            args.append(signer)
+        if policy_id is not None:
+            # the subject keys of the tokens of a policy start with "<policy id>."
+            conditions.append("subject_key >= ? AND subject_key < ?")
+            args += [f"{policy_id}.", f"{policy_id}/"]
+        # within a signer, the subjects are ordered as well
+        order = "subject_key" if view == "subjects" else "signer, subject_key"
+        rows = self._db.execute(
+            f"SELECT {group_column}, subject, signature FROM registrations "
+            f"WHERE {' AND '.join(conditions)} ORDER BY {order}, utxo",
+            args,
+        )
+        item, last_key = None, None
+        for key, subject, signature in rows:
+            signature = json.loads(signature)
+            if metadata_key is not None and metadata_key not in (
+                signature.get("metadata") or {}
+            ):
+                continue
+            if key != last_key:
+                if item is not None:
+                    yield last_key, item
+                last_key = key
+                item = (
+                    {"subject": json.loads(subject), "verifiers": []}
+                    if view == "subjects"
+                    else {"signer": key, "subjects": []}
+                )
+            if view == "subjects":
+                item["verifiers"].append(signature)
+            else:
+                item["subjects"].append(
+                    {"subject": json.loads(subject), "signature": signature}
+                )
+        if item is not None:
+            yield last_key, item
+
+    def subject_keys(self, contract: str) -> Iterator[str]:
+        """
+        The keys of all registered subjects of the contract
+        """
+        return (
+            key
+            for (key,) in self._db.execute(
+                "SELECT DISTINCT subject_key FROM registrations WHERE contract = ?",
+                (contract,),
+            )
+        )
+
+    def _query(self, condition: str, args: tuple) -> List[dict]:
+        return [
+            {
+                "contract": contract,
+                "subject": json.loads(subject),
+                "signature": json.loads(signature),
+            }
+            for contract, subject, signature in self._db.execute(
+                f"SELECT contract, subject, signature FROM registrations WHERE {condition}",
+                args,
+            )
+        ]
+
+
+def _row(contract: str, subject: str, signature: dict) -> tuple:
+    subject_json = json.loads(subject)
+    key = subject_key(subject_json)
+    return (
+        contract,
+        signature["utxo"],
+        json.dumps(subject_json, separators=(",", ":")),
+        key,
+        signature["signer"],
+        key.split(".")[0] if "." in key else None,
+        json.dumps(signature, separators=(",", ":")),
+    )
@@ -0,0 +1,270 @@
+"""
+Resolution of the trust graph spanned by the three registries.
+
+An authority is trusted if it is one of the configured roots or registered in authority_trust
+by a trusted authority. A token is verified if a trusted authority registered it in token_trust
+and no trusted authority registered it in token_mistrust.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from onchain_token_verification.rest.registrations import subject_key
+from onchain_token_verification.rest.store import ADDED, RegistrationStore
+
+_LOGGER = logging.getLogger(__name__)
+
+AUTHORITY_TRUST = "authority_trust"
+TOKEN_TRUST = "token_trust"
+TOKEN_MISTRUST = "token_mistrust"
+TRUST_CONTRACTS = [AUTHORITY_TRUST, TOKEN_TRUST, TOKEN_MISTRUST]
+
+VERIFIED = "verified"
+MISTRUSTED = "mistrusted"
+UNVERIFIED = "unverified"
+
+# number of changes requested from the change feed at once
+SYNC_BATCH = 10_000
+
+
+class TrustGraph:
+    """
+    Keeps the registrations of all three contracts and the set of trusted authorities.
+    Trusted authorities form a tree rooted at the configured roots, each authority pointing
+    to an authority that registered it. Adding a registration only visits the authorities
+    that become trusted through it, removing one only visits the authorities that were
+    trusted through it, so the closure is never recomputed as a whole.
+    Verdicts about tokens are resolved against the trusted authorities on request.
+
+    The graph follows the change feed of a RegistrationStore through sync.
+    """
+
+    def __init__(self, roots: Iterable[str], sync_interval: float = 1):
+        self.roots = set(roots)
+        self.sync_interval = sync_interval
+        self._lock = threading.RLock()
+        self._last_sync = None
+        # contract -> cursor of the change feed up to which changes were applied
+        self._cursors: Dict[str, int] = {}
+        # id of the store the cursors belong to
+        self._store_id: Optional[str] = None
+        # utxo ref -> (contract, subject key, signer)
+        self._registrations: Dict[str, Tuple[str, str, str]] = {}
+        # contract -> subject key -> signer -> utxo refs
+        self._signatures: Dict[str, Dict[str, Dict[str, Set[str]]]] = {
+            contract: {} for contract in TRUST_CONTRACTS
+        }
+        # authority -> authorities registered by it
+        self._registered_by: Dict[str, Set[str]] = defaultdict(set)
+        # trusted authority -> the authority it is trusted through, None for roots
+        self._parent: Dict[str, Optional[str]] = {root: None for root in self.roots}
+        self._children: Dict[str, Set[str]] = defaultdict(set)
+
+    def add(self, contract: str, subject: str, signer: str, utxo: str):
+        """
+        Adds a registration given by the contract, the subject key (see subject_key),
+        the signer and the utxo ref. Adding a known registration has no effect.
+        """
+        if utxo in self._registrations:
+            return
+        self._registrations[utxo] = (contract, subject, signer)
+        utxos = (
+            self._signatures[contract].setdefault(subject, {}).setdefault(signer, set())
+        )
+        utxos.add(utxo)
+        if contract != AUTHORITY_TRUST or len(utxos) > 1:
+            return
+        self._registered_by[signer].add(subject)
+        if signer in self._parent and subject not in self._parent:
+            self._trust([(subject, signer)])
+
+    def remove(self, utxo: str):
+        """
+        Removes the registration at the utxo ref. Removing an unknown registration has no effect.
+        """
+        registration = self._registrations.pop(utxo, None)
+        if registration is None:
+            return
+        contract, subject, signer = registration
+        signers = self._signatures[contract][subject]
+        signers[signer].discard(utxo)
+        if signers[signer]:
+            return
+        del signers[signer]
+        if not signers:
+            del self._signatures[contract][subject]
+        if contract != AUTHORITY_TRUST:
+            return
+        self._registered_by[signer].discard(subject)
+        if not self._registered_by[signer]:
+            del self._registered_by[signer]
+        if subject in self._parent and self._parent[subject] == signer:
+            self._distrust(subject)
+
+    def _trust(self, frontier: List[Tuple[str, str]]):
+        # breadth first search from the newly trusted authorities, given with their parent
+        queue = deque(frontier)
+        while queue:
+            authority, parent = queue.popleft()
+            if authority in self._parent:
+                continue
+            self._parent[authority] = parent
+            self._children[parent].add(authority)
+            for registered in self._registered_by.get(authority, ()):
+                if registered not in self._parent:
+                    queue.append((registered, authority))
+
+    def _distrust(self, authority: str):
+        # drop the subtree of authorities trusted through the given authority
+        self._children[self._parent[authority]].discard(authority)
+        subtree = []
+        stack = [authority]
+        while stack:
+            a = stack.pop()
+            subtree.append(a)
+            del self._parent[a]
+            stack.extend(self._children.pop(a, ()))
+        # and re-attach those that are still registered by a trusted authority
+        frontier = []
+        registrations = self._signatures[AUTHORITY_TRUST]
+        for a in subtree:
+            for signer in registrations.get(a, ()):
+                if signer in self._parent:
+                    frontier.append((a, signer))
+                    break
+        self._trust(frontier)
+        _LOGGER.debug(
+            f"Distrusted {len(subtree)} authorities, {len(subtree) - len(frontier)} not re-attached directly"
+        )
+
+    def is_trusted(self, authority: str) -> bool:
+        return authority in self._parent
+
+    def chain(self, authority: str) -> Optional[List[str]]:
+        """
+        The authorities through which the authority is trusted, starting at a root,
+        None if the authority is not trusted
+        """
+        if authority not in self._parent:
+            return None
+        chain = [authority]
+        while self._parent[chain[-1]] is not None:
+            chain.append(self._parent[chain[-1]])
+        return chain[::-1]
+
+    def _trusted_signatures(
+        self, contract: str, subject: str, chains: dict
+    ) -> List[dict]:
+        signatures = []
+        for signer, utxos in self._signatures[contract].get(subject, {}).items():
+            if signer not in self._parent:
+                continue
+            if signer not in chains:
+                chains[signer] = self.chain(signer)
+            signatures.append(
+                {"signer": signer, "utxos": sorted(utxos), "chain": chains[signer]}
+            )
+        return signatures
+
+    def _verify(self, policy_id: str, token_name: str, chains: dict) -> dict:
+        subject = f"{policy_id}.{token_name}"
+        verified_by = self._trusted_signatures(TOKEN_TRUST, subject, chains)
+        mistrusted_by = self._trusted_signatures(TOKEN_MISTRUST, subject, chains)
+        if mistrusted_by:
+            verdict = MISTRUSTED
+        elif verified_by:
+            verdict = VERIFIED
+        else:
+            verdict = UNVERIFIED
+        return {
+            "policy_id": policy_id,
+            "token_name": token_name,
+            "verdict": verdict,
+            "verified_by": verified_by,
+            "mistrusted_by": mistrusted_by,
+        }
+
+    def verify(self, policy_id: str, token_name: str) -> dict:
+        """
+        The verdict about a token with the trusted signers that justify it
+        """
+        with self._lock:
+            return self._verify(policy_id, token_name, {})
+
+    def verify_many(self, tokens: Iterable[Tuple[str, str]]) -> List[dict]:
+        """
+        The verdicts about many tokens, given as pairs of policy id and token name,
+        resolved against the same state of the graph
+        """
+        # the chains of signers are shared by the verdicts
+        chains = {}
+        with self._lock:
+            return [
+                self._verify(policy_id, token_name, chains)
+                for policy_id, token_name in tokens
+            ]
+
+    def _apply(self, contract: str, change: str, subject: dict, signature: dict):
+        if change == ADDED:
+            self.add(
+                contract, subject_key(subject), signature["signer"], signature["utxo"]
+            )
+        else:
+            self.remove(signature["utxo"])
+
+    def _reload(self, store: RegistrationStore, contract: str):
+        for utxo in [
+            utxo for utxo, (c, _, _) in self._registrations.items() if c == contract
+        ]:
+            self.remove(utxo)
+        cursor, registrations = store.registrations(contract)
+        for registration in registrations:
+            self._apply(
+                contract, ADDED, registration["subject"], registration["signature"]
+            )
+        self._cursors[contract] = cursor
+
+    def sync(self, store: RegistrationStore):
+        """
+        Applies the changes recorded in the store since the last sync,
+        at most once per sync interval
+        """
+        with self._lock:
+            now = time.monotonic()
+            if (
+                self._last_sync is not None
+                and now - self._last_sync < self.sync_interval
+            ):
+                return
+            self._last_sync = now
+            store_id = store.store_id()
+            if store_id != self._store_id:
+                # the store was created again, its cursors started over
+                self._cursors.clear()
+                self._store_id = store_id
+            for contract in TRUST_CONTRACTS:
+                if contract not in self._cursors:
+                    self._reload(store, contract)
+                    continue
+                while True:
+                    cursor, changes = store.changes(
+                        contract, self._cursors[contract], SYNC_BATCH
+                    )
+                    if changes is None:
+                        _LOGGER.info(
+                            f"Changes of {contract} were pruned, reloading its registrations"
+                        )
+                        self._reload(store, contract)
+                        break
+                    for change in changes:
+                        self._apply(
+                            contract,
+                            change["change"],
+                            change["subject"],
+                            change["signature"],
+                        )
+                    self._cursors[contract] = cursor
+                    if len(changes) < SYNC_BATCH:
+                        break
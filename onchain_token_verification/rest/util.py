@@ -1,35 +1,38 @@
 from pathlib import Path
+import importlib
 import os
+import zlib
 
-import opshin
-
-from ..utils import get_contract
+from ..artifacts import contract_artifacts
 
 # path to store temporary data
 # for optimal use, mount in RAM
 DATA_DIR = Path(os.getenv("DATA_DIR", "./data"))
 DATA_DIR.mkdir(exist_ok=True, parents=True)
 
-from ..contracts import (
-    token_mistrust,
-    authority_trust,
-    token_trust,
-)
+# names of the watched contracts, the modules in onchain_token_verification.contracts
+# and the compiled scripts in build/
+CONTRACT_NAMES = [
+    "authority_trust",
+    "token_trust",
+    "token_mistrust",
+]
 
 
-def contract_name(contract):
-    return Path(contract.__file__).stem
+def contract_module(contract_name: str):
+    """
+    The module of the contract, imported on demand as it pulls in opshin
+    """
+    return importlib.import_module(
+        f"onchain_token_verification.contracts.{contract_name}"
+    )
 
 
-CONTRACTS = [
-    authority_trust,
-    token_trust,
-    token_mistrust,
-]
-CONTRACT_ARTIFACTS = [
-    opshin.generate_artifacts(get_contract(contract_name(contract)))
-    for contract in CONTRACTS
-]
+def load_contract_artifacts():
+    """
+    Policy ids and addresses of the contracts by name, from the artifact manifest
+    """
+    return contract_artifacts(CONTRACT_NAMES)
 
 
 FULL_LIST = "subjects"
@@ -37,5 +40,74 @@ SIGNERS = "signers"
 PURPOSES = [FULL_LIST, SIGNERS]
 
 
+# indexed store of all registrations
+STORE_PATH = DATA_DIR / "registrations.sqlite3"
+
+# state of the incremental chain-sync indexer
+CHAINSYNC_CHECKPOINT = DATA_DIR / "chainsync-checkpoint.json"
+
+# event logs and snapshots of the registries for point-in-time queries, one directory per contract
+HISTORY_DIR = DATA_DIR / "history"
+
+# metrics of the querier in the Prometheus text format, served by the server
+QUERIER_METRICS = DATA_DIR / "querier.prom"
+
+# pubkeyhashes (hex encoded, comma separated) of the authorities that are trusted
+# without being registered by another authority, the roots of the trust graph
+TRUSTED_ROOTS = [
+    root.strip().lower()
+    for root in os.getenv("TRUSTED_ROOTS", "").split(",")
+    if root.strip()
+]
+
+
 def contract_data_path(contract_name: str, purpose: str):
     return DATA_DIR / f"{contract_name}-{purpose}.json"
+
+
+def contract_membership_path(contract_name: str):
+    return DATA_DIR / f"{contract_name}-members.bin"
+
+
+def contract_binary_snapshot_path(contract_name: str):
+    return DATA_DIR / f"{contract_name}-snapshot.bin"
+
+
+# content encodings in which snapshots are stored next to the plain file,
+# in order of preference, by file suffix and a factory for streaming compressors
+# (objects with compress(bytes) -> bytes and flush() -> bytes).
+# Snapshots are compressed on every change, so the levels trade some ratio for speed.
+ENCODINGS = {}
+try:
+    import zstandard
+
+    ENCODINGS["zstd"] = (".zst", zstandard.ZstdCompressor(level=10).compressobj)
+except ImportError:
+    pass
+try:
+    import brotli
+
+    class BrotliCompressor:
+        def __init__(self):
+            self._compressor = brotli.Compressor(quality=7)
+
+        def compress(self, data: bytes) -> bytes:
+            return self._compressor.process(data)
+
+        def flush(self) -> bytes:
+            return self._compressor.finish()
+
+    ENCODINGS["br"] = (".br", BrotliCompressor)
+except ImportError:
+    pass
+# wbits=31 produces the gzip container format
+ENCODINGS["gzip"] = (".gz", lambda: zlib.compressobj(9, zlib.DEFLATED, 31))
+
+
+def encoded_path(p: Path, encoding: str) -> Path:
+    return Path(str(p) + ENCODINGS[encoding][0])
+
+
+def etag_path(p: Path) -> Path:
+    # stores the hash of the content of the snapshot
+    return Path(str(p) + ".etag")
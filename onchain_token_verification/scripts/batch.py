@@ -0,0 +1,406 @@
+"""
+Shared tooling of the batch scripts: chaining of transactions, packing of many
+registrations into few transactions and an offline stand-in for the chain context
+"""
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+import cbor2
+from pycardano import (
+    Address,
+    ChainContext,
+    ExecutionUnits,
+    GenesisParameters,
+    MultiAsset,
+    Network,
+    OgmiosChainContext,
+    ProtocolParameters,
+    PyCardanoException,
+    RedeemerTag,
+    Transaction,
+    TransactionBody,
+    TransactionFailedException,
+    TransactionId,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+    Value,
+)
+from pycardano.backend.ogmios import OgmiosQueryType
+
+from onchain_token_verification.contracts import (
+    authority_trust,
+    token_mistrust,
+    token_trust,
+)
+
+# contracts by name
+CONTRACTS = {
+    "authority_trust": authority_trust,
+    "token_trust": token_trust,
+    "token_mistrust": token_mistrust,
+}
+
+# Flat attach 2 ADA to each registration, next to the minted NFT proving signature rights
+REGISTRATION_AMOUNT = 2000000
+
+
+def within_limits(tx: Transaction, protocol_param: ProtocolParameters) -> bool:
+    """
+    Whether the transaction fits into the size and execution unit limits of a transaction
+    """
+    if len(tx.to_cbor()) > protocol_param.max_tx_size:
+        return False
+    redeemers = tx.transaction_witness_set.redeemer or []
+    return (
+        sum(r.ex_units.mem for r in redeemers) <= protocol_param.max_tx_ex_mem
+        and sum(r.ex_units.steps for r in redeemers) <= protocol_param.max_tx_ex_steps
+    )
+
+
+def pack(
+    items: Sequence,
+    build: Callable[[Sequence], Transaction],
+    protocol_param: ProtocolParameters,
+    hint: int = 1,
+) -> Tuple[Transaction, int]:
+    """
+    Builds a transaction from the longest prefix of the items that fits into the limits of a
+    transaction, found by doubling and then bisecting the number of items, starting at the hint
+    (e.g. the number of items that fit into the previous transaction).
+    Returns the transaction and the number of items it contains.
+    """
+
+    def attempt(n: int) -> Optional[Transaction]:
+        try:
+            tx = build(items[:n])
+        except PyCardanoException:
+            # e.g. too large, execution budget exceeded or insufficient funds
+            if n == 1:
+                raise
+            return None
+        if not within_limits(tx, protocol_param):
+            if n == 1:
+                raise TransactionFailedException(
+                    "A single item exceeds the limits of a transaction"
+                )
+            return None
+        return tx
+
+    best, best_n = None, 0
+    # the smallest number of items known not to fit, if any
+    failed_n = None
+    n = max(1, min(hint, len(items)))
+    while failed_n is None:
+        tx = attempt(n)
+        if tx is None:
+            failed_n = n
+        else:
+            best, best_n = tx, n
+            if n == len(items):
+                return best, best_n
+            n = min(2 * n, len(items))
+    while failed_n - best_n > 1:
+        n = (best_n + failed_n) // 2
+        tx = attempt(n)
+        if tx is None:
+            failed_n = n
+        else:
+            best, best_n = tx, n
+    return best, best_n
+
+
+def ogmios_utxo(utxo: UTxO) -> list:
+    """
+    The UTxO in the json format of Ogmios (v5)
+    """
+    value = utxo.output.amount
+    output = {
+        "address": str(utxo.output.address),
+        "value": {
+            "coins": value.coin,
+            "assets": {
+                f"{policy_id.payload.hex()}.{name.payload.hex()}": quantity
+                for policy_id, assets in value.multi_asset.items()
+                for name, quantity in assets.items()
+            },
+        },
+    }
+    if utxo.output.datum_hash is not None:
+        output["datumHash"] = utxo.output.datum_hash.payload.hex()
+    if utxo.output.datum is not None:
+        output["datum"] = utxo.output.datum.to_cbor().hex()
+    return [
+        {"txId": utxo.input.transaction_id.payload.hex(), "index": utxo.input.index},
+        output,
+    ]
+
+
+def pycardano_utxo(ref: str, output: dict) -> UTxO:
+    """
+    The UTxO given its ref (<tx id>#<index>) and output in the json format of Ogmios (v5),
+    the inverse of ogmios_utxo. Datums and scripts are not restored.
+    """
+    tx_id, index = ref.split("#")
+    multi_asset = {}
+    for asset, quantity in output["value"].get("assets", {}).items():
+        # assets with an empty name are identified by the policy id alone
+        policy_id, _, name = asset.partition(".")
+        multi_asset.setdefault(bytes.fromhex(policy_id), {})[
+            bytes.fromhex(name)
+        ] = quantity
+    return UTxO(
+        TransactionInput(TransactionId(bytes.fromhex(tx_id)), int(index)),
+        TransactionOutput(
+            Address.from_primitive(output["address"]),
+            Value(
+                output["value"]["coins"],
+                MultiAsset.from_primitive(multi_asset) if multi_asset else MultiAsset(),
+            ),
+        ),
+    )
+
+
+def decode_transaction(cbor: Union[bytes, str]) -> Tuple[TransactionBody, list]:
+    """
+    The body and the redeemers (as primitives) of a serialized transaction.
+    Only the body is deserialized, as pycardano fails to restore the scripts in the witness set.
+    """
+    if isinstance(cbor, str):
+        cbor = bytes.fromhex(cbor)
+    body, witness_set, *_ = cbor2.loads(cbor)
+    return TransactionBody.from_primitive(body), witness_set.get(5, [])
+
+
+def transaction_outputs(body: TransactionBody) -> List[UTxO]:
+    tx_id = body.hash()
+    return [
+        UTxO(TransactionInput(TransactionId(tx_id), index), output)
+        for index, output in enumerate(body.outputs)
+    ]
+
+
+class ChainedContext(ChainContext):
+    """
+    Wraps a chain context so that transactions built one after the other can spend the
+    outputs (e.g. the change) of previously submitted transactions before they are on chain.
+    The UTxOs of each address are queried only once.
+    With submit=False, transactions are only applied locally (dry run).
+    """
+
+    def __init__(self, context: ChainContext, submit: bool = True):
+        self._context = context
+        self._submit = submit
+        # address -> UTxOs at the address
+        self._cache: Dict[str, Dict[TransactionInput, UTxO]] = {}
+        # UTxOs created by submitted transactions
+        self._pending: Dict[TransactionInput, UTxO] = {}
+        # inputs spent by submitted transactions
+        self._spent: Set[TransactionInput] = set()
+
+    @property
+    def protocol_param(self) -> ProtocolParameters:
+        return self._context.protocol_param
+
+    @property
+    def genesis_param(self) -> GenesisParameters:
+        return self._context.genesis_param
+
+    @property
+    def network(self) -> Network:
+        return self._context.network
+
+    @property
+    def epoch(self) -> int:
+        return self._context.epoch
+
+    @property
+    def last_block_slot(self) -> int:
+        return self._context.last_block_slot
+
+    def _utxos(self, address: str) -> List[UTxO]:
+        if address not in self._cache:
+            self._cache[address] = {
+                utxo.input: utxo for utxo in self._context.utxos(address)
+            }
+        return list(self._cache[address].values())
+
+    def utxo_by_tx_id(self, tx_id: str, index: int) -> Optional[UTxO]:
+        tx_in = TransactionInput(TransactionId(bytes.fromhex(tx_id)), index)
+        if tx_in in self._spent:
+            return None
+        if tx_in in self._pending:
+            return self._pending[tx_in]
+        return self._context.utxo_by_tx_id(tx_id, index)
+
+    def submit_tx_cbor(self, cbor: Union[bytes, str]):
+        if self._submit:
+            self._context.submit_tx_cbor(cbor)
+        body, _ = decode_transaction(cbor)
+        for tx_in in body.inputs:
+            self._spent.add(tx_in)
+            self._pending.pop(tx_in, None)
+            for utxos in self._cache.values():
+                utxos.pop(tx_in, None)
+        for utxo in transaction_outputs(body):
+            self._pending[utxo.input] = utxo
+            address = str(utxo.output.address)
+            if address in self._cache:
+                self._cache[address][utxo.input] = utxo
+
+    def evaluate_tx_cbor(self, cbor: Union[bytes, str]) -> Dict[str, ExecutionUnits]:
+        if not self._pending or not isinstance(self._context, OgmiosChainContext):
+            return self._context.evaluate_tx_cbor(cbor)
+        # the node does not know the outputs of transactions that are not yet on chain
+        if isinstance(cbor, bytes):
+            cbor = cbor.hex()
+        result = self._context._request(
+            OgmiosQueryType.EvaluateTx,
+            {
+                "evaluate": cbor,
+                "additionalUtxoSet": [
+                    ogmios_utxo(utxo) for utxo in self._pending.values()
+                ],
+            },
+        )
+        if "EvaluationResult" not in result:
+            raise TransactionFailedException(result)
+        return {
+            k: ExecutionUnits(v["memory"], v["steps"])
+            for k, v in result["EvaluationResult"].items()
+        }
+
+
+# protocol parameters of the preview network at the time of writing
+OFFLINE_PROTOCOL_PARAMETERS = ProtocolParameters(
+    min_fee_constant=155381,
+    min_fee_coefficient=44,
+    max_block_size=90112,
+    max_tx_size=16384,
+    max_block_header_size=1100,
+    key_deposit=2000000,
+    pool_deposit=500000000,
+    pool_influence=0.3,
+    monetary_expansion=0.003,
+    treasury_expansion=0.2,
+    decentralization_param=0,
+    extra_entropy="",
+    protocol_major_version=8,
+    protocol_minor_version=0,
+    min_utxo=4310,
+    min_pool_cost=340000000,
+    price_mem=0.0577,
+    price_step=0.0000721,
+    max_tx_ex_mem=14000000,
+    max_tx_ex_steps=10000000000,
+    max_block_ex_mem=62000000,
+    max_block_ex_steps=20000000000,
+    max_val_size=5000,
+    collateral_percent=150,
+    max_collateral_inputs=3,
+    coins_per_utxo_word=34482,
+    coins_per_utxo_byte=4310,
+    cost_models={},
+)
+
+
+class OfflineChainContext(ChainContext):
+    """
+    Stand-in for a chain context without a node, e.g. to test the batch scripts.
+    Serves the given UTxOs and applies submitted transactions to them. The execution units of
+    each redeemer are estimated as a base cost plus a cost per input and output of the transaction,
+    as the validators iterate over the outputs of the transaction.
+    """
+
+    def __init__(
+        self,
+        utxos: Iterable[UTxO] = (),
+        protocol_param: ProtocolParameters = OFFLINE_PROTOCOL_PARAMETERS,
+        network: Network = Network.TESTNET,
+        base_ex_units: ExecutionUnits = ExecutionUnits(200000, 60000000),
+        ex_units_per_io: ExecutionUnits = ExecutionUnits(30000, 10000000),
+    ):
+        self.utxo_set: Dict[TransactionInput, UTxO] = {u.input: u for u in utxos}
+        # bodies of the submitted transactions
+        self.submitted: List[TransactionBody] = []
+        self._protocol_param = protocol_param
+        self._network = network
+        self.base_ex_units = base_ex_units
+        self.ex_units_per_io = ex_units_per_io
+
+    @property
+    def protocol_param(self) -> ProtocolParameters:
+        return self._protocol_param
+
+    @property
+    def genesis_param(self) -> GenesisParameters:
+        return GenesisParameters(
+            active_slots_coefficient=0.05,
+            update_quorum=5,
+            max_lovelace_supply=45000000000000000,
+            network_magic=2,
+            epoch_length=86400,
+            system_start=1666656000,
+            slots_per_kes_period=129600,
+            slot_length=1,
+            max_kes_evolutions=62,
+            security_param=432,
+        )
+
+    @property
+    def network(self) -> Network:
+        return self._network
+
+    @property
+    def epoch(self) -> int:
+        return 0
+
+    @property
+    def last_block_slot(self) -> int:
+        return 100000
+
+    def _utxos(self, address: str) -> List[UTxO]:
+        return [
+            utxo
+            for utxo in self.utxo_set.values()
+            if str(utxo.output.address) == address
+        ]
+
+    def utxo_by_tx_id(self, tx_id: str, index: int) -> Optional[UTxO]:
+        return self.utxo_set.get(
+            TransactionInput(TransactionId(bytes.fromhex(tx_id)), index)
+        )
+
+    def add_utxo(self, utxo: UTxO):
+        self.utxo_set[utxo.input] = utxo
+
+    def submit_tx_cbor(self, cbor: Union[bytes, str]):
+        body, _ = decode_transaction(cbor)
+        for tx_in in body.inputs:
+            if tx_in not in self.utxo_set:
+                raise TransactionFailedException(f"Input {tx_in} does not exist")
+        for tx_in in body.inputs:
+            del self.utxo_set[tx_in]
+        for utxo in transaction_outputs(body):
+            self.utxo_set[utxo.input] = utxo
+        self.submitted.append(body)
+
+    def evaluate_tx_cbor(self, cbor: Union[bytes, str]) -> Dict[str, ExecutionUnits]:
+        body, redeemers = decode_transaction(cbor)
+        ios = len(body.inputs) + len(body.outputs)
+        return {
+            f"{RedeemerTag(tag).name.lower()}:{index}": ExecutionUnits(
+                self.base_ex_units.mem + ios * self.ex_units_per_io.mem,
+                self.base_ex_units.steps + ios * self.ex_units_per_io.steps,
+            )
+            for tag, index, *_ in redeemers
+        }
@@ -0,0 +1,492 @@
+"""
+Mints and burns the vouchers of the MuesliSwap pool smart voucher
+(onchain_token_verification/smart_voucher/muesliswap_pool_verifier.py) as pools cross THRESHOLD.
+
+The bot follows the chain through the Ogmios chain-sync protocol and keeps an index of the
+MuesliSwap pools (by pool NFT) and of the UTxOs of its wallet, loaded from the chain context
+when starting without a checkpoint. Once at the tip, it checks the pools that changed: it mints
+a voucher for every pool with at least THRESHOLD lovelace for which the wallet holds none and
+burns the voucher of every pool below the threshold.
+
+The policy validates a single pool, the one referenced by the redeemer, and allows only one
+minted voucher per transaction, so every transaction mints or burns the voucher of one pool.
+All transactions due at a block are submitted at once, each spending its own UTxOs.
+The policy requires the minted voucher in the only output not at the vouching address,
+so it ends up in the change output, together with the rest of the spent UTxO. Minting
+therefore spends the smallest UTxO of the wallet covering it, burning releases it again.
+Submitted transactions are remembered until they appear on chain or their ttl passed,
+so that no pool is handled twice in the meantime.
+"""
+import logging
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Collection, Dict, List, Optional, Set, Tuple
+
+import click
+from pycardano import (
+    Address,
+    ChainContext,
+    MultiAsset,
+    OgmiosChainContext,
+    PaymentSigningKey,
+    PaymentVerificationKey,
+    PlutusV2Script,
+    Redeemer,
+    ScriptHash,
+    Transaction,
+    TransactionBuilder,
+    TransactionId,
+    TransactionInput,
+    UTxO,
+    plutus_script_hash,
+)
+
+from onchain_token_verification.rest.chainsync import (
+    ORIGIN,
+    SECURITY_PARAMETER,
+    ChainIndexer,
+    OgmiosChainSync,
+    Point,
+    ReplayChainSync,
+    block_transactions,
+    follow,
+    parse_point,
+    transaction_changes,
+)
+from onchain_token_verification.rest.registrations import utxo_ref
+from onchain_token_verification.rest.snapshot import atomic_dump, encode_json
+from onchain_token_verification.rest.util import DATA_DIR
+from onchain_token_verification.scripts.batch import ogmios_utxo, pycardano_utxo
+from onchain_token_verification.smart_voucher.muesliswap_pool_verifier import (
+    POOL_NFT_POLICYID,
+    POOL_SCRIPT_HASH,
+    THRESHOLD,
+    BurnRedeemer,
+    MintRedeemer,
+)
+from onchain_token_verification.utils import (
+    get_contract,
+    get_signing_info,
+    network,
+    ogmios_url,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# name of the compiled voucher policy in build/
+POOL_VERIFIER = "muesliswap_pool_verifier"
+# state of the bot, to resume following the chain after a restart
+CHECKPOINT = DATA_DIR / "pool-voucher-checkpoint.json"
+# Only UTxOs with at least this many lovelace fund a mint, the voucher keeps the rest
+# of the UTxO, which has to cover the fee and collateral of burning it again
+MIN_FUNDING = 10_000_000
+# number of slots after which a submitted transaction is given up if it is not on chain
+TTL = 600
+
+# assets are keyed by <policy id>.<token name hex> in the Ogmios json format
+POOL_NFT_PREFIX = POOL_NFT_POLICYID.hex() + "."
+POOLS = "pools"
+WALLET = "wallet"
+
+
+def pool_nft(output: dict) -> Optional[str]:
+    """
+    The hex encoded name of the pool NFT if the output (in the Ogmios json format)
+    is a MuesliSwap pool and None otherwise
+    """
+    names = [
+        asset[len(POOL_NFT_PREFIX) :]
+        for asset in output["value"].get("assets", {})
+        if asset.startswith(POOL_NFT_PREFIX)
+    ]
+    if not names:
+        return None
+    # only decoded for outputs holding a pool NFT, as this is comparatively slow
+    address = Address.from_primitive(output["address"])
+    if address.payment_part.payload != POOL_SCRIPT_HASH:
+        return None
+    # the validator takes the first token name of the policy, the value is ordered by name
+    # (the order of the hex encoded names is the same)
+    return min(names)
+
+
+def transaction_input(ref: str) -> TransactionInput:
+    tx_id, index = ref.split("#")
+    return TransactionInput(TransactionId(bytes.fromhex(tx_id)), int(index))
+
+
+class PoolIndexer(ChainIndexer):
+    """
+    Maintains the MuesliSwap pools (pool NFT name -> [utxo ref, lovelace]) and the UTxOs at
+    the wallet address (utxo ref -> output in the Ogmios json format)
+    """
+
+    def __init__(self, wallet_address: str, max_rollback: int = SECURITY_PARAMETER):
+        super().__init__(max_rollback)
+        self.wallet_address = wallet_address
+        self.pools: Dict[str, list] = {}
+        self.wallet: Dict[str, dict] = {}
+        # utxo ref -> name of the pool NFT it holds
+        self._pool_refs: Dict[str, str] = {}
+        # names of the pool NFTs whose pool changed since the last call of pop_changed
+        self._changed: Set[str] = set()
+
+    def _set_pool(self, nft: str, pool: Optional[list]) -> Optional[list]:
+        previous = self.pools.pop(nft, None)
+        if previous is not None:
+            del self._pool_refs[previous[0]]
+        if pool is not None:
+            self.pools[nft] = pool
+            self._pool_refs[pool[0]] = nft
+        self._changed.add(nft)
+        return previous
+
+    def _set_wallet(self, ref: str, output: Optional[dict]) -> Optional[dict]:
+        previous = self.wallet.pop(ref, None)
+        if output is not None:
+            self.wallet[ref] = output
+        return previous
+
+    def apply_block(self, point: dict, block: dict) -> list:
+        undo = []
+        for tx in block_transactions(block):
+            spent, created = transaction_changes(tx)
+            for tx_in in spent:
+                ref = utxo_ref(tx_in["txId"], tx_in["index"])
+                if ref in self._pool_refs:
+                    nft = self._pool_refs[ref]
+                    undo.append((POOLS, nft, self._set_pool(nft, None)))
+                if ref in self.wallet:
+                    undo.append((WALLET, ref, self._set_wallet(ref, None)))
+            for index, output in created:
+                undo += self.add_output(utxo_ref(tx["id"], index), output)
+        return undo
+
+    def add_output(self, ref: str, output: dict) -> list:
+        """
+        Indexes the output if it is a pool or at the wallet address,
+        returns the operations undoing this
+        """
+        undo = []
+        if output["address"] == self.wallet_address:
+            undo.append((WALLET, ref, self._set_wallet(ref, output)))
+        nft = pool_nft(output)
+        if nft is not None:
+            pool = [ref, output["value"]["coins"]]
+            undo.append((POOLS, nft, self._set_pool(nft, pool)))
+        return undo
+
+    def undo(self, operation: tuple):
+        kind, key, previous = operation
+        if kind == POOLS:
+            self._set_pool(key, previous)
+        else:
+            self._set_wallet(key, previous)
+
+    def clear(self):
+        self._changed.update(self.pools)
+        self.pools.clear()
+        self._pool_refs.clear()
+        self.wallet.clear()
+
+    def pop_changed(self) -> Set[str]:
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def checkpoint(self) -> dict:
+        return {**super().checkpoint(), "pools": self.pools, "wallet": self.wallet}
+
+    def restore(self, checkpoint: dict):
+        super().restore(checkpoint)
+        self.pools = {}
+        self._pool_refs = {}
+        for nft, pool in checkpoint["pools"].items():
+            self._set_pool(nft, pool)
+        self.wallet = checkpoint["wallet"]
+
+
+@dataclass
+class PendingTransaction:
+    # hex encoded name of the pool NFT whose voucher is minted (1) or burned (-1)
+    pool: str
+    minted: int
+    # last slot in which the transaction can be included in a block
+    ttl: int
+    # refs of the spent UTxOs of the wallet
+    spent: List[str]
+
+
+class VoucherBot:
+    """
+    Mints and burns the vouchers of the pools in the index, signed with the given key.
+    With submit=False, the transactions are only built and signed (dry run).
+    """
+
+    def __init__(
+        self,
+        context: ChainContext,
+        contract: PlutusV2Script,
+        payment_skey: PaymentSigningKey,
+        min_funding: int = MIN_FUNDING,
+        ttl: int = TTL,
+        submit: bool = True,
+    ):
+        self.context = context
+        self.contract = contract
+        self.policy_id = plutus_script_hash(contract)
+        self.payment_skey = payment_skey
+        payment_vkey = PaymentVerificationKey.from_signing_key(payment_skey)
+        self.address = Address(payment_vkey.hash(), network=context.network)
+        self.indexer = PoolIndexer(str(self.address))
+        self.min_funding = min_funding
+        self.ttl = ttl
+        self.submit = submit
+        # submitted transactions that are not yet on chain, by id
+        self.pending: Dict[str, PendingTransaction] = {}
+        # pools to check again, e.g. after their pending transaction was resolved
+        self._recheck: Set[str] = set()
+
+    @property
+    def point(self) -> Point:
+        return self.indexer.point
+
+    def intersection_points(self) -> List[Point]:
+        return self.indexer.intersection_points()
+
+    def resume(self, point: Point, restored: bool):
+        self.indexer.resume(point, restored)
+        if restored:
+            return
+        # the index only sees the blocks after the start point, so the wallet and the pools
+        # (at the pool address without stake part) are loaded from the chain context.
+        # Outputs that the following blocks create or spend again are indexed or removed again.
+        pool_address = Address(
+            ScriptHash(POOL_SCRIPT_HASH), network=self.context.network
+        )
+        for address in (self.address, pool_address):
+            for utxo in self.context.utxos(address):
+                tx_in, output = ogmios_utxo(utxo)
+                self.indexer.add_output(utxo_ref(tx_in["txId"], tx_in["index"]), output)
+
+    def roll_forward(self, block: dict):
+        self.indexer.roll_forward(block)
+        slot = self.indexer.point["slot"]
+        for tx in block_transactions(block):
+            if tx["id"] in self.pending:
+                self._recheck.add(self.pending.pop(tx["id"]).pool)
+        for tx_id, pending in list(self.pending.items()):
+            if pending.ttl < slot:
+                _LOGGER.warning(f"Transaction {tx_id} expired without being included")
+                self._recheck.add(self.pending.pop(tx_id).pool)
+
+    def roll_backward(self, point: Point):
+        self.indexer.roll_backward(point)
+
+    def wallet_utxos(self) -> List[UTxO]:
+        """
+        UTxOs of the wallet on chain that are not spent by pending transactions
+        """
+        spent = {ref for pending in self.pending.values() for ref in pending.spent}
+        return [
+            pycardano_utxo(ref, output)
+            for ref, output in self.indexer.wallet.items()
+            if ref not in spent
+        ]
+
+    def _vouchers(self, utxo: UTxO) -> Dict[str, int]:
+        assets = utxo.output.amount.multi_asset.get(self.policy_id, {})
+        return {name.payload.hex(): quantity for name, quantity in assets.items()}
+
+    def due(self, pools: Collection[str]) -> List[Tuple[str, int]]:
+        """
+        The pools among the given ones whose voucher needs to be minted (1) or burned (-1),
+        burns first as they release funds
+        """
+        held: Dict[str, int] = {}
+        for utxo in self.wallet_utxos():
+            for name, quantity in self._vouchers(utxo).items():
+                held[name] = held.get(name, 0) + quantity
+        in_flight = {pending.pool for pending in self.pending.values()}
+        due = []
+        for nft in sorted(pools):
+            if nft in in_flight:
+                continue
+            pool = self.indexer.pools.get(nft)
+            if pool is None:
+                if held.get(nft, 0) > 0:
+                    _LOGGER.warning(
+                        f"Pool {nft} does not exist anymore, its voucher can not be burned"
+                    )
+            elif pool[1] >= THRESHOLD and held.get(nft, 0) == 0:
+                due.append((nft, 1))
+            elif pool[1] < THRESHOLD and held.get(nft, 0) > 0:
+                due.append((nft, -1))
+        return sorted(due, key=lambda d: d[1])
+
+    def _build(
+        self, nft: str, minted: int, spent: UTxO
+    ) -> Tuple[Transaction, PendingTransaction]:
+        pool_input = transaction_input(self.indexer.pools[nft][0])
+        builder = TransactionBuilder(self.context)
+        builder.add_input(spent)
+        builder.reference_inputs.add(pool_input)
+        # the script is attached to the transaction, so the pool is the only reference input
+        builder.add_minting_script(
+            script=self.contract,
+            redeemer=Redeemer(MintRedeemer(0) if minted > 0 else BurnRedeemer(0)),
+        )
+        builder.mint = MultiAsset.from_primitive(
+            {bytes(self.policy_id): {bytes.fromhex(nft): minted}}
+        )
+        builder.ttl = self.context.last_block_slot + self.ttl
+        signed_tx = builder.build_and_sign(
+            signing_keys=[self.payment_skey],
+            change_address=self.address,
+        )
+        spent_ref = utxo_ref(
+            spent.input.transaction_id.payload.hex(), spent.input.index
+        )
+        pending = PendingTransaction(nft, minted, builder.ttl, [spent_ref])
+        return signed_tx, pending
+
+    def mint(self, nft: str) -> Tuple[Transaction, PendingTransaction]:
+        """
+        Mints the voucher of the pool into the change output of the smallest UTxO of the wallet
+        with at least min_funding lovelace and without vouchers
+        """
+        funding = [
+            utxo
+            for utxo in self.wallet_utxos()
+            if utxo.output.amount.coin >= self.min_funding and not self._vouchers(utxo)
+        ]
+        if not funding:
+            raise ValueError(
+                f"No UTxO at {self.address} with at least {self.min_funding} lovelace "
+                f"and without vouchers to mint the voucher of pool {nft}"
+            )
+        return self._build(nft, 1, min(funding, key=lambda u: u.output.amount.coin))
+
+    def burn(self, nft: str) -> Tuple[Transaction, PendingTransaction]:
+        """
+        Burns the voucher of the pool, spending the UTxO of the wallet holding it
+        """
+        # no output may hold a voucher, so the spent UTxO must not hold any other
+        for utxo in self.wallet_utxos():
+            if self._vouchers(utxo) == {nft: 1}:
+                return self._build(nft, -1, utxo)
+        raise ValueError(f"No UTxO at {self.address} holds only the voucher of {nft}")
+
+    def act(self) -> List[Transaction]:
+        """
+        Mints and burns the vouchers of the pools that changed, returns the submitted transactions
+        """
+        pools = self.indexer.pop_changed() | self._recheck
+        self._recheck = set()
+        submitted = []
+        for nft, minted in self.due(pools):
+            try:
+                signed_tx, pending = self.mint(nft) if minted > 0 else self.burn(nft)
+                if self.submit:
+                    self.context.submit_tx(signed_tx.to_cbor())
+            except Exception as e:
+                _LOGGER.error(
+                    f"Could not {'mint' if minted > 0 else 'burn'} the voucher of pool {nft}",
+                    exc_info=e,
+                )
+                # retried after the next block
+                self._recheck.add(nft)
+                continue
+            self.pending[str(signed_tx.id)] = pending
+            submitted.append(signed_tx)
+            _LOGGER.info(
+                f"{'Minted' if minted > 0 else 'Burned'} the voucher of pool {nft} "
+                f"in transaction {signed_tx.id}"
+            )
+        return submitted
+
+    def checkpoint(self) -> dict:
+        return {
+            "index": self.indexer.checkpoint(),
+            "pending": {tx_id: asdict(p) for tx_id, p in self.pending.items()},
+            "recheck": sorted(self._recheck),
+        }
+
+    def restore(self, checkpoint: dict):
+        self.indexer.restore(checkpoint["index"])
+        self.pending = {
+            tx_id: PendingTransaction(**p) for tx_id, p in checkpoint["pending"].items()
+        }
+        # the pools may have crossed the threshold before the bot stopped
+        self._recheck = set(checkpoint["recheck"]) | set(self.indexer.pools)
+
+
+def follow_chain(
+    chain_sync,
+    bot: VoucherBot,
+    checkpoint_path: Path,
+    start: Point = ORIGIN,
+    flush_every: int = 1000,
+):
+    """
+    Applies the blocks of the chain to the index, starting from the last checkpoint or the
+    given start point, and mints and burns vouchers whenever the tip of the chain is reached
+    """
+
+    def flush(at_tip: bool):
+        # pools are only acted upon at the tip, where their UTxOs can be referenced
+        if at_tip:
+            bot.act()
+        atomic_dump(encode_json(bot.checkpoint()), checkpoint_path)
+
+    follow(
+        chain_sync, bot, checkpoint_path, flush, start=start, flush_every=flush_every
+    )
+
+
+@click.command()
+@click.argument("signer_key")
+@click.option(
+    "--start",
+    default=ORIGIN,
+    help="Point (<slot>.<block hash>) to start following the chain from if there is no checkpoint",
+)
+@click.option(
+    "--min-funding",
+    default=MIN_FUNDING,
+    help="Minimum lovelace of the UTxO spent to mint a voucher",
+)
+@click.option(
+    "--replay",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Replay recorded chain-sync messages from this file instead of connecting to Ogmios",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Build and sign the transactions without submitting them",
+)
+def main(
+    signer_key: str,
+    start: str,
+    min_funding: int,
+    replay: Optional[Path],
+    dry_run: bool,
+):
+    logging.basicConfig(level=logging.INFO)
+    context = OgmiosChainContext(ogmios_url, network=network)
+    _, payment_skey, _ = get_signing_info(signer_key)
+    bot = VoucherBot(
+        context,
+        get_contract(POOL_VERIFIER),
+        payment_skey,
+        min_funding=min_funding,
+        submit=not dry_run,
+    )
+    chain_sync = (
+        ReplayChainSync(replay) if replay is not None else OgmiosChainSync(ogmios_url)
+    )
+    follow_chain(chain_sync, bot, CHECKPOINT, start=parse_point(start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Registers many subjects at once, signed with the given key.
+
+Registrations are read from a file with one json object per line, either
+{"contract": "token_trust" | "token_mistrust", "policy_id": ..., "token_name": ..., "metadata": {...}}
+or {"contract": "authority_trust", "authority": <pubkeyhash>, "metadata": {...}},
+where the metadata is optional and maps names to strings or integers.
+As many registrations as fit are minted in each transaction, each transaction
+spending the change of the previous one.
+"""
+import json
+from typing import List
+
+import click
+from opshin.ledger.api_v2 import Nothing
+from pycardano import (
+    OgmiosChainContext,
+    Address,
+    TransactionBuilder,
+    TransactionOutput,
+    plutus_script_hash,
+    Redeemer,
+    MultiAsset,
+    Value,
+    PlutusV2Script,
+    ChainContext,
+    PaymentSigningKey,
+    PaymentVerificationKey,
+)
+
+from onchain_token_verification.contracts.cip68 import CIP68Datum
+from onchain_token_verification.scripts.batch import (
+    CONTRACTS,
+    REGISTRATION_AMOUNT,
+    ChainedContext,
+    pack,
+)
+from onchain_token_verification.utils import (
+    get_signing_info,
+    network,
+    ogmios_url,
+    get_contract,
+)
+
+
+def registration_datum(entry: dict, signer: bytes):
+    contract = CONTRACTS[entry["contract"]]
+    metadata = entry.get("metadata")
+    if metadata is not None:
+        metadata = CIP68Datum(
+            metadata={
+                k.encode("utf8"): v.encode("utf8") if isinstance(v, str) else v
+                for k, v in metadata.items()
+            },
+            version=1,
+            extra=Nothing(),
+        )
+    else:
+        metadata = Nothing()
+    if entry["contract"] == "authority_trust":
+        subject = bytes.fromhex(entry["authority"])
+    else:
+        subject = contract.Token(
+            bytes.fromhex(entry["policy_id"]), bytes.fromhex(entry["token_name"])
+        )
+    return contract.Registration(subject, signer, metadata)
+
+
+def read_registrations(path: str) -> List[dict]:
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    for i, entry in enumerate(entries):
+        if entry.get("contract") not in CONTRACTS:
+            raise click.BadParameter(
+                f"line {i + 1}: unknown contract {entry.get('contract')}"
+            )
+    return entries
+
+
+def register(
+    context: ChainContext,
+    contract_name: str,
+    contract: PlutusV2Script,
+    entries: List[dict],
+    payment_skey: PaymentSigningKey,
+):
+    """
+    Registers the entries at the given contract in as few transactions as possible,
+    returns the signed transactions
+    """
+    contract_hash = plutus_script_hash(contract)
+    contract_address = Address(contract_hash, network=context.network)
+    token_name = CONTRACTS[contract_name].TOKENNAME
+    payment_vkey = PaymentVerificationKey.from_signing_key(payment_skey)
+    payment_address = Address(payment_vkey.hash(), network=context.network)
+    signer = payment_vkey.hash().to_primitive()
+    datums = [registration_datum(entry, signer) for entry in entries]
+
+    def build(chunk):
+        builder = TransactionBuilder(context)
+        builder.add_input_address(payment_address)
+        builder.add_minting_script(
+            script=contract,
+            redeemer=Redeemer(CONTRACTS[contract_name].NoRedeemer()),
+        )
+        builder.mint = MultiAsset.from_primitive(
+            {bytes(contract_hash): {token_name: len(chunk)}}
+        )
+        token = MultiAsset.from_primitive({bytes(contract_hash): {token_name: 1}})
+        for datum in chunk:
+            builder.add_output(
+                TransactionOutput(
+                    address=contract_address,
+                    amount=Value(coin=REGISTRATION_AMOUNT, multi_asset=token),
+                    datum=datum,
+                )
+            )
+        builder.required_signers = [payment_vkey.hash()]
+        return builder.build_and_sign(
+            signing_keys=[payment_skey],
+            change_address=payment_address,
+        )
+
+    signed_txs = []
+    n = 1
+    while datums:
+        signed_tx, n = pack(datums, build, context.protocol_param, hint=n)
+        context.submit_tx(signed_tx.to_cbor())
+        signed_txs.append(signed_tx)
+        datums = datums[n:]
+        print(f"{contract_name}: registered {n} in transaction {signed_tx.id}")
+    return signed_txs
+
+
+@click.command()
+@click.argument("signer_key")
+@click.argument("registrations", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Build and sign the transactions without submitting them",
+)
+def main(signer_key: str, registrations: str, dry_run: bool):
+    # Load chain context, chaining the transactions on top of each other
+    context = ChainedContext(
+        OgmiosChainContext(ogmios_url, network=network), submit=not dry_run
+    )
+
+    entries = read_registrations(registrations)
+    _, payment_skey, _ = get_signing_info(signer_key)
+    signed_txs = []
+    for contract_name in CONTRACTS:
+        contract_entries = [e for e in entries if e["contract"] == contract_name]
+        if not contract_entries:
+            continue
+        signed_txs.extend(
+            register(
+                context,
+                contract_name,
+                get_contract(contract_name),
+                contract_entries,
+                payment_skey,
+            )
+        )
+
+    print(f"{len(entries)} registrations in {len(signed_txs)} transactions")
+    for signed_tx in signed_txs:
+        print(f"Cardanoscan: https://preview.cardanoscan.io/transaction/{signed_tx.id}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Withdraws many registrations signed with the given key at once, e.g. after a key compromise.
+
+All registrations of the signer at the three contracts are looked up in the store of the
+querier (--store) or, without a store, found in one pass over each contract address.
+Optionally, only the subjects listed in a file are withdrawn, one json object per line in
+the format of register_batch (metadata is ignored).
+As many registrations as fit are spent and their tokens burned in each transaction,
+each transaction spending the change of the previous one.
+"""
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import click
+from pycardano import (
+    OgmiosChainContext,
+    Address,
+    TransactionBuilder,
+    plutus_script_hash,
+    Redeemer,
+    MultiAsset,
+    PlutusV2Script,
+    ChainContext,
+    PaymentSigningKey,
+    PaymentVerificationKey,
+    RawCBOR,
+    UTxO,
+    AssetName,
+    ScriptHash,
+)
+
+from onchain_token_verification.rest.registrations import split_registration
+from onchain_token_verification.rest.store import RegistrationStore
+from onchain_token_verification.scripts.batch import (
+    CONTRACTS,
+    ChainedContext,
+    pack,
+)
+from onchain_token_verification.utils import (
+    get_signing_info,
+    network,
+    ogmios_url,
+    get_contract,
+)
+
+
+def subject_of(contract_name: str, registration) -> str:
+    """
+    Key of the subject of a registration, <policy id>.<token name> for tokens,
+    the pubkeyhash for authorities (all hex encoded)
+    """
+    if contract_name == "authority_trust":
+        return registration.subject.hex()
+    return f"{registration.subject.policy_id.hex()}.{registration.subject.token_name.hex()}"
+
+
+def read_subjects(path: str) -> Set[Tuple[str, str]]:
+    """
+    The contract names and subject keys listed in the file
+    """
+    subjects = set()
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            contract_name = entry.get("contract")
+            if contract_name not in CONTRACTS:
+                raise click.BadParameter(
+                    f"line {i + 1}: unknown contract {contract_name}"
+                )
+            if contract_name == "authority_trust":
+                subject = entry["authority"].lower()
+            else:
+                subject = f"{entry['policy_id']}.{entry['token_name']}".lower()
+            subjects.add((contract_name, subject))
+    return subjects
+
+
+def find_registrations(
+    context: ChainContext,
+    contracts: Dict[str, PlutusV2Script],
+    signer: bytes,
+    subjects: Optional[Set[Tuple[str, str]]] = None,
+    store: Optional[RegistrationStore] = None,
+) -> Dict[str, List[UTxO]]:
+    """
+    The UTxOs holding registrations of the signer (restricted to the given subjects, if any),
+    by contract name. With a store, they are looked up in its indexes, otherwise each contract
+    address is queried once, contracts sharing an address are resolved by the shape of the datum.
+    """
+    if store is not None:
+        return lookup_registrations(context, store, contracts, signer, subjects)
+    # address -> names of the contracts at the address
+    by_address: Dict[str, List[str]] = {}
+    for contract_name, contract in contracts.items():
+        address = str(Address(plutus_script_hash(contract), network=context.network))
+        by_address.setdefault(address, []).append(contract_name)
+
+    found = {contract_name: [] for contract_name in contracts}
+    for address, contract_names in by_address.items():
+        for utxo in context.utxos(address):
+            datum = utxo.output.datum
+            if datum is None:
+                # registrations with datum hashes need their datum, which the node does not provide
+                continue
+            cbor = datum.cbor if isinstance(datum, RawCBOR) else datum.to_cbor()
+            for contract_name in contract_names:
+                split = split_registration(cbor, CONTRACTS[contract_name].Registration)
+                if split is None:
+                    continue
+                registration, _ = split
+                if registration.signer != signer:
+                    break
+                if (
+                    subjects is not None
+                    and (contract_name, subject_of(contract_name, registration))
+                    not in subjects
+                ):
+                    break
+                found[contract_name].append(utxo)
+                break
+    return found
+
+
+def lookup_registrations(
+    context: ChainContext,
+    store: RegistrationStore,
+    contract_names: Iterable[str],
+    signer: bytes,
+    subjects: Optional[Set[Tuple[str, str]]] = None,
+) -> Dict[str, List[UTxO]]:
+    """
+    The UTxOs holding registrations of the signer (restricted to the given subjects, if any),
+    by contract name, as indexed in the store of the querier.
+    Registrations spent since the store was updated are skipped, those created since are missed.
+    """
+    signer_hex = signer.hex()
+    found = {}
+    for contract_name in contract_names:
+        if subjects is None:
+            entries = store.by_signer(contract_name, signer_hex)
+        else:
+            entries = [
+                entry
+                for name, key in sorted(subjects)
+                if name == contract_name
+                for entry in store.by_subject(contract_name, key)
+                if entry["signature"]["signer"] == signer_hex
+            ]
+        found[contract_name] = []
+        for entry in entries:
+            tx_id, index = entry["signature"]["utxo"].split("#")
+            utxo = context.utxo_by_tx_id(tx_id, int(index))
+            if utxo is not None:
+                found[contract_name].append(utxo)
+    return found
+
+
+def withdraw(
+    context: ChainContext,
+    contract_name: str,
+    contract: PlutusV2Script,
+    utxos: List[UTxO],
+    payment_skey: PaymentSigningKey,
+):
+    """
+    Spends the registrations at the given contract and burns their tokens in as few
+    transactions as possible, returns the signed transactions
+    """
+    contract_hash = plutus_script_hash(contract)
+    token_name = AssetName(CONTRACTS[contract_name].TOKENNAME)
+    no_redeemer = CONTRACTS[contract_name].NoRedeemer
+    payment_vkey = PaymentVerificationKey.from_signing_key(payment_skey)
+    payment_address = Address(payment_vkey.hash(), network=context.network)
+
+    def build(chunk):
+        builder = TransactionBuilder(context)
+        builder.add_input_address(payment_address)
+        burned = 0
+        for utxo in chunk:
+            builder.add_script_input(utxo, contract, redeemer=Redeemer(no_redeemer()))
+            burned += utxo.output.amount.multi_asset.get(contract_hash, {}).get(
+                token_name, 0
+            )
+        if burned:
+            builder.add_minting_script(
+                script=contract,
+                redeemer=Redeemer(no_redeemer()),
+            )
+            builder.mint = MultiAsset.from_primitive(
+                {bytes(contract_hash): {token_name.payload: -burned}}
+            )
+        builder.required_signers = [payment_vkey.hash()]
+        return builder.build_and_sign(
+            signing_keys=[payment_skey],
+            change_address=payment_address,
+        )
+
+    signed_txs = []
+    n = 1
+    while utxos:
+        signed_tx, n = pack(utxos, build, context.protocol_param, hint=n)
+        context.submit_tx(signed_tx.to_cbor())
+        signed_txs.append(signed_tx)
+        utxos = utxos[n:]
+        print(f"{contract_name}: withdrew {n} in transaction {signed_tx.id}")
+    return signed_txs
+
+
+@click.command()
+@click.argument("signer_key")
+@click.option(
+    "--subjects",
+    type=click.Path(exists=True, dir_okay=False),
+    help="File of the subjects to withdraw, all registrations of the signer by default",
+)
+@click.option(
+    "--contract",
+    "contract_names",
+    type=click.Choice(list(CONTRACTS)),
+    multiple=True,
+    help="Contracts to withdraw from, all by default",
+)
+@click.option(
+    "--store",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Store of the querier (registrations.sqlite3 in its data directory) to look up "
+    "the registrations in, instead of scanning the contract addresses",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Build and sign the transactions without submitting them",
+)
+def main(
+    signer_key: str,
+    subjects: Optional[str],
+    contract_names: Tuple[str],
+    store: Optional[str],
+    dry_run: bool,
+):
+    # Load chain context, chaining the transactions on top of each other
+    context = ChainedContext(
+        OgmiosChainContext(ogmios_url, network=network), submit=not dry_run
+    )
+
+    contracts = {name: get_contract(name) for name in contract_names or CONTRACTS}
+    payment_vkey, payment_skey, _ = get_signing_info(signer_key)
+    found = find_registrations(
+        context,
+        contracts,
+        payment_vkey.hash().to_primitive(),
+        read_subjects(subjects) if subjects is not None else None,
+        RegistrationStore(Path(store), readonly=True) if store is not None else None,
+    )
+
+    # contracts sharing a script (authority_trust and token_trust) are withdrawn from together
+    by_script: Dict[ScriptHash, Tuple[str, List[UTxO]]] = {}
+    for contract_name, utxos in found.items():
+        contract_hash = plutus_script_hash(contracts[contract_name])
+        by_script.setdefault(contract_hash, (contract_name, []))[1].extend(utxos)
+
+    signed_txs = []
+    for contract_name, utxos in by_script.values():
+        if not utxos:
+            continue
+        signed_txs.extend(
+            withdraw(
+                context, contract_name, contracts[contract_name], utxos, payment_skey
+            )
+        )
+
+    print(
+        f"{sum(map(len, found.values()))} registrations in {len(signed_txs)} transactions"
+    )
+    for signed_tx in signed_txs:
+        print(f"Cardanoscan: https://preview.cardanoscan.io/transaction/{signed_tx.id}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import json
+
+import pytest
+from opshin.ledger.api_v2 import Nothing
+
+from onchain_token_verification.contracts import authority_trust, token_trust
+from onchain_token_verification.rest import querier, util
+from onchain_token_verification.rest.chainsync import (
+    ReplayChainSync,
+    RegistryIndexer,
+    WatchedContract,
+    block_point,
+)
+from onchain_token_verification.rest.store import RegistrationStore
+
+TOKEN_TRUST = WatchedContract(
+    name="token_trust",
+    address="addr_test1wztokentrust",
+    asset=f"{'ab' * 28}.{token_trust.TOKENNAME.hex()}",
+    registration_class=token_trust.Registration,
+)
+AUTHORITY_TRUST = WatchedContract(
+    name="authority_trust",
+    address="addr_test1wzauthoritytrust",
+    asset=f"{'cd' * 28}.{authority_trust.TOKENNAME.hex()}",
+    registration_class=authority_trust.Registration,
+)
+SIGNER = b"\x02" * 28
+
+
+def token_output(name: bytes, contract: WatchedContract = TOKEN_TRUST) -> dict:
+    datum = token_trust.Registration(
+        token_trust.Token(b"\x01" * 28, name), SIGNER, Nothing()
+    )
+    return output(datum.to_cbor().hex(), contract)
+
+
+def authority_output(authority: bytes) -> dict:
+    datum = authority_trust.Registration(authority, SIGNER, Nothing())
+    return output(datum.to_cbor().hex(), AUTHORITY_TRUST)
+
+
+def output(datum: str, contract: WatchedContract) -> dict:
+    return {
+        "address": contract.address,
+        "value": {"coins": 2_000_000, "assets": {contract.asset: 1}},
+        "datumHash": None,
+        "datum": datum,
+    }
+
+
+def tx(tx_id: str, outputs: list, inputs=()) -> dict:
+    return {
+        "id": tx_id,
+        "inputSource": "inputs",
+        "body": {
+            "inputs": [{"txId": i, "index": index} for i, index in inputs],
+            "outputs": outputs,
+        },
+    }
+
+
+def forward(slot: int, txs: list) -> dict:
+    block = {
+        "babbage": {"header": {"slot": slot}, "headerHash": "%064x" % slot, "body": txs}
+    }
+    return {"RollForward": {"block": block, "tip": block_point(block)}}
+
+
+def backward(slot: int) -> dict:
+    point = {"slot": slot, "hash": "%064x" % slot}
+    return {"RollBackward": {"point": point, "tip": point}}
+
+
+# registers two tokens and an authority, then replaces the first token
+# and registers a token at the wrong contract address
+MESSAGES = [
+    forward(
+        1,
+        [
+            tx("aa" * 32, [token_output(b"A"), token_output(b"B")]),
+            tx("bb" * 32, [authority_output(b"\x03" * 28)]),
+        ],
+    ),
+    forward(
+        2,
+        [
+            tx(
+                "cc" * 32,
+                [token_output(b"C"), token_output(b"D", AUTHORITY_TRUST)],
+                inputs=[("aa" * 32, 0)],
+            )
+        ],
+    ),
+]
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """
+    Writes the snapshots and metrics of the querier to a temporary directory
+    """
+    monkeypatch.setattr(util, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(querier, "QUERIER_METRICS", tmp_path / "querier.prom")
+    return tmp_path
+
+
+def follow(messages: list, store: RegistrationStore, checkpoint) -> RegistryIndexer:
+    indexer = RegistryIndexer([TOKEN_TRUST, AUTHORITY_TRUST])
+    querier.follow_chain(ReplayChainSync(messages), indexer, store, checkpoint)
+    return indexer
+
+
+def stored(store: RegistrationStore, contract: str) -> set:
+    return {
+        verifier["utxo"]
+        for _, item in store.items(contract, "subjects")
+        for verifier in item["verifiers"]
+    }
+
+
+def test_roll_forward_applies_created_and_spent_registrations(data_dir):
+    store = RegistrationStore(data_dir / "registrations.sqlite3")
+    indexer = follow(MESSAGES, store, data_dir / "checkpoint.json")
+    expected = {f"{'aa' * 32}#1", f"{'cc' * 32}#0"}
+    assert set(indexer.registries["token_trust"]) == expected
+    assert stored(store, "token_trust") == expected
+    assert stored(store, "authority_trust") == {f"{'bb' * 32}#0"}
+    subjects = json.loads(
+        util.contract_data_path("token_trust", util.FULL_LIST).read_text()
+    )
+    assert [s["subject"]["fields"][1]["bytes"] for s in subjects] == ["42", "43"]
+    assert indexer.point == block_point(MESSAGES[-1]["RollForward"]["block"])
+
+
+def test_roll_backward_restores_the_registries(data_dir):
+    store = RegistrationStore(data_dir / "registrations.sqlite3")
+    indexer = follow(MESSAGES + [backward(1)], store, data_dir / "checkpoint.json")
+    expected = {f"{'aa' * 32}#0", f"{'aa' * 32}#1"}
+    assert set(indexer.registries["token_trust"]) == expected
+    assert stored(store, "token_trust") == expected
+    assert stored(store, "authority_trust") == {f"{'bb' * 32}#0"}
+    assert indexer.point == block_point(MESSAGES[0]["RollForward"]["block"])
+
+
+def test_resumes_from_the_checkpoint(data_dir):
+    checkpoint = data_dir / "checkpoint.json"
+    store = RegistrationStore(data_dir / "registrations.sqlite3")
+    follow(MESSAGES[:1], store, checkpoint)
+    assert checkpoint.exists()
+    # continues after the block of the checkpoint
+    resumed = follow(MESSAGES + [forward(3, [])], store, checkpoint)
+    assert set(resumed.registries["token_trust"]) == {
+        f"{'aa' * 32}#1",
+        f"{'cc' * 32}#0",
+    }
+    assert stored(store, "token_trust") == set(resumed.registries["token_trust"])
+    # blocks applied before the restart are rolled back from the restored state
+    rolled_back = follow(MESSAGES + [forward(3, []), backward(1)], store, checkpoint)
+    assert set(rolled_back.registries["token_trust"]) == {
+        f"{'aa' * 32}#0",
+        f"{'aa' * 32}#1",
+    }
+
+
+def test_unchanged_registrations_keep_the_snapshots(data_dir):
+    store = RegistrationStore(data_dir / "registrations.sqlite3")
+    indexer = follow(MESSAGES, store, data_dir / "checkpoint.json")
+    registrations = indexer.registries["token_trust"].values()
+    snapshot = util.contract_binary_snapshot_path("token_trust")
+    written = snapshot.stat().st_ino
+    querier.write_registrations(store, "token_trust", registrations)
+    assert snapshot.stat().st_ino == written
+    snapshot.unlink()
+    querier.write_registrations(store, "token_trust", registrations)
+    assert snapshot.exists()
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from onchain_token_verification.rest.chainsync import WatchedContract
+from onchain_token_verification.rest.kupo import CHECKPOINT_HEADER, KupoBackend
+
+ADDRESS = "addr_test1wzcontract"
+POLICY_ID = "ab" * 28
+ASSET_NAME = b"trusted".hex()
+CONTRACT = WatchedContract(
+    name="token_trust",
+    address=ADDRESS,
+    asset=f"{POLICY_ID}.{ASSET_NAME}",
+    registration_class=object,
+)
+
+
+def match(tx_id: str, created: int, spent=None, datum_hash="d1", policy_id=POLICY_ID):
+    return {
+        "transaction_id": tx_id,
+        "output_index": 0,
+        "address": ADDRESS,
+        "value": {"coins": 2_000_000, "assets": {f"{policy_id}.{ASSET_NAME}": 1}},
+        "datum_hash": datum_hash,
+        "datum_type": "inline",
+        "created_at": {"slot_no": created},
+        "spent_at": None if spent is None else {"slot_no": spent},
+    }
+
+
+class KupoStandIn:
+    """
+    Serves the subset of the Kupo API used by the backend from a list of matches
+    """
+
+    def __init__(self):
+        self.matches = []
+        self.datums = {"d1": "d87980"}
+        self.checkpoint = 100
+        self.requests = []
+        # seconds to wait before answering a request for matches
+        self.delay = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                stand_in.requests.append(self.path)
+                params = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+                if url.path.startswith("/datums/"):
+                    body = {"datum": stand_in.datums[url.path[len("/datums/") :]]}
+                elif url.path == f"/matches/{ADDRESS}":
+                    time.sleep(stand_in.delay)
+                    body = [m for m in stand_in.matches if stand_in.selects(m, params)]
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header(CHECKPOINT_HEADER, str(stand_in.checkpoint))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def selects(m: dict, params: dict) -> bool:
+        asset = f"{params['policy_id'][0]}.{params['asset_name'][0]}"
+        if asset not in m["value"]["assets"]:
+            return False
+        if "unspent" in params and m["spent_at"] is not None:
+            return False
+        if "spent" in params and m["spent_at"] is None:
+            return False
+        if "created_after" in params:
+            return m["created_at"]["slot_no"] > int(params["created_after"][0])
+        if "spent_after" in params:
+            return m["spent_at"]["slot_no"] > int(params["spent_after"][0])
+        return True
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def kupo():
+    stand_in = KupoStandIn()
+    yield stand_in
+    stand_in.close()
+
+
+def refs(utxos) -> set:
+    return {tx_in["txId"] for tx_in, _ in utxos}
+
+
+def test_fetches_matches_of_the_contract_address_filtered_by_token(kupo):
+    kupo.matches = [match("aa", 10), match("bb", 20, policy_id="cd" * 28)]
+    backend = KupoBackend(kupo.url)
+    utxos = asyncio.run(backend.utxos(CONTRACT, 5))
+    assert refs(utxos) == {"aa"}
+    tx_in, output = utxos[0]
+    assert tx_in == {"txId": "aa", "index": 0}
+    assert output["address"] == ADDRESS
+    assert output["datum"] == "d87980"
+    assert kupo.requests[0].startswith(f"/matches/{ADDRESS}?unspent&")
+    assert f"policy_id={POLICY_ID}" in kupo.requests[0]
+    assert f"asset_name={ASSET_NAME}" in kupo.requests[0]
+
+
+def test_applies_matches_created_and_spent_after_the_checkpoint(kupo):
+    kupo.matches = [match("aa", 10), match("bb", 20)]
+    backend = KupoBackend(kupo.url)
+    assert refs(asyncio.run(backend.utxos(CONTRACT, 5))) == {"aa", "bb"}
+    kupo.matches = [match("aa", 10, spent=110), match("bb", 20), match("cc", 120)]
+    kupo.checkpoint = 130
+    kupo.requests.clear()
+    assert refs(asyncio.run(backend.utxos(CONTRACT, 5))) == {"bb", "cc"}
+    assert any("created_after=100" in r for r in kupo.requests)
+    assert any("spent_after=100" in r for r in kupo.requests)
+
+
+def test_resyncs_all_unspent_matches(kupo):
+    kupo.matches = [match("aa", 10)]
+    backend = KupoBackend(kupo.url, resync_every=2)
+    asyncio.run(backend.utxos(CONTRACT, 5))
+    asyncio.run(backend.utxos(CONTRACT, 5))
+    # rolled back, so never reported as spent
+    kupo.matches = [match("bb", 20)]
+    assert refs(asyncio.run(backend.utxos(CONTRACT, 5))) == {"bb"}
+
+
+def test_timed_out_cycle_does_not_update_the_state(kupo):
+    kupo.matches = [match("aa", 10)]
+    backend = KupoBackend(kupo.url)
+
+    async def cycles():
+        assert refs(await backend.utxos(CONTRACT, 5)) == {"aa"}
+        kupo.matches = [match("aa", 10), match("bb", 120)]
+        kupo.checkpoint = 130
+        kupo.delay = 0.5
+        with pytest.raises(asyncio.TimeoutError):
+            await backend.utxos(CONTRACT, 0.1)
+        kupo.delay = 0
+        # the next cycle starts while the worker of the timed out one still waits
+        kupo.matches = [match("aa", 10, spent=140), match("bb", 120)]
+        kupo.checkpoint = 150
+        assert refs(await backend.utxos(CONTRACT, 5)) == {"bb"}
+
+    asyncio.run(cycles())
+    kupo.requests.clear()
+    assert refs(asyncio.run(backend.utxos(CONTRACT, 5))) == {"bb"}
+    assert any("created_after=150" in r for r in kupo.requests)
+
+
+def test_outdated_worker_does_not_update_the_state(kupo):
+    kupo.matches = [match("aa", 10)]
+    backend = KupoBackend(kupo.url)
+    asyncio.run(backend.utxos(CONTRACT, 5))
+    kupo.matches = [match("bb", 120)]
+    # a later cycle started while this worker was running
+    with pytest.raises(TimeoutError):
+        backend._fetch(CONTRACT, 0, time.monotonic() + 5)
+    assert refs(asyncio.run(backend.utxos(CONTRACT, 5))) == {"aa", "bb"}
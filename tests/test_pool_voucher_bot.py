@@ -0,0 +1,218 @@
+from pycardano import (
+    Address,
+    AssetName,
+    Network,
+    PaymentSigningKey,
+    ScriptHash,
+    Transaction,
+)
+
+from onchain_token_verification.rest.chainsync import ReplayChainSync, block_point
+from onchain_token_verification.scripts.batch import (
+    OfflineChainContext,
+    ogmios_utxo,
+    pycardano_utxo,
+    transaction_outputs,
+)
+from onchain_token_verification.scripts.pool_voucher_bot import (
+    POOL_VERIFIER,
+    VoucherBot,
+    follow_chain,
+)
+from onchain_token_verification.smart_voucher.muesliswap_pool_verifier import (
+    POOL_NFT_POLICYID,
+    POOL_SCRIPT_HASH,
+    THRESHOLD,
+)
+from onchain_token_verification.utils import get_contract
+
+POOL_ADDRESS = str(Address(ScriptHash(POOL_SCRIPT_HASH), network=Network.TESTNET))
+GENESIS_ID = "11" * 32
+
+
+def output(address: str, coins: int, assets=None) -> dict:
+    return {"address": address, "value": {"coins": coins, "assets": assets or {}}}
+
+
+def pool(nft: str, coins: int) -> dict:
+    return output(
+        POOL_ADDRESS, coins, {f"{POOL_NFT_POLICYID.hex()}.{nft}": 1, "aa" * 28: 5}
+    )
+
+
+def block(slot: int, txs: list) -> dict:
+    return {
+        "babbage": {"header": {"slot": slot}, "headerHash": f"{slot:064x}", "body": txs}
+    }
+
+
+def forward(b: dict) -> dict:
+    return {"RollForward": {"block": b, "tip": block_point(b)}}
+
+
+def swap(tx_id: str, pool_index: int, nft: str, coins: int) -> dict:
+    """
+    A transaction spending the pool output of the genesis transaction
+    """
+    return {
+        "id": tx_id,
+        "body": {
+            "inputs": [{"txId": GENESIS_ID, "index": pool_index}],
+            "outputs": [pool(nft, coins)],
+        },
+    }
+
+
+def tx_json(tx: Transaction) -> dict:
+    body = tx.transaction_body
+    return {
+        "id": str(tx.id),
+        "body": {
+            "inputs": [
+                {"txId": i.transaction_id.payload.hex(), "index": i.index}
+                for i in body.inputs
+            ],
+            "outputs": [ogmios_utxo(u)[1] for u in transaction_outputs(body)],
+        },
+    }
+
+
+def bot_with_wallet(submit: bool = True):
+    """
+    A bot with an offline chain context and the genesis transaction, funding its wallet with
+    20, 12 and 5 ADA and creating a pool above (01) and one below (02) the threshold
+    """
+    skey = PaymentSigningKey.generate()
+    context = OfflineChainContext()
+    bot = VoucherBot(context, get_contract(POOL_VERIFIER), skey, submit=submit)
+    wallet = str(bot.address)
+    genesis = {
+        "id": GENESIS_ID,
+        "body": {
+            "inputs": [],
+            "outputs": [
+                output(wallet, 20_000_000),
+                output(wallet, 12_000_000),
+                output(wallet, 5_000_000),
+                pool("01", THRESHOLD + 1),
+                pool("02", THRESHOLD - 1),
+            ],
+        },
+    }
+    for i, o in enumerate(genesis["body"]["outputs"][:3]):
+        context.add_utxo(pycardano_utxo(f"{GENESIS_ID}#{i}", o))
+    return bot, skey, context, block(10, [genesis])
+
+
+def minted(bot: VoucherBot, tx: Transaction) -> dict:
+    return {
+        name.payload.hex(): quantity
+        for name, quantity in tx.transaction_body.mint[bot.policy_id].items()
+    }
+
+
+def test_mints_voucher_of_pool_above_threshold():
+    bot, _, _, genesis = bot_with_wallet()
+    bot.roll_forward(genesis)
+    (tx,) = bot.act()
+    assert minted(bot, tx) == {"01": 1}
+    body = tx.transaction_body
+    # the smallest UTxO with at least MIN_FUNDING lovelace
+    assert [(i.transaction_id.payload.hex(), i.index) for i in body.inputs] == [
+        (GENESIS_ID, 1)
+    ]
+    assert len(body.outputs) == 1
+    assert body.outputs[0].amount.multi_asset[bot.policy_id][AssetName(b"\x01")] == 1
+    # the pool is the only reference input
+    assert [i.index for i in body.reference_inputs] == [3]
+    # pending until on chain
+    assert bot.act() == []
+
+
+def test_burns_voucher_once_pool_drops_below_threshold():
+    bot, _, _, genesis = bot_with_wallet()
+    bot.roll_forward(genesis)
+    (mint,) = bot.act()
+    bot.roll_forward(
+        block(20, [tx_json(mint), swap("22" * 32, 4, "02", THRESHOLD + 1)])
+    )
+    assert not bot.pending
+    (mint_b,) = bot.act()
+    assert minted(bot, mint_b) == {"02": 1}
+    bot.roll_forward(
+        block(30, [tx_json(mint_b), swap("33" * 32, 3, "01", THRESHOLD - 1)])
+    )
+    (burn,) = bot.act()
+    assert minted(bot, burn) == {"01": -1}
+    assert bot.policy_id not in burn.transaction_body.outputs[0].amount.multi_asset
+    assert bot.due(set(bot.indexer.pools)) == []
+
+
+def test_rollback_restores_pools():
+    bot, _, _, genesis = bot_with_wallet()
+    bot.roll_forward(genesis)
+    (mint,) = bot.act()
+    b2 = block(20, [tx_json(mint)])
+    bot.roll_forward(b2)
+    bot.roll_forward(block(30, [swap("33" * 32, 3, "01", THRESHOLD - 1)]))
+    assert bot.indexer.pools["01"][1] == THRESHOLD - 1
+    bot.roll_backward(block_point(b2))
+    assert bot.indexer.pools["01"] == [f"{GENESIS_ID}#3", THRESHOLD + 1]
+    assert bot.act() == []
+
+
+def test_resumes_from_checkpoint(tmp_path):
+    checkpoint = tmp_path / "checkpoint.json"
+    bot, skey, context, genesis = bot_with_wallet(submit=False)
+    follow_chain(ReplayChainSync([forward(genesis)]), bot, checkpoint)
+    ((tx_id, pending),) = bot.pending.items()
+    assert pending.pool == "01" and pending.minted == 1
+    mint = {
+        "id": tx_id,
+        "body": {
+            "inputs": [{"txId": GENESIS_ID, "index": 1}],
+            "outputs": [
+                output(
+                    str(bot.address),
+                    12_000_000 - 200_000,
+                    {f"{bot.policy_id.payload.hex()}.01": 1},
+                )
+            ],
+        },
+    }
+    messages = [
+        forward(genesis),
+        forward(block(20, [mint, swap("33" * 32, 3, "01", THRESHOLD - 1)])),
+    ]
+    resumed = VoucherBot(context, get_contract(POOL_VERIFIER), skey, submit=False)
+    follow_chain(ReplayChainSync(messages), resumed, checkpoint)
+    assert resumed.indexer.pools["01"][1] == THRESHOLD - 1
+    ((_, pending),) = resumed.pending.items()
+    assert pending.pool == "01" and pending.minted == -1
+
+
+def test_loads_wallet_and_pools_when_starting_after_origin(tmp_path):
+    bot, _, context, genesis = bot_with_wallet(submit=False)
+    wallet = str(bot.address)
+    # the pools and the UTxOs of the wallet, one holding the voucher of pool 01, predate the start
+    context.add_utxo(
+        pycardano_utxo(
+            f"{GENESIS_ID}#5",
+            output(wallet, 5_000_000, {f"{bot.policy_id.payload.hex()}.01": 1}),
+        )
+    )
+    for i, o in [(3, pool("01", THRESHOLD + 1)), (6, pool("03", THRESHOLD + 1))]:
+        context.add_utxo(pycardano_utxo(f"{GENESIS_ID}#{i}", o))
+    messages = [forward(genesis), forward(block(20, []))]
+    follow_chain(
+        ReplayChainSync(messages),
+        bot,
+        tmp_path / "checkpoint.json",
+        start=block_point(genesis),
+    )
+    assert set(bot.indexer.pools) == {"01", "03"}
+    assert len(bot.indexer.wallet) == 4
+    ((_, pending),) = bot.pending.items()
+    assert pending.pool == "03" and pending.minted == 1
+    # funded by a UTxO of the wallet from before the start
+    assert pending.spent == [f"{GENESIS_ID}#1"]
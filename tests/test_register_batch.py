@@ -0,0 +1,120 @@
+import json
+
+from pycardano import (
+    Address,
+    ExecutionUnits,
+    Network,
+    PaymentSigningKey,
+    PaymentVerificationKey,
+    TransactionId,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+    plutus_script_hash,
+)
+
+from onchain_token_verification.rest.registrations import decode_registration
+from onchain_token_verification.scripts.batch import (
+    CONTRACTS,
+    ChainedContext,
+    OfflineChainContext,
+    within_limits,
+)
+from onchain_token_verification.scripts.register_batch import register
+from onchain_token_verification.utils import get_contract
+
+
+def funded_wallet(context: OfflineChainContext) -> PaymentSigningKey:
+    skey = PaymentSigningKey.generate()
+    address = Address(
+        PaymentVerificationKey.from_signing_key(skey).hash(), network=Network.TESTNET
+    )
+    context.add_utxo(
+        UTxO(
+            TransactionInput(TransactionId(bytes(32)), 0),
+            TransactionOutput(address, 1_000_000_000),
+        )
+    )
+    return skey
+
+
+def registered(context: OfflineChainContext, contract_name: str) -> list:
+    """
+    The decoded registrations at the contract address
+    """
+    contract = get_contract(contract_name)
+    address = Address(plutus_script_hash(contract), network=Network.TESTNET)
+    return [
+        decode_registration(
+            f"{utxo.input.transaction_id.payload.hex()}#{utxo.input.index}",
+            utxo.output.datum.to_cbor(),
+            CONTRACTS[contract_name].Registration,
+        )
+        for utxo in context.utxos(address)
+    ]
+
+
+def test_registers_entries_in_chained_transactions():
+    # every input and output costs a tenth of the step budget, so only a few fit per transaction
+    offline = OfflineChainContext(ex_units_per_io=ExecutionUnits(30000, 1_000_000_000))
+    skey = funded_wallet(offline)
+    contract = get_contract("token_trust")
+    entries = [
+        {
+            "contract": "token_trust",
+            "policy_id": "%056x" % i,
+            "token_name": "4d494c4b",
+            "metadata": {"name": f"Milk {i}", "decimals": 6},
+        }
+        for i in range(20)
+    ]
+    signed_txs = register(
+        ChainedContext(offline), "token_trust", contract, entries, skey
+    )
+    assert len(signed_txs) > 1
+    assert all(within_limits(tx, offline.protocol_param) for tx in signed_txs)
+    # each transaction spends the change of the previous one
+    for previous, tx in zip(signed_txs, signed_txs[1:]):
+        assert previous.id in {i.transaction_id for i in tx.transaction_body.inputs}
+    contract_hash = plutus_script_hash(contract)
+    assert [
+        sum(tx.transaction_body.mint[contract_hash].values()) for tx in signed_txs
+    ] == [
+        sum(1 for o in tx.transaction_body.outputs if o.datum is not None)
+        for tx in signed_txs
+    ]
+    assert len(offline.submitted) == len(signed_txs)
+
+    registrations = registered(offline, "token_trust")
+    assert sorted(json.loads(s)["fields"][0]["bytes"] for s, _ in registrations) == [
+        entry["policy_id"] for entry in entries
+    ]
+    signer = PaymentVerificationKey.from_signing_key(skey).hash().payload.hex()
+    assert {signature["signer"] for _, signature in registrations} == {signer}
+
+
+def test_registers_authorities_with_and_without_metadata():
+    offline = OfflineChainContext()
+    skey = funded_wallet(offline)
+    entries = [
+        {
+            "contract": "authority_trust",
+            "authority": "%056x" % 1,
+            "metadata": {"name": "Authority"},
+        },
+        {"contract": "authority_trust", "authority": "%056x" % 2},
+    ]
+    (_,) = register(
+        ChainedContext(offline),
+        "authority_trust",
+        get_contract("authority_trust"),
+        entries,
+        skey,
+    )
+    registrations = {
+        json.loads(s)["bytes"]: signature
+        for s, signature in registered(offline, "authority_trust")
+    }
+    assert set(registrations) == {"%056x" % 1, "%056x" % 2}
+    assert registrations["%056x" % 2]["metadata"] is None
+    assert registrations["%056x" % 1]["metadata"] is not None
@@ -0,0 +1,37 @@
+import json
+
+from onchain_token_verification.rest.store import RegistrationStore
+
+SIGNER = "aa" * 28
+TOKEN_NAME = "4d494c4b"
+
+
+def token(i: int) -> tuple:
+    subject = {
+        "constructor": 0,
+        "fields": [{"bytes": "%056x" % i}, {"bytes": TOKEN_NAME}],
+    }
+    signature = {"signer": SIGNER, "utxo": "%064x#0" % i, "metadata": None}
+    return json.dumps(subject), signature
+
+
+def delete(path):
+    for suffix in ("", "-wal", "-shm"):
+        path.with_name(path.name + suffix).unlink(missing_ok=True)
+
+
+def test_cursors_of_a_recreated_store_ask_for_a_resync(tmp_path):
+    path = tmp_path / "registrations.sqlite3"
+    store = RegistrationStore(path)
+    store.replace("token_trust", [token(i) for i in range(5)])
+    cursor, _ = store.changes("token_trust", 0, 100)
+    store_id = store.store_id()
+    store.close()
+    assert RegistrationStore(path, readonly=True).store_id() == store_id
+    delete(path)
+    store = RegistrationStore(path)
+    assert store.store_id() != store_id
+    store.replace("token_trust", [token(9)])
+    assert store.changes("token_trust", cursor, 100) == (1, None)
+    assert store.changes("token_trust", 0, 100)[0] == 1
+
@@ -0,0 +1,37 @@
+import json
+
+from onchain_token_verification.rest.store import RegistrationStore
+from onchain_token_verification.rest.trust import UNVERIFIED, VERIFIED, TrustGraph
+
+ROOT = "aa" * 28
+TOKEN_NAME = "4d494c4b"
+
+
+def token(i: int) -> tuple:
+    """
+    A registration of token i by the root authority
+    """
+    subject = {
+        "constructor": 0,
+        "fields": [{"bytes": "%056x" % i}, {"bytes": TOKEN_NAME}],
+    }
+    signature = {"signer": ROOT, "utxo": "%064x#0" % i, "metadata": None}
+    return json.dumps(subject), signature
+
+
+def test_trust_graph_reloads_a_recreated_store(tmp_path):
+    path = tmp_path / "registrations.sqlite3"
+    store = RegistrationStore(path)
+    store.replace("token_trust", [token(i) for i in range(5)])
+    graph = TrustGraph([ROOT], sync_interval=0)
+    graph.sync(store)
+    assert graph.verify("%056x" % 1, TOKEN_NAME)["verdict"] == VERIFIED
+    store.close()
+    for suffix in ("", "-wal", "-shm"):
+        path.with_name(path.name + suffix).unlink(missing_ok=True)
+    store = RegistrationStore(path)
+    # the cursors of the new store already went past the one of the graph
+    store.replace("token_trust", [token(i) for i in range(10, 16)])
+    graph.sync(store)
+    assert graph.verify("%056x" % 1, TOKEN_NAME)["verdict"] == UNVERIFIED
+    assert graph.verify("%056x" % 10, TOKEN_NAME)["verdict"] == VERIFIED
@@ -0,0 +1,181 @@
+import pytest
+from pycardano import (
+    Address,
+    Network,
+    PaymentSigningKey,
+    PaymentVerificationKey,
+    TransactionId,
+    TransactionInput,
+    TransactionOutput,
+    UTxO,
+    plutus_script_hash,
+)
+
+from onchain_token_verification.rest.registrations import decode_registration
+from onchain_token_verification.rest.store import RegistrationStore
+from onchain_token_verification.scripts.batch import (
+    CONTRACTS,
+    ChainedContext,
+    OfflineChainContext,
+)
+from onchain_token_verification.scripts.register_batch import register
+from onchain_token_verification.scripts.withdraw_batch import (
+    find_registrations,
+    withdraw,
+)
+from onchain_token_verification.utils import get_contract
+
+
+def token(i: int, contract: str = "token_trust") -> dict:
+    return {"contract": contract, "policy_id": "%056x" % i, "token_name": "4d494c4b"}
+
+
+def wallet(i: int, context: OfflineChainContext) -> PaymentSigningKey:
+    skey = PaymentSigningKey.generate()
+    address = Address(
+        PaymentVerificationKey.from_signing_key(skey).hash(), network=Network.TESTNET
+    )
+    context.add_utxo(
+        UTxO(
+            TransactionInput(TransactionId(bytes(32)), i),
+            TransactionOutput(address, 1_000_000_000),
+        )
+    )
+    return skey
+
+
+def signer_of(skey: PaymentSigningKey) -> bytes:
+    return PaymentVerificationKey.from_signing_key(skey).hash().to_primitive()
+
+
+def refs(found) -> dict:
+    return {name: {str(utxo.input) for utxo in utxos} for name, utxos in found.items()}
+
+
+@pytest.fixture
+def chain():
+    """
+    An offline chain with registrations at all contracts of the owner
+    and two token registrations of another signer
+    """
+    offline = OfflineChainContext()
+    owner, other = wallet(0, offline), wallet(1, offline)
+    contracts = {name: get_contract(name) for name in CONTRACTS}
+    context = ChainedContext(offline)
+    register(
+        context,
+        "token_trust",
+        contracts["token_trust"],
+        [token(i) for i in range(6)],
+        owner,
+    )
+    register(
+        context,
+        "authority_trust",
+        contracts["authority_trust"],
+        [{"contract": "authority_trust", "authority": "%056x" % i} for i in range(3)],
+        owner,
+    )
+    register(
+        context,
+        "token_mistrust",
+        contracts["token_mistrust"],
+        [token(i, "token_mistrust") for i in range(2)],
+        owner,
+    )
+    register(
+        context, "token_trust", contracts["token_trust"], [token(0), token(1)], other
+    )
+    return offline, contracts, owner, other
+
+
+def index(offline: OfflineChainContext, contracts: dict, path) -> RegistrationStore:
+    """
+    The store of the querier, indexing the registrations on the offline chain
+    """
+    store = RegistrationStore(path)
+    for name, contract in contracts.items():
+        address = Address(plutus_script_hash(contract), network=Network.TESTNET)
+        registrations = []
+        for utxo in offline.utxos(address):
+            if utxo.output.datum is None:
+                continue
+            registration = decode_registration(
+                f"{utxo.input.transaction_id.payload.hex()}#{utxo.input.index}",
+                utxo.output.datum.to_cbor(),
+                CONTRACTS[name].Registration,
+            )
+            if registration is not None:
+                registrations.append(registration)
+        store.replace(name, registrations)
+    return store
+
+
+def test_finds_all_registrations_of_the_signer(chain):
+    offline, contracts, owner, other = chain
+    found = find_registrations(ChainedContext(offline), contracts, signer_of(owner))
+    assert {name: len(utxos) for name, utxos in found.items()} == {
+        "authority_trust": 3,
+        "token_trust": 6,
+        "token_mistrust": 2,
+    }
+    found = find_registrations(ChainedContext(offline), contracts, signer_of(other))
+    assert len(found["token_trust"]) == 2
+
+
+def test_finds_only_the_given_subjects(chain):
+    offline, contracts, owner, _ = chain
+    subjects = {
+        ("token_trust", "%056x.4d494c4b" % 1),
+        ("authority_trust", "%056x" % 2),
+    }
+    found = find_registrations(
+        ChainedContext(offline), contracts, signer_of(owner), subjects
+    )
+    assert {name: len(utxos) for name, utxos in found.items()} == {
+        "authority_trust": 1,
+        "token_trust": 1,
+        "token_mistrust": 0,
+    }
+
+
+def test_store_lookup_matches_the_scan(chain, tmp_path):
+    offline, contracts, owner, other = chain
+    store = index(offline, contracts, tmp_path / "registrations.sqlite3")
+    subjects = {
+        ("token_trust", "%056x.4d494c4b" % 1),
+        ("token_mistrust", "%056x.4d494c4b" % 0),
+    }
+    for signer in (signer_of(owner), signer_of(other)):
+        for selected in (None, subjects):
+            scanned = find_registrations(
+                ChainedContext(offline), contracts, signer, selected
+            )
+            looked_up = find_registrations(
+                ChainedContext(offline), contracts, signer, selected, store
+            )
+            assert refs(looked_up) == refs(scanned)
+
+
+def test_withdraws_and_burns_the_registrations(chain, tmp_path):
+    offline, contracts, owner, other = chain
+    store = index(offline, contracts, tmp_path / "registrations.sqlite3")
+    context = ChainedContext(offline)
+    found = find_registrations(context, contracts, signer_of(owner), store=store)
+    for name, utxos in found.items():
+        signed_txs = withdraw(context, name, contracts[name], utxos, owner)
+        spent = {tx_in for tx in signed_txs for tx_in in tx.transaction_body.inputs}
+        assert {utxo.input for utxo in utxos} <= spent
+        contract_hash = plutus_script_hash(contracts[name])
+        assert sum(
+            sum(tx.transaction_body.mint[contract_hash].values()) for tx in signed_txs
+        ) == -len(utxos)
+    remaining = find_registrations(ChainedContext(offline), contracts, signer_of(owner))
+    assert not any(remaining.values())
+    # the store is not updated yet, spent registrations are skipped
+    looked_up = find_registrations(
+        ChainedContext(offline), contracts, signer_of(owner), store=store
+    )
+    assert not any(looked_up.values())
+    found = find_registrations(ChainedContext(offline), contracts, signer_of(other))
+    assert len(found["token_trust"]) == 2